@@ -6,14 +6,46 @@ Main Flask application
 
 import os
 import json
+import fcntl
 import time
+import zlib
+import shutil
 import threading
 import subprocess
 from datetime import datetime
 from pathlib import Path
-from flask import Flask, render_template, jsonify, request, send_file, Response
+from flask import Flask, render_template, jsonify, request, Response
 import glob
 
+from camera_state import camera_service
+from events import event_bus
+import capture_backends
+from capture_backends import CaptureError, FswebcamCapture, open_capture_backend
+from session_index import SessionIndex
+from video_builder import (DEFAULT_SEGMENT_FRAMES, build_video, remove_segments, run_ffmpeg,
+                           set_display_rotation)
+from jobs import JobCancelled, JobQueue
+from metering import IRController, meter_frame
+from v4l2_controls import registry as control_registry
+from encoders import DEFAULT_QUALITY, EncoderError, describe_profiles, probe_profiles, resolve_profile
+from live_encoder import LiveEncoder
+from media import send_media
+from preview_stream import PreviewStream
+from thumbnails import ThumbnailStore
+from capture_daemon import CaptureClient, CaptureUnavailable
+from capture_sessions import LIBCAMERA_DEVICE, DeviceBusy, SessionRegistry
+from session_journal import SessionJournal
+from frame_store import FrameStore
+from storage import StorageManager, recompress_session
+from change_detect import CHANGE_MODES, DEFAULT_THIN_EVERY, DEFAULT_THRESHOLD, ChangeDetector
+import burst
+from burst import BURST_MODES, DEFAULT_BURST_FRAMES, MAX_BURST_FRAMES, BurstMerger
+import frame_pipeline
+from frame_pipeline import CaptureProcessor, FramePipeline, process_session
+from frame_writer import (DEFAULT_SYNC_FRAMES, DEFAULT_SYNC_SECONDS, DURABILITY_POLICIES, FrameWriter,
+                          intact_frames, temp_path)
+from scheduler import OVERRUN_POLICIES, DeadlineScheduler, parse_schedule_time, seconds_until, wait_until
+
 app = Flask(__name__)
 
 # Configuration
@@ -22,26 +54,85 @@ DATA_DIR = BASE_DIR / "timelapse_data"
 IMAGES_DIR = DATA_DIR / "images"
 VIDEOS_DIR = DATA_DIR / "videos"
 CONFIG_FILE = BASE_DIR / "config" / "settings.json"
+INDEX_DB = DATA_DIR / "sessions.db"
+CAPTURE_LOCK_FILE = DATA_DIR / "capture.lock"
+CAPTURE_SOCKET = DATA_DIR / "capture.sock"
+THUMBNAILS_DIR = DATA_DIR / "thumbnails"
+PROCESSED_DIR = DATA_DIR / "processed"
+JOURNAL_DIR = DATA_DIR / "journal"
 
 # Ensure directories exist
 IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
 CONFIG_FILE.parent.mkdir(parents=True, exist_ok=True)
 
-# Global state
-timelapse_state = {
-    "active": False,
-    "current_session": None,
-    "interval": 5,  # seconds
-    "total_frames": 0,
-    "start_time": None,
-    "scheduled_start": None,  # ISO datetime string
-    "scheduled_end": None,    # ISO datetime string
-    "thread": None,
-    "waiting_for_start": False
-}
+frame_store = FrameStore(IMAGES_DIR)
+session_index = SessionIndex(INDEX_DB, frame_store, VIDEOS_DIR)
+session_journal = SessionJournal(JOURNAL_DIR)
+
+# Running sessions by ID, each capturing from its own camera device with its
+# own worker thread (state dicts from new_session_state, see capture_sessions.py)
+capture_sessions = SessionRegistry()
+
+# Held while a session is being set up, so two starts can't claim one device
+session_start_lock = threading.Lock()
+
+# Open while this process owns the camera (see claim_capture)
+capture_lock_fd = None
+
+def claim_capture():
+    """Make this process the one that captures, unless another process already is
+    
+    Capture state lives in the process that runs the capture thread, so
+    however many server processes are started only one may drive the
+    camera. The owner holds an exclusive flock on CAPTURE_LOCK_FILE until
+    it exits.
+    
+    Returns:
+        bool: True if this process owns capture
+    """
+    global capture_lock_fd
+    if capture_lock_fd is not None:
+        return True
+    fd = os.open(CAPTURE_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    capture_lock_fd = fd
+    return True
+
+def capture_owner():
+    """PID of the process that owns capture, if known"""
+    try:
+        return int(CAPTURE_LOCK_FILE.read_text().strip() or 0) or None
+    except (OSError, ValueError):
+        return None
 
-camera_lock = threading.Lock()
+def capture_elsewhere_response():
+    """409 for camera requests reaching a process that doesn't own capture"""
+    return jsonify({"error": "The camera is driven by another server process",
+                    "capture_pid": capture_owner()}), 409
+
+# With TIMELAPSEPI_CAPTURE=daemon the capture engine runs in capture_daemon.py
+# and this process forwards to it; otherwise it captures in-process
+capture_client = CaptureClient(CAPTURE_SOCKET) if os.environ.get('TIMELAPSEPI_CAPTURE') == 'daemon' else None
+
+def forward_to_daemon(op, **params):
+    """Answer a request with the capture daemon's response"""
+    try:
+        message, _ = capture_client.call(op, **params)
+    except CaptureUnavailable as e:
+        print(f"[Daemon] {e}")
+        return jsonify({"error": "The capture daemon is not running"}), 503
+    return jsonify(message.get("result") or {"error": message.get("error")}), message.get("code", 200)
+
+# Per-device IR state, and the control names IR cameras use
+ir_controllers = {}
+IR_CONTROL_NAMES = ('led_mode', 'infrared_mode', 'ir_led', 'led1_mode')
 
 def load_config():
     """Load configuration from file"""
@@ -51,7 +142,42 @@ def load_config():
     return {
         "interval": 5,
         "resolution": [1920, 1080],
-        "camera_type": "auto"  # auto, picamera, libcamera, or usb
+        "camera_type": "auto",  # auto, picamera, libcamera, or usb
+        "capture_backend": "auto",  # auto (v4l2, falls back to fswebcam), v4l2, or fswebcam
+        "overrun_policy": "skip",  # skip, catchup, or shift when a capture overruns its slot
+        "segment_frames": 500,  # max frames per cached video segment
+        "live_encode": False,  # encode the video while capturing
+        "live_fps": 30,
+        "job_workers": 1,  # compile/rotate/preview jobs that may run at once
+        "encoder": "auto",  # encoder profile (see encoders.py), auto picks the fastest usable
+        "encoder_quality": "medium",  # low, medium or high: quality target for auto
+        "preview_fps": 5,  # live preview frame rate cap
+        "preview_resolution": [640, 480],  # live preview size cap
+        "thumbnail_cache_mb": 200,  # disk cap for session thumbnails (least recently viewed dropped first)
+        "durability": "frame",  # frame, count or time: when captured frames are flushed to the SD card
+        "durability_frames": DEFAULT_SYNC_FRAMES,  # frames between flushes with "count"
+        "durability_seconds": DEFAULT_SYNC_SECONDS,  # seconds between flushes with "time"
+        "storage_low_free_mb": 1024,  # below this only every storage_degrade_every-th frame is captured
+        "storage_degrade_every": 2,
+        "storage_min_free_mb": 300,  # below this capture pauses until space is freed
+        "retention_keep_sessions": None,  # keep only the newest N sessions (None: all)
+        "retention_max_gb": None,  # delete the oldest sessions beyond this total (None: no cap)
+        "retention_delete_frames_after_compile": False,  # keep only the video and thumbnails
+        "retention_recompress_after_days": None,  # re-encode older sessions' frames smaller (None: never)
+        "retention_recompress_width": 1280,
+        "retention_recompress_quality": 75,
+        "change_mode": "off",  # off, drop, thin or mark frames that barely differ from the last kept one
+        "change_threshold": DEFAULT_THRESHOLD,  # mean luminance change (0-255) below which a frame is unchanged
+        "change_thin_every": DEFAULT_THIN_EVERY,  # with "thin", keep one in this many unchanged frames
+        "change_boost_interval": None,  # capture interval while motion is detected (None: no boost)
+        "change_boost_seconds": 60,  # how long a boost lasts after the last motion
+        "burst_mode": "off",  # off, average (stack burst_frames frames) or hdr (fuse an exposure bracket)
+        "burst_frames": DEFAULT_BURST_FRAMES,  # frames per slot with "average"
+        "burst_exposures": None,  # exposure_time_absolute values for "hdr" (None: bracket the current exposure)
+        "process_workers": None,  # burst merge/post-processing processes (None: one less than the CPU cores)
+        "postprocess": [],  # stages a compile with "postprocess": true runs the frames through (see frame_pipeline.py)
+        "capture_postprocess": [],  # stages each frame goes through before it is stored
+        "postprocess_quality": 90  # JPEG quality of post-processed frames
     }
 
 def save_config(config):
@@ -59,85 +185,68 @@ def save_config(config):
     with open(CONFIG_FILE, 'w') as f:
         json.dump(config, f, indent=2)
 
-# Global cache for detected devices
-_device_cache = {
-    'devices': None,
-    'timestamp': 0,
-    'cache_duration': 60  # Cache for 60 seconds
-}
+def make_frame_writer():
+    """Frame writer with the configured durability policy (see frame_writer.py)"""
+    config = load_config()
+    policy = config.get('durability', 'frame')
+    if policy not in DURABILITY_POLICIES:
+        print(f"[Frames] Unknown durability policy {policy!r}, flushing every frame")
+        policy = 'frame'
+    return FrameWriter(policy, config.get('durability_frames', DEFAULT_SYNC_FRAMES),
+                       config.get('durability_seconds', DEFAULT_SYNC_SECONDS))
+
+def publish_job(job):
+    """Job queue listener: push job state and progress to browsers"""
+    event_bus.publish('job', job.to_dict())
+
+job_queue = JobQueue(load_config().get('job_workers', 1), on_change=publish_job)
+
+thumbnails = ThumbnailStore(THUMBNAILS_DIR, frame_store.frame_path,
+                            max_bytes=load_config().get('thumbnail_cache_mb', 200) * 1024 * 1024)
+
+def storage_usage():
+    """Bytes used by kind, from the session index and thumbnail cache totals"""
+    usage = session_index.totals()
+    usage["thumbnails"] = thumbnails.usage()["bytes"]
+    return usage
+
+def storage_changed(state, previous):
+    """Free space crossed a threshold: tell browsers, and free space if it is short"""
+    publish_status('storage', state=state, previous=previous)
+    if state != 'ok':
+        submit_retention()
+
+storage = StorageManager(DATA_DIR, storage_usage, storage_changed)
+storage.configure(load_config())
+
+def encoder_profile(name=None, needs_filters=False):
+    """Resolve an encoder profile: the request's override, else the configured one
+    
+    Returns:
+        tuple: (profile name, ffmpeg output args)
+    
+    Raises:
+        EncoderError: Unknown or unavailable profile
+    """
+    config = load_config()
+    return resolve_profile(name or config.get('encoder', 'auto'),
+                           config.get('encoder_quality', DEFAULT_QUALITY), needs_filters)
 
 def detect_usb_camera_devices(force_refresh=False):
-    """Detect all available USB camera devices that can actually capture
+    """Get all available USB camera devices that can actually capture
+    
+    Detection is owned by the background camera state service (see
+    camera_state.py); this just reads its latest snapshot.
     
     Args:
-        force_refresh: If True, ignore cache and re-scan devices
+        force_refresh: If True, rescan devices now and wait for the result
     
     Returns:
         list: List of dicts with device info: [{'device': '/dev/video0', 'name': 'Logitech Webcam'}]
     """
-    import time
-    
-    # Check cache
-    cache_age = time.time() - _device_cache['timestamp']
-    if not force_refresh and _device_cache['devices'] is not None and cache_age < _device_cache['cache_duration']:
-        print(f"[Device Detection] Using cached devices (age: {cache_age:.1f}s)")
-        return _device_cache['devices']
-    
-    print("[Device Detection] Scanning for cameras...")
-    devices = []
-    video_devices = sorted(Path('/dev').glob('video*'))
-    
-    for device in video_devices:
-        try:
-            # Try to get device info
-            result = subprocess.run(
-                ['v4l2-ctl', '--device', str(device), '--all'],
-                capture_output=True,
-                timeout=1,
-                text=True
-            )
-            
-            # Must have Video Capture capability
-            if 'Video Capture' not in result.stdout:
-                continue
-            
-            # Extract device name
-            device_name = str(device).split('/')[-1]
-            for line in result.stdout.split('\n'):
-                if 'Card type' in line or 'Device name' in line:
-                    parts = line.split(':', 1)
-                    if len(parts) > 1:
-                        device_name = parts[1].strip()
-                        break
-            
-            # Test if fswebcam can actually capture from this device
-            # This is the key test - some devices show as "Video Capture" but can't capture
-            test_result = subprocess.run(
-                ['fswebcam', '-d', str(device), '-r', '640x480', '--no-banner', '-'],
-                capture_output=True,
-                timeout=3
-            )
-            
-            # If fswebcam succeeded and produced output, this device works
-            if test_result.returncode == 0 and len(test_result.stdout) > 1000:
-                devices.append({
-                    'device': str(device),
-                    'name': device_name
-                })
-                print(f"[Device Detection] Found working camera: {device} ({device_name})")
-            else:
-                print(f"[Device Detection] Skipping {device} - fswebcam test failed")
-                
-        except Exception as e:
-            print(f"[Device Detection] Error checking {device}: {e}")
-            continue
-    
-    # Update cache
-    _device_cache['devices'] = devices
-    _device_cache['timestamp'] = time.time()
-    
-    print(f"[Device Detection] Scan complete. Found {len(devices)} working camera(s)")
-    return devices
+    if force_refresh:
+        return camera_service.refresh(wait=True)['devices']
+    return camera_service.devices()
 
 def get_default_camera_device():
     """Get the default/best camera device to use
@@ -158,163 +267,279 @@ def get_default_camera_device():
 def detect_camera():
     """Detect camera type (preserved for backward compatibility)
     
-    Uses cached device detection results to avoid repeated scanning.
+    Reads the camera state snapshot, so it never touches the hardware.
     """
-    devices = detect_usb_camera_devices(force_refresh=False)  # Use cache
-    if devices:
-        return 'usb'
+    return camera_service.camera_type()
+
+def configured_device():
+    """The selected camera: the one new sessions and the preview use by default
     
-    # Check for libcamera
-    result = subprocess.run(['which', 'libcamera-still'], capture_output=True)
-    if result.returncode == 0:
-        return 'libcamera'
+    Like get_default_camera_device(), but quiet, for the status and preview
+    paths that ask often.
     
-    return None
+    Returns:
+        str: camera_device from the config, else LIBCAMERA_DEVICE for a Pi
+             camera module, else the first detected USB camera
+    """
+    device = load_config().get('camera_device')
+    if device:
+        return device
+    if detect_camera() == 'libcamera':
+        return LIBCAMERA_DEVICE
+    devices = detect_usb_camera_devices()
+    return devices[0]['device'] if devices else '/dev/video0'
+
+def available_devices():
+    """Devices a session can be started on"""
+    devices = [d['device'] for d in detect_usb_camera_devices()]
+    if detect_camera() == 'libcamera':
+        devices.append(LIBCAMERA_DEVICE)
+    return devices
+
+def previewing(session):
+    """Whether the live preview is watching a session's camera right now"""
+    return preview_stream.client_count and session["device"] == configured_device()
 
-def capture_image(session_id, frame_number, resolution=(1920, 1080), auto_adjust=False, ir_mode='auto'):
+def capture_image(session, frame_number, backend=None, detector=None, lateness=0.0):
     """Capture a single image with optional auto-adjustment and IR control
     
     Args:
-        session_id: Session identifier
+        session: State dict of the running session (see new_session_state);
+                 its device, resolution, auto_adjust and ir_mode settings,
+                 frame writer and capture-time processor are used
         frame_number: Frame number for filename
-        resolution: Tuple of (width, height)
-        auto_adjust: If True, let camera auto-adjust settings between frames
-        ir_mode: 'on', 'off', or 'auto' (auto-detect based on brightness)
-    """
-    session_dir = IMAGES_DIR / session_id
-    session_dir.mkdir(parents=True, exist_ok=True)
-    
-    print(f"[Capture] Session directory: {session_dir}")
-    print(f"[Capture] Directory exists: {session_dir.exists()}")
-    print(f"[Capture] Directory is writable: {os.access(session_dir, os.W_OK)}")
-    
-    filename = session_dir / f"frame_{frame_number:06d}.jpg"
+        backend: Open capture backend to grab from (see capture_backends).
+                 If None a one-shot fswebcam capture is used.
+        detector: ChangeDetector deciding whether the frame is stored, if any
+        lateness: How late the slot started, for a frame stored once processed
     
-    camera_type = detect_camera()
+    Returns:
+        True if the frame was stored (or queued for processing), None if
+        the detector dropped it as unchanged, False if capture failed
+    """
+    session_id = session["id"]
+    resolution = session["resolution"]
+    auto_adjust = session["auto_adjust"]
+    ir_mode = session["ir_mode"]
+    frame_writer = session["frame_writer"]
+    processor = session["processor"]
+    filename = frame_store.path_for_write(session_id, frame_number)
+    
+    if session["device"] == LIBCAMERA_DEVICE:
+        camera_type = 'libcamera'
+    else:
+        camera_type = 'usb' if backend is not None else detect_camera()
     
     if camera_type == 'usb':
-        # Get configured camera device from config or use default
-        config = load_config()
-        video_device = config.get('camera_device', get_default_camera_device())
-        print(f"[Capture] Using camera device: {video_device}")
+        video_device = session["device"]
         
-        # Handle IR mode switching
-        if ir_mode == 'auto':
-            # Check brightness of last frame to decide if IR is needed
-            last_frame = session_dir / f"frame_{frame_number-1:06d}.jpg"
-            if last_frame.exists() and frame_number > 0:
-                try:
-                    # Calculate average brightness using ImageMagick or similar
-                    result = subprocess.run(
-                        ['ffmpeg', '-i', str(last_frame), '-vf', 
-                         'scale=100:100,format=gray,crop=50:50:25:25', 
-                         '-f', 'rawvideo', '-'],
-                        capture_output=True, timeout=2
-                    )
-                    if result.returncode == 0:
-                        # Calculate average brightness from raw data
-                        brightness = sum(result.stdout) / len(result.stdout) if result.stdout else 128
-                        
-                        # If too dark (< 30 out of 255), enable IR
-                        # If bright enough (> 50 out of 255), disable IR
-                        if brightness < 30:
-                            set_ir_mode(video_device, True)
-                        elif brightness > 50:
-                            set_ir_mode(video_device, False)
-                except:
-                    pass
-        elif ir_mode == 'on':
-            set_ir_mode(video_device, True)
-        elif ir_mode == 'off':
-            set_ir_mode(video_device, False)
+        # Handle IR mode switching ('auto' is decided from each frame's metering below)
+        if ir_mode in ('on', 'off'):
+            ir_controller(video_device).force(ir_mode == 'on')
         
-        # Build fswebcam command
-        cmd = [
-            'fswebcam',
-            '-d', video_device,
-            '-r', f"{resolution[0]}x{resolution[1]}",
-            '--no-banner',
-            '--jpeg', '95',  # High quality JPEG
-        ]
-        
-        if auto_adjust:
-            # Let camera auto-adjust by skipping frames
-            cmd.extend(['-S', '10'])  # Skip 10 frames for better adjustment
-            # Don't force any settings, let camera auto-adjust
-        else:
-            # Minimal frame skip, use locked settings
-            cmd.extend(['-S', '2'])  # Skip just 2 frames for camera stability
-            # Settings will be locked via v4l2-ctl before timelapse starts
-        
-        cmd.append(str(filename))
-        
-        print(f"[Capture] Command: {' '.join(cmd)}")
+        if backend is None:
+            skip_frames = 10 if auto_adjust else 2
+            backend = FswebcamCapture(video_device, resolution, skip_frames=skip_frames)
         
         try:
-            result = subprocess.run(cmd, check=True, capture_output=True, timeout=10)
-            
-            # Give filesystem a moment to sync
-            time.sleep(0.1)
-            
-            # Check if file exists
-            file_exists = filename.exists()
-            file_size = filename.stat().st_size if file_exists else 0
-            
-            print(f"[Capture] Frame {frame_number} - fswebcam returned success")
-            print(f"[Capture] Expected file: {filename}")
-            print(f"[Capture] File exists: {file_exists}, size: {file_size} bytes")
+            started = time.monotonic()
+            frame = backend.grab()
+            verdict = detector.judge(data=frame) if detector else 'keep'
+            if verdict == 'drop':
+                if previewing(session):
+                    preview_stream.offer(frame)
+                return None
+            if processor is not None:
+                captured_at = time.time()
+                processor.submit(frame_number, frame, captured_at,
+                                 {"verdict": verdict, "lateness": lateness, "captured_at": captured_at})
+            else:
+                store_frame(session, frame_number, frame, verdict)
+            elapsed = time.monotonic() - started
             
-            if not file_exists:
-                # Debug: list what's actually in the directory
-                print(f"[Capture] DEBUG: Listing directory contents:")
-                try:
-                    for item in session_dir.iterdir():
-                        print(f"[Capture]   - {item.name}")
-                except Exception as e:
-                    print(f"[Capture]   ERROR listing directory: {e}")
-                    
-                # Check stdout/stderr from fswebcam
-                if result.stdout:
-                    print(f"[Capture] fswebcam stdout: {result.stdout.decode('utf-8')}")
-                if result.stderr:
-                    print(f"[Capture] fswebcam stderr: {result.stderr.decode('utf-8')}")
-                    
-                return False
-                
-            if file_size == 0:
-                print(f"[Capture] WARNING: File created but has 0 bytes!")
-                return False
-                
-            print(f"[Capture] SUCCESS: Frame {frame_number} captured ({file_size} bytes)")
+            print(f"[Capture] SUCCESS: Frame {frame_number} captured via {backend.name} "
+                  f"({len(frame)} bytes, {elapsed * 1000:.0f} ms)")
             return True
             
-        except subprocess.CalledProcessError as e:
-            error_msg = e.stderr.decode('utf-8') if e.stderr else 'Unknown error'
-            print(f"[Capture] ERROR: Failed to capture frame {frame_number}: {error_msg}")
-            print(f"[Capture] Command was: {' '.join(cmd)}")
-            return False
-            return False
-        except subprocess.TimeoutExpired:
-            print(f"[Capture] ERROR: Timeout capturing frame {frame_number}")
+        except CaptureError as e:
+            print(f"[Capture] ERROR: Failed to capture frame {frame_number}: {e}")
             return False
         except Exception as e:
             print(f"[Capture] ERROR: Exception capturing frame {frame_number}: {e}")
             return False
     elif camera_type == 'libcamera':
         # Use libcamera-still for Raspberry Pi Camera
+        tmp = temp_path(filename)
         cmd = [
             'libcamera-still',
-            '-o', str(filename),
+            '-o', str(tmp),
             '--width', str(resolution[0]),
             '--height', str(resolution[1]),
             '--nopreview',
             '-t', '1'
         ]
         subprocess.run(cmd, check=True, capture_output=True)
+        if tmp.exists():
+            verdict = detector.judge(path=tmp) if detector else 'keep'
+            if verdict == 'drop':
+                tmp.unlink()
+                return None
+            if processor is not None:
+                data = tmp.read_bytes()
+                tmp.unlink()
+                captured_at = time.time()
+                processor.submit(frame_number, data, captured_at,
+                                 {"verdict": verdict, "lateness": lateness, "captured_at": captured_at})
+                return True
+            frame_writer.place(tmp, filename)
+            size, captured_at = filename.stat().st_size, time.time()
+            frame_store.add(session_id, frame_number, size, captured_at)
+            if verdict == 'mark':
+                frame_store.mark_unchanged(session_id, frame_number)
+            session_index.record_frame(session_id, size, captured_at)
+            storage.record_frame(size, captured_at)
+            if previewing(session):
+                preview_stream.offer(filename.read_bytes())
+            thumbnails.add(session_id, frame_number)
+            update_metering(session, frame_number, filename)
+            return True
+        return False
     else:
         raise Exception("No camera detected")
+
+def store_frame(session, frame_number, frame, verdict='keep', captured_at=None):
+    """Store a JPEG frame of a session
+    
+    Writes it, records it in the frame store, session index and storage
+    accounting, and hands it to the preview, thumbnails, metering and IR
+    control.
     
-    return filename.exists()
+    Args:
+        session: State dict of the running session
+        frame_number: Frame number for filename
+        frame: JPEG bytes
+        verdict: Change detection verdict, 'keep' or 'mark' (stored as unchanged)
+        captured_at: When it was grabbed (epoch seconds), if not just now
+    """
+    session_id = session["id"]
+    filename = frame_store.path_for_write(session_id, frame_number)
+    captured_at = captured_at or time.time()
+    session["frame_writer"].write(filename, frame)
+    frame_store.add(session_id, frame_number, len(frame), captured_at)
+    if verdict == 'mark':
+        frame_store.mark_unchanged(session_id, frame_number)
+    session_index.record_frame(session_id, len(frame), captured_at)
+    storage.record_frame(len(frame), captured_at)
+    if previewing(session):
+        preview_stream.offer(frame)
+    thumbnails.add(session_id, frame_number, frame)
+    
+    # Meter the frame we still have in memory; in auto mode the IR
+    # decision applies from the next frame on
+    stats = update_metering(session, frame_number, filename, frame)
+    if stats and session["ir_mode"] == 'auto' and session["device"] != LIBCAMERA_DEVICE:
+        ir_controller(session["device"]).update(stats['center_mean'])
+
+def capture_burst(session, frame_number, backend, detector, merger, lateness=0.0):
+    """Grab a burst (or exposure bracket) for one slot and queue it for merging
+    
+    The burst's reference frame is judged by the detector straight away, so
+    the capture loop can boost or drop without waiting for the merge. The
+    merged frame is stored by burst_merged once it is its turn.
+    
+    Args:
+        session: State dict of the running session
+        frame_number: Frame number the merged frame is stored as
+        backend: Open capture backend of the session's camera
+        detector: ChangeDetector, if any
+        merger: The session's BurstMerger
+        lateness: How late the slot started, for the log and status event
+    
+    Returns:
+        True if the burst was queued, None if the detector dropped it as
+        unchanged, False if capture failed
+    """
+    video_device = session["device"]
+    if session["ir_mode"] in ('on', 'off'):
+        ir_controller(video_device).force(session["ir_mode"] == 'on')
+    
+    try:
+        started = time.monotonic()
+        exposures = None
+        controls = None
+        if merger.mode == 'hdr':
+            controls = control_registry.get(video_device)
+            # Bracketed around the current auto exposure each slot, so it
+            # follows the light through the day
+            exposures = burst.bracket_exposures(controls, merger.exposures)
+        frames = burst.grab_burst(backend, merger.frames, exposures, controls)
+        reference = merger.reference(frames)
+        verdict = detector.judge(data=reference) if detector else 'keep'
+        if verdict == 'drop':
+            if previewing(session):
+                preview_stream.offer(reference)
+            return None
+        elapsed = time.monotonic() - started
+        print(f"[Capture] Burst of {len(frames)} frames for frame {frame_number} grabbed via {backend.name} "
+              f"({elapsed * 1000:.0f} ms" + (f", exposures {exposures})" if exposures else ")"))
+        merger.submit(frame_number, frames, {"verdict": verdict, "lateness": lateness,
+                                             "frames": len(frames), "captured_at": time.time()})
+        return True
+    except CaptureError as e:
+        print(f"[Capture] ERROR: Failed to capture burst for frame {frame_number}: {e}")
+        return False
+    except Exception as e:
+        print(f"[Capture] ERROR: Exception capturing burst for frame {frame_number}: {e}")
+        return False
+
+def burst_merged(session, frame_number, frame, context):
+    """Store a merged burst frame (BurstMerger.on_merged, called in capture order on its delivery thread)
+    
+    With capture-time processing it goes on to the session's processor.
+    """
+    print(f"[Capture] SUCCESS: Frame {frame_number} merged from {context['frames']} frames ({len(frame)} bytes)")
+    processor = session["processor"]
+    if processor is not None:
+        processor.submit(frame_number, frame, context["captured_at"], context)
+        return
+    store_frame(session, frame_number, frame, context["verdict"], context["captured_at"])
+    frame_captured(session, frame_number, context["lateness"])
+
+def frame_processed(session, frame_number, frame, context):
+    """Store a processed frame (CaptureProcessor.on_processed, called in capture order on its delivery thread)"""
+    store_frame(session, frame_number, frame, context["verdict"], context["captured_at"])
+    frame_captured(session, frame_number, context["lateness"])
+
+def frame_captured(session, frame_number, lateness):
+    """Journal a stored frame and let the live encoder and status listeners know"""
+    session_id = session["id"]
+    frame_writer = session["frame_writer"]
+    session_journal.record(session_id, frame_number, time.time(), sync=frame_writer.syncs_each_frame)
+    frame_writer.commit()
+    session["total_frames"] = frame_number + 1
+    encoder = session["live_encoder"]
+    if encoder is not None:
+        encoder.submit(frame_store.frame_path(session_id, frame_number))
+    print(f"[Timelapse] {session_id}: frame {frame_number} captured "
+          f"({lateness * 1000:.0f} ms late). Total frames: {frame_number + 1}")
+    publish_status('frame', session_id=session_id, device=session["device"], frame=frame_number,
+                   lateness_ms=round(lateness * 1000, 1))
+
+def update_metering(session, frame_number, filename, data=None):
+    """Meter a captured frame and keep the result with the session for the status display"""
+    stats = meter_frame(filename, data)
+    if stats:
+        session["metering"] = dict(stats, session_id=session["id"], frame=frame_number,
+                                   device=session["device"])
+    return stats
+
+def ir_controller(video_device):
+    """The IR hysteresis controller of a device"""
+    controller = ir_controllers.get(video_device)
+    if controller is None:
+        controller = ir_controllers.setdefault(
+            video_device, IRController(lambda enable: set_ir_mode(video_device, enable)))
+    return controller
 
 def set_ir_mode(video_device, enable):
     """Enable or disable IR mode on compatible cameras
@@ -323,129 +548,429 @@ def set_ir_mode(video_device, enable):
     - led_mode (for IR LED)
     - infrared_mode
     - ir_led
+    
+    The control is looked up in the device's cached control map.
+    
+    Returns:
+        bool: True if an IR control was set
     """
-    try:
-        # Common IR control names
-        ir_controls = ['led_mode', 'infrared_mode', 'ir_led', 'led1_mode']
-        
-        # Get available controls
-        result = subprocess.run(['v4l2-ctl', '--device', video_device, '--list-ctrls'],
-                              capture_output=True, text=True, timeout=2)
-        
-        for control in ir_controls:
-            if control in result.stdout.lower():
-                # Try to set it (value depends on camera model)
-                # Usually: 0=off, 1=on for IR
-                value = 1 if enable else 0
-                subprocess.run(
-                    ['v4l2-ctl', '--device', video_device, f'--set-ctrl={control}={value}'],
-                    capture_output=True, timeout=2
-                )
-                print(f"IR mode {'enabled' if enable else 'disabled'} via {control}")
-                break
-    except Exception as e:
-        print(f"Could not set IR mode: {e}")
+    controls = control_registry.get(video_device)
+    if controls is None:
+        return False
+    
+    control = next((c for c in IR_CONTROL_NAMES if controls.has(c)), None)
+    if control is None:
+        return False
+    
+    # Value depends on camera model, usually: 0=off, 1=on for IR
+    applied, errors, _ = controls.set({control: 1 if enable else 0})
+    if errors:
+        print(f"Could not set IR mode: {errors[control]}")
+        return False
+    print(f"IR mode {'enabled' if enable else 'disabled'} via {control}")
+    return True
 
-def timelapse_worker(session_id, interval, resolution, scheduled_start=None, scheduled_end=None, 
-                     auto_adjust=False, ir_mode='auto'):
-    """Background worker for capturing timelapse frames
+def new_session_state(session_id, settings, first_frame=0):
+    """State of a running session: what its worker, the status and stop work with
     
     Args:
-        session_id: Unique session identifier
-        interval: Seconds between captures
-        resolution: Tuple of (width, height)
-        scheduled_start: ISO format datetime to start capturing
-        scheduled_end: ISO format datetime to stop capturing
-        auto_adjust: If True, let camera auto-adjust settings between frames
-        ir_mode: 'on', 'off', or 'auto' (auto-detect based on brightness)
+        session_id: Session identifier
+        settings: Session settings as stored in the journal
+        first_frame: Number of the next frame to capture
+    """
+    return {
+        "id": session_id,
+        "device": settings["device"],
+        "settings": settings,
+        "active": True,
+        "interval": settings["interval"],  # seconds
+        "resolution": tuple(settings["resolution"]),
+        "auto_adjust": settings["auto_adjust"],
+        "ir_mode": settings["ir_mode"],
+        "total_frames": first_frame,
+        "start_time": settings["start_time"],  # None until a scheduled start
+        "scheduled_start": settings["scheduled_start"],  # ISO datetime string
+        "scheduled_end": settings["scheduled_end"],      # ISO datetime string
+        "thread": None,
+        "stop_event": threading.Event(),
+        "waiting_for_start": False,
+        "frame_writer": session_frame_writer(settings),
+        "schedule": None,         # DeadlineScheduler stats (lateness, skipped slots)
+        "live_encoder": None,     # LiveEncoder when the session encodes as it captures
+        "backend": None,          # Capture backend the session holds open
+        "change_detector": None,
+        "burst": None,            # BurstMerger when the session merges bursts
+        "pipeline": FramePipeline(settings["postprocess"], settings.get("postprocess_quality", 90))
+                    if settings.get("postprocess") else None,  # capture-time post-processing
+        "processor": None,        # CaptureProcessor running the pipeline in the process pool
+        "boosted": False,         # Capturing at the boost interval after motion
+        "suspending": False,      # Worker stopping for a restart; the session resumes after it
+        "metering": None          # Luminance stats of the last captured frame
+    }
+
+def timelapse_worker(session, first_frame=0, resumed=False):
+    """Background worker capturing one session's frames from its camera
+    
+    Args:
+        session: State dict of the session (see new_session_state). Its
+                 settings: interval, resolution, scheduled_start/end (ISO
+                 datetimes), auto_adjust, ir_mode ('on', 'off' or 'auto'),
+                 overrun_policy (see scheduler.OVERRUN_POLICIES), live_fps and
+                 live_profile (encode the video while capturing), change
+                 (change detection settings, or None), burst (burst/HDR
+                 settings, or None)
+        first_frame: Number of the next frame (non-zero when resuming)
+        resumed: The session was interrupted by a restart and is being resumed
     """
-    frame_number = 0
+    session_id = session["id"]
+    settings = session["settings"]
+    live_fps = settings["live_fps"]
+    live_profile = settings["live_profile"]
+    change = settings.get("change")
+    burst_settings = settings.get("burst")
+    stop_event = session["stop_event"]
+    backend = None
+    encoder = None
+    merger = None
+    processor = None
+    
+    # Wait for scheduled start if specified (a resumed session may be past it)
+    start_dt = parse_schedule_time(settings["scheduled_start"])
+    if start_dt and not session["start_time"]:
+        session["waiting_for_start"] = True
+        started = wait_until(start_dt, stop_event)
+        session["waiting_for_start"] = False
+        if not started:
+            return
+        session["start_time"] = datetime.now().isoformat()
+        publish_status('session', session_id=session_id, state='recording')
+    
+    # Keep the camera open for the whole session instead of per frame
+    if session["device"] != LIBCAMERA_DEVICE and detect_camera() == 'usb':
+        try:
+            with capture_sessions.device_lock(session["device"]):
+                close_preview_camera(session["device"])  # the session takes the device over
+                backend = open_capture_backend(session["device"], session["resolution"],
+                                               load_config().get('capture_backend', 'auto'), session["auto_adjust"])
+            session["backend"] = backend
+        except CaptureError as e:
+            print(f"[Timelapse] ERROR: Could not open camera {session['device']}: {e}")
+    
+    # A resumed session's live video was cut off by the restart; it is
+    # compiled from all the frames when the session ends instead
+    if live_fps and not resumed:
+        live_profile, encoder_args = encoder_profile(live_profile)
+        encoder = LiveEncoder(VIDEOS_DIR / f"{session_id}.mp4", live_fps, encoder_args=encoder_args)
+        if encoder.start():
+            session["live_encoder"] = encoder
+        else:
+            print(f"[Timelapse] WARNING: Live encoding unavailable ({encoder.error}), compile when done")
+            encoder = None
+    
+    detector = None
+    if change and (change["mode"] != 'off' or change["boost_interval"]):
+        detector = ChangeDetector(change["mode"], change["threshold"], change["thin_every"])
+    session["change_detector"] = detector
+    
+    if burst_settings and burst_settings["mode"] != 'off':
+        merger = open_burst_merger(session, burst_settings, backend)
+    session["burst"] = merger
+    
+    if session["pipeline"] is not None:
+        processor = CaptureProcessor(session["pipeline"],
+                                     lambda frame_number, frame, context:
+                                         frame_processed(session, frame_number, frame, context),
+                                     workers=load_config().get('process_workers'), name=session_id)
+    session["processor"] = processor
     
-    # Wait for scheduled start if specified
-    if scheduled_start:
-        timelapse_state["waiting_for_start"] = True
-        start_dt = datetime.fromisoformat(scheduled_start.replace('Z', '+00:00'))
+    try:
+        _capture_loop(session, backend, encoder, first_frame, detector, merger)
+    finally:
+        if merger is not None:
+            # Store the bursts still being merged before the session ends
+            merger.drain(timeout=60)
+            dropped = merger.close()
+            if dropped:
+                print(f"[Timelapse] WARNING: {session_id}: {dropped} bursts not merged in time, dropped")
+        if processor is not None:
+            # Merged bursts go on to the processor, so it is drained after the merger
+            processor.drain(timeout=60)
+            dropped = processor.close()
+            if dropped:
+                print(f"[Timelapse] WARNING: {session_id}: {dropped} frames not processed in time, dropped")
+        session["frame_writer"].sync()
+        session["boosted"] = False
+        if backend is not None:
+            with capture_sessions.device_lock(session["device"]):
+                session["backend"] = None
+                backend.close()
+        if encoder is not None:
+            finish_live_encode(session_id, encoder, live_fps, live_profile)
+        elif live_fps and resumed and not session["suspending"]:
+            submit_compile(session_id, live_fps, encoder=live_profile)
+
+def open_burst_merger(session, burst_settings, backend):
+    """The BurstMerger of a session, or None if its camera can't take bursts
+    
+    Bursts need the camera held open (a USB camera with a capture backend),
+    and NumPy and Pillow to merge them. Without an exposure_time_absolute
+    control an hdr session stacks a plain burst instead.
+    """
+    session_id = session["id"]
+    if backend is None:
+        print(f"[Timelapse] WARNING: {session_id}: burst capture needs an open USB camera, capturing single frames")
+        return None
+    if not burst.available():
+        print(f"[Timelapse] WARNING: {session_id}: burst capture needs NumPy and Pillow, capturing single frames")
+        return None
+    mode = burst_settings["mode"]
+    controls = control_registry.get(session["device"])
+    if mode == 'hdr' and (controls is None or not controls.has('exposure_time_absolute')):
+        print(f"[Timelapse] WARNING: {session_id}: {session['device']} has no exposure control, "
+              f"averaging bursts instead of HDR")
+        mode = 'average'
+    merger = BurstMerger(mode, burst_settings["frames"], burst_settings["exposures"],
+                         workers=load_config().get('process_workers'),
+                         on_merged=lambda frame_number, frame, context:
+                             burst_merged(session, frame_number, frame, context),
+                         name=session_id)
+    print(f"[Timelapse] {session_id}: {mode} bursts"
+          + (f" of {merger.frames} frames" if mode == 'average' else "") + f", merged by {merger.workers} process(es)")
+    return merger
+
+def finish_live_encode(session_id, encoder, fps, profile=None):
+    """Close the live-encoded video, or compile the session if it is missing frames"""
+    if encoder.finish():
+        session_index.record_video(session_id)
+        event_bus.publish('sessions', {"session_id": session_id})
+        if storage.delete_frames_after_compile:
+            submit_retention()
+    else:
+        print(f"[Timelapse] Live video incomplete ({encoder.stats()}), compiling from frames")
+        submit_compile(session_id, fps, encoder=profile)
+
+def _capture_loop(session, backend, encoder=None, first_frame=0, detector=None, merger=None):
+    """Capture a session's frames on a fixed grid until stopped or the scheduled end is reached
+    
+    With a detector, unchanged frames may not be stored, and motion
+    switches the grid to the boost interval until the boost time passes
+    without it. With a merger each slot grabs a burst, which is stored once
+    merged in the pool; the loop moves on to the next slot meanwhile, and
+    likewise with capture-time processing. Only the session's own device
+    lock is held while capturing, so sessions on other cameras capture at
+    the same time.
+    """
+    session_id = session["id"]
+    settings = session["settings"]
+    interval = settings["interval"]
+    change = settings.get("change") or {}
+    boost_interval = change.get("boost_interval")
+    boost_seconds = change.get("boost_seconds")
+    end_dt = parse_schedule_time(settings["scheduled_end"])
+    stop_event = session["stop_event"]
+    device_lock = capture_sessions.device_lock(session["device"])
+    processor = session["processor"]
+    scheduler = DeadlineScheduler(interval, settings["overrun_policy"])
+    session["schedule"] = scheduler.stats()
+    session["boosted"] = False
+    frame_number = first_frame
+    boost_until = None
+    
+    while session["active"]:
+        # Don't sleep past the scheduled end time
+        time_left = seconds_until(end_dt) if end_dt else None
+        if time_left is not None and time_left <= 0:
+            print(f"[Timelapse] {session_id}: reached scheduled end time, stopping timelapse")
+            session["active"] = False
+            break
         
-        while datetime.now(start_dt.tzinfo or None) < start_dt:
-            if not timelapse_state["active"]:
-                timelapse_state["waiting_for_start"] = False
-                return
-            time.sleep(1)
+        if not scheduler.wait(stop_event, max_wait=time_left):
+            continue
         
-        timelapse_state["waiting_for_start"] = False
-        timelapse_state["start_time"] = datetime.now().isoformat()
-    
-    while timelapse_state["active"]:
-        # Check if we've reached scheduled end time
-        if scheduled_end:
-            end_dt = datetime.fromisoformat(scheduled_end.replace('Z', '+00:00'))
-            if datetime.now(end_dt.tzinfo or None) >= end_dt:
-                print(f"[Timelapse] Reached scheduled end time, stopping timelapse")
-                timelapse_state["active"] = False
-                break
+        # Paused, or thinned out, while the card is (nearly) full
+        if not storage.admit(session_id):
+            scheduler.advance()
+            session["schedule"] = scheduler.stats()
+            continue
         
         try:
-            print(f"[Timelapse] Attempting to capture frame {frame_number}")
-            with camera_lock:
-                success = capture_image(session_id, frame_number, resolution, auto_adjust, ir_mode)
+            with device_lock:
+                if merger is not None:
+                    success = capture_burst(session, frame_number, backend, detector, merger, scheduler.lateness)
+                else:
+                    success = capture_image(session, frame_number, backend, detector, scheduler.lateness)
+            
+            if processor is not None:
+                # Outside the device lock: hold off while processing is behind
+                processor.throttle()
             
             if success:
+                # A burst or processed frame is journaled once it has been stored
+                if merger is None and processor is None:
+                    frame_captured(session, frame_number, scheduler.lateness)
                 frame_number += 1
-                timelapse_state["total_frames"] = frame_number
-                print(f"[Timelapse] Frame {frame_number - 1} captured. Total frames: {frame_number}")
+                session["schedule"] = scheduler.stats()
+            elif success is None:
+                print(f"[Timelapse] {session_id}: frame unchanged ({detector.last_change:.1f}), not stored")
             else:
-                print(f"[Timelapse] WARNING: Frame {frame_number} capture returned False")
+                print(f"[Timelapse] WARNING: {session_id}: frame {frame_number} capture returned False")
             
-            # Wait for the interval
-            time.sleep(interval)
+            if boost_interval and success is not False:
+                if detector.motion:
+                    if boost_until is None:
+                        print(f"[Timelapse] {session_id}: motion detected, capturing every {boost_interval:g}s")
+                        scheduler.set_interval(min(boost_interval, interval))
+                        session["boosted"] = True
+                        publish_status('status')
+                    boost_until = time.monotonic() + boost_seconds
+                elif boost_until is not None and time.monotonic() >= boost_until:
+                    print(f"[Timelapse] {session_id}: no motion for {boost_seconds:g}s, "
+                          f"back to every {interval:g}s")
+                    scheduler.set_interval(interval)
+                    boost_until = None
+                    session["boosted"] = False
+                    publish_status('status')
             
         except Exception as e:
-            print(f"[Timelapse] ERROR: Exception capturing frame {frame_number}: {e}")
+            print(f"[Timelapse] ERROR: Exception capturing frame {frame_number} of {session_id}: {e}")
             import traceback
             traceback.print_exc()
-            time.sleep(1)
+        
+        scheduler.advance()
+        session["schedule"] = scheduler.stats()
 
-def compile_video(session_id, fps=30, rotation=0):
-    """Compile images into a video using ffmpeg"""
-    session_dir = IMAGES_DIR / session_id
-    output_file = VIDEOS_DIR / f"{session_id}.mp4"
+def session_frame_count(session_id):
+    """Number of frames in a session, from the session index"""
+    info = session_index.get(session_id)
+    if info is None:
+        session_index.rebuild(session_id)
+        info = session_index.get(session_id)
+    return info["frame_count"] if info else 0
+
+ROTATIONS = (0, 90, 180, 270)
+
+def rotation_filter(rotation):
+    """ffmpeg -vf filter that bakes a clockwise rotation into the pixels"""
+    # 0 = no rotation, 90 = 90° clockwise, 180 = 180°, 270 = 90° counter-clockwise
+    return {
+        90: 'transpose=1',
+        180: 'transpose=1,transpose=1',
+        270: 'transpose=2',
+    }.get(rotation % 360)
+
+def session_rotation(session_id):
+    """Stored display rotation of a session and how much of it is baked into its video"""
+    info = session_index.get(session_id) or {}
+    return info.get("rotation", 0), info.get("video_baked_rotation", 0)
+
+def compile_video(session_id, fps=30, rotation=None, job=None, encoder=None, reencode=False,
+                  skip_unchanged=False, postprocess=None):
+    """Compile images into a video using ffmpeg
     
-    # Check if images exist
-    images = sorted(session_dir.glob("frame_*.jpg"))
-    if not images:
-        return None
+    Only frames added since the last compile or preview are encoded; the
+    rest are reused from cached segments (see video_builder.py). Rotation is
+    stored with the session and applied as display-matrix metadata, unless
+    reencode asks for it to be encoded into the pixels.
     
-    # Build ffmpeg command with rotation
-    cmd = [
-        'ffmpeg',
-        '-y',  # Overwrite output file
-        '-framerate', str(fps),
-        '-pattern_type', 'glob',
-        '-i', str(session_dir / 'frame_*.jpg'),
-    ]
+    Args:
+        rotation: Degrees clockwise (None: the session's stored rotation)
+        job: Job this runs as (for progress and cancellation), if any
+        encoder: Encoder profile name (None: configured one, see encoders.py)
+        reencode: Encode the rotation into the video instead of tagging it
+        skip_unchanged: Leave out frames change detection marked unchanged
+        postprocess: Pipeline stages to run the frames through first (see
+                     frame_pipeline.py); frames processed by an earlier
+                     compile with the same stages are reused
     
-    # Add rotation filter if specified
-    # 0 = no rotation, 90 = 90° clockwise, 180 = 180°, 270 = 90° counter-clockwise
-    if rotation == 90:
-        cmd.extend(['-vf', 'transpose=1'])  # 90° clockwise
-    elif rotation == 180:
-        cmd.extend(['-vf', 'transpose=1,transpose=1'])  # 180°
-    elif rotation == 270:
-        cmd.extend(['-vf', 'transpose=2'])  # 90° counter-clockwise
-    
-    cmd.extend([
-        '-c:v', 'libx264',
-        '-pix_fmt', 'yuv420p',
-        '-crf', '23',
-        str(output_file)
-    ])
+    Returns:
+        Path of the compiled video
+    
+    Raises:
+        RuntimeError: No frames, or ffmpeg failed
+        EncoderError: Unknown or unavailable encoder profile
+        JobCancelled: The job was cancelled
+    """
+    output_file = VIDEOS_DIR / f"{session_id}.mp4"
     
+    # Check if images exist
+    frame_files = frame_store.frame_files(session_id, skip_unchanged=skip_unchanged)
+    total = len(frame_files)
+    if not total:
+        raise RuntimeError("No frames in session")
+    if storage.check() == 'full':
+        raise RuntimeError("Not enough free space to compile; free some space or delete sessions")
+    
+    if rotation is None:
+        rotation, _ = session_rotation(session_id)
+    video_filter = rotation_filter(rotation) if reencode else None
+    
+    encoder, encoder_args = encoder_profile(encoder, needs_filters=video_filter is not None)
+    
+    selection = 'changed' if skip_unchanged else None
+    changed_from = None
+    # With post-processing, processing is the first half of the progress
+    progress_share = 100
+    if postprocess:
+        pipeline = FramePipeline(postprocess, load_config().get('postprocess_quality', frame_pipeline.DEFAULT_QUALITY))
+        frame_files, process_stats = process_session(frame_store, session_id, pipeline, PROCESSED_DIR, skip_unchanged,
+                                         on_progress=(lambda percent: job.report(percent / 2)) if job else None,
+                                         cancel_event=job.cancel_event if job else None,
+                                         workers=load_config().get('process_workers'))
+        if frame_files is None:
+            raise JobCancelled()
+        selection = f"{selection or 'all'}-{pipeline.key}"
+        # Frames re-rendered since the last compile (their deflicker window
+        # changed) keep their paths; their segments must be encoded again
+        changed_from = process_stats["changed_from"]
+        progress_share = 50
+    
+    def on_progress(frames_done):
+        if job:
+            job.report(100 - progress_share + frames_done / total * progress_share)
+    
+    success, error_msg, _ = build_video(session_id, frame_files, VIDEOS_DIR, output_file, fps, video_filter,
+                                        load_config().get('segment_frames', DEFAULT_SEGMENT_FRAMES),
+                                        on_progress, job.cancel_event if job else None, low_priority=True,
+                                        encoder_args=encoder_args, rotation=0 if reencode else rotation,
+                                        selection=selection, changed_from=changed_from)
+    if not success:
+        if job and job.cancelled:
+            raise JobCancelled()
+        print(f"Error compiling video: {error_msg}")
+        raise RuntimeError(f"ffmpeg failed: {error_msg[-200:]}")
+    
+    session_index.set_rotation(session_id, rotation, baked=rotation if reencode else 0)
+    session_index.record_video(session_id)
+    event_bus.publish('sessions', {"session_id": session_id})
+    if storage.delete_frames_after_compile:
+        submit_retention()
+    return output_file
+
+def submit_compile(session_id, fps=30, rotation=None, encoder=None, reencode=False, skip_unchanged=False,
+                   postprocess=None):
+    """Queue a compile job (or return the identical one already queued)"""
+    def run(job):
+        video = compile_video(session_id, fps, rotation, job, encoder, reencode, skip_unchanged, postprocess)
+        return {"video": video.name, "encoder": encoder}
+    return job_queue.submit('compile', run, session_id,
+                            {"fps": fps, "rotation": rotation, "encoder": encoder, "reencode": reencode,
+                             "skip_unchanged": skip_unchanged, "postprocess": postprocess})
+
+def postprocess_error(stages):
+    """Why a list of pipeline stages can't be used here, or None"""
+    if not frame_pipeline.available():
+        return "post-processing needs Pillow"
     try:
-        subprocess.run(cmd, check=True, capture_output=True)
-        return output_file
-    except subprocess.CalledProcessError as e:
-        print(f"Error compiling video: {e}")
-        return None
+        FramePipeline(stages)
+    except ValueError as e:
+        return str(e)
+    return None
+
+def requested_postprocess(value):
+    """Pipeline stages a request asks for: true means the configured "postprocess" stages"""
+    if value is True:
+        return load_config().get('postprocess') or None
+    return value or None
 
 @app.route('/')
 def index():
@@ -464,27 +989,7 @@ def camera_info():
     }
     
     if camera_type == 'usb':
-        # Get USB camera details
-        video_devices = list(Path('/dev').glob('video*'))
-        devices = []
-        
-        for device in video_devices:
-            try:
-                result = subprocess.run(['v4l2-ctl', '--device', str(device), '--all'], 
-                                      capture_output=True, timeout=2, text=True)
-                if 'Video Capture' in result.stdout:
-                    # Extract device name
-                    for line in result.stdout.split('\n'):
-                        if 'Card type' in line:
-                            card_name = line.split(':')[1].strip()
-                            devices.append({
-                                "device": str(device),
-                                "name": card_name
-                            })
-                            break
-            except:
-                pass
-        
+        devices = detect_usb_camera_devices()
         info['details'] = {
             "devices": devices,
             "count": len(devices)
@@ -495,28 +1000,184 @@ def camera_info():
 @app.route('/api/status')
 def get_status():
     """Get current timelapse status"""
-    return jsonify({
-        "active": timelapse_state["active"],
-        "session_id": timelapse_state["current_session"],
-        "interval": timelapse_state["interval"],
-        "total_frames": timelapse_state["total_frames"],
-        "start_time": timelapse_state["start_time"],
-        "scheduled_start": timelapse_state.get("scheduled_start"),
-        "scheduled_end": timelapse_state.get("scheduled_end"),
-        "waiting_for_start": timelapse_state.get("waiting_for_start", False),
-        "auto_adjust": timelapse_state.get("auto_adjust", False),
-        "ir_mode": timelapse_state.get("ir_mode", 'auto'),
-        "camera_available": detect_camera() is not None,
-        "camera_type": detect_camera()
-    })
+    return jsonify(build_status())
+
+def build_status():
+    """Current timelapse status as a dict (cheap: no hardware access)"""
+    status = capture_status()
+    status.update(local_status())
+    return status
+
+def local_status():
+    """The part of the status this process knows itself (preview viewers, cameras)"""
+    camera = camera_service.snapshot()
+    return {
+        "preview": preview_stream.stats(),
+        "camera_available": camera['camera_available'],
+        "camera_type": camera['camera_type']
+    }
+
+def idle_status():
+    """Top-level capture status while the selected camera isn't recording"""
+    return {"active": False, "session_id": None, "device": None, "interval": None, "total_frames": 0,
+            "start_time": None, "waiting_for_start": False}
+
+def capture_status():
+    """The capture part of the status, from whichever process runs capture
+    
+    "sessions" lists every running session. The top-level fields describe
+    the one on the selected camera (camera_device), as they did when only
+    one camera could record, and are idle while that camera isn't.
+    """
+    if capture_client is not None:
+        status = capture_client.status()
+        if status is None:
+            return dict(idle_status(), sessions=[], capture_daemon=False)
+        status["capture_daemon"] = True
+        return status
+    sessions = [session_status(session) for session in capture_sessions.running()]
+    device = configured_device()
+    status = next((s for s in sessions if s["device"] == device), None) or idle_status()
+    return dict(status, sessions=sessions, storage=storage.status(), open_devices=open_camera_devices())
+
+def open_camera_devices():
+    """Cameras this process holds open (sessions, preview), as device list entries"""
+    known = {d['device']: d for d in camera_service.devices()}
+    return [known.get(device, {'device': device, 'name': device.split('/')[-1]})
+            for device in sorted(capture_backends.open_devices)]
+
+def daemon_open_devices():
+    """Cameras the capture daemon holds open, which this process must not probe"""
+    status = capture_client.status()
+    return status.get("open_devices", []) if status else []
+
+if capture_client is not None:
+    camera_service.set_open_elsewhere(daemon_open_devices)
+
+def session_status(session):
+    """Status of one running session"""
+    live_encoder = session["live_encoder"]
+    change_detector = session["change_detector"]
+    merger = session["burst"]
+    return {
+        "active": session["active"],
+        "session_id": session["id"],
+        "device": session["device"],
+        "interval": session["interval"],
+        "resolution": list(session["resolution"]),
+        "total_frames": session["total_frames"],
+        "start_time": session["start_time"],
+        "scheduled_start": session["scheduled_start"],
+        "scheduled_end": session["scheduled_end"],
+        "waiting_for_start": session["waiting_for_start"],
+        "auto_adjust": session["auto_adjust"],
+        "ir_mode": session["ir_mode"],
+        "schedule": session["schedule"],
+        "live_encode": live_encoder.stats() if live_encoder else None,
+        "metering": metering_summary(session),
+        "durability": session["frame_writer"].stats(),
+        "change_detection": change_detector.stats() if change_detector else None,
+        "burst": merger.stats() if merger else None,
+        "postprocess": session["processor"].stats() if session["processor"] else None,
+        "boosted": session["boosted"]
+    }
+
+def running_session_status(status, session_id):
+    """A running session's entry in a capture status, or None"""
+    return next((s for s in status.get("sessions", []) if s["session_id"] == session_id), None)
+
+def devices_in_use():
+    """Camera devices running sessions capture from, with their session IDs"""
+    return {s["device"]: s["session_id"] for s in capture_status().get("sessions", [])}
+
+def live_encoding(status):
+    """Whether the session in a capture status is being encoded as it is captured"""
+    live_encode = status.get("live_encode")
+    return bool(live_encode) and live_encode.get("state") == 'running'
+
+def metering_summary(session):
+    """A session's last frame brightness and IR state for the status display (no histogram)"""
+    stats = session["metering"]
+    if not stats:
+        return None
+    summary = {k: stats[k] for k in ("session_id", "frame", "mean", "center_mean", "p5", "p50", "p95")}
+    controller = ir_controllers.get(stats["device"])
+    summary["ir_on"] = controller.state if controller else None
+    return summary
+
+def publish_device_change(snapshot):
+    """Camera state service listener: push hotplug changes to browsers"""
+    publish_status('devices', devices=snapshot['devices'])
+
+camera_service.add_listener(publish_device_change)
+
+def publish_status(event_type, **data):
+    """Push an event carrying the fresh status to connected browsers"""
+    data["status"] = build_status()
+    event_bus.publish(event_type, data)
+
+def relay_daemon_events():
+    """Republish the capture daemon's events to this process's browsers
+    
+    Runs for the life of the process, reconnecting whenever the daemon
+    restarts. The daemon's device changes aren't passed on as they are:
+    they start a rescan here, which keeps the cameras it holds open and
+    publishes the result if it differs.
+    """
+    connected = None
+    while True:
+        try:
+            for event_type, data in capture_client.events():
+                if not connected:
+                    connected = True
+                    print("[Daemon] Connected to the capture daemon")
+                    publish_status('status')
+                if event_type == 'devices':
+                    camera_service.refresh(wait=False)
+                    continue
+                if "status" in data:
+                    data["status"].update(local_status(), capture_daemon=True)
+                if event_type == 'frame' and preview_stream.client_count \
+                        and data.get("device") == configured_device():
+                    # The daemon's captured frames reach the preview through the images folder
+                    try:
+                        preview_stream.offer(frame_store.frame_path(data["session_id"], data["frame"])
+                                             .read_bytes())
+                    except OSError:
+                        pass
+                event_bus.publish(event_type, data)
+        except CaptureUnavailable:
+            pass
+        if connected is not False:
+            connected = False
+            print(f"[Daemon] Capture daemon not reachable at {CAPTURE_SOCKET}, retrying")
+            publish_status('status')
+        time.sleep(2)
+
+@app.route('/api/events')
+def event_stream():
+    """Server-Sent Events stream of status, frame, compile and device changes"""
+    sub = event_bus.subscribe()
+    stream = event_bus.stream(sub, initial=[('status', {"status": build_status()})])
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/start', methods=['POST'])
 def start_timelapse():
-    """Start a new timelapse"""
-    if timelapse_state["active"]:
-        return jsonify({"error": "Timelapse already active"}), 400
+    """Start a new timelapse
+    
+    It captures from "device" (default: the selected camera). Sessions on
+    different cameras run side by side; a camera runs one session at a time.
+    """
+    if capture_client is not None:
+        return forward_to_daemon('start', params=request.json or {})
+    if not claim_capture():
+        return capture_elsewhere_response()
     
     data = request.json or {}
+    device = data.get('device') or configured_device()
+    if data.get('device') and device not in available_devices():
+        return jsonify({"error": f"Device {device} not found or not working"}), 400
     interval = data.get('interval', 5)
     resolution_list = data.get('resolution', [1920, 1080])
     resolution = tuple(resolution_list) if isinstance(resolution_list, list) else resolution_list
@@ -524,71 +1185,302 @@ def start_timelapse():
     scheduled_end = data.get('scheduled_end')      # ISO datetime string
     auto_adjust = data.get('auto_adjust', False)   # Enable auto-adjustment
     ir_mode = data.get('ir_mode', 'auto')          # 'on', 'off', or 'auto'
+    config = load_config()
+    overrun_policy = data.get('overrun_policy', config.get('overrun_policy', 'skip'))
+    live_encode = data.get('live_encode', config.get('live_encode', False))
+    live_fps = data.get('live_fps', config.get('live_fps', 30))
+    live_profile = None
+    change_mode = data.get('change_mode', config.get('change_mode', 'off'))
+    change = {
+        "mode": change_mode,
+        "threshold": data.get('change_threshold', config.get('change_threshold', DEFAULT_THRESHOLD)),
+        "thin_every": data.get('change_thin_every', config.get('change_thin_every', DEFAULT_THIN_EVERY)),
+        "boost_interval": data.get('change_boost_interval', config.get('change_boost_interval')),
+        "boost_seconds": data.get('change_boost_seconds', config.get('change_boost_seconds', 60)),
+    }
+    burst_mode = data.get('burst_mode', config.get('burst_mode', 'off'))
+    burst_settings = {
+        "mode": burst_mode,
+        "frames": data.get('burst_frames', config.get('burst_frames', DEFAULT_BURST_FRAMES)),
+        "exposures": data.get('burst_exposures', config.get('burst_exposures')),
+    }
+    postprocess = data.get('capture_postprocess', config.get('capture_postprocess')) or None
+    
+    if overrun_policy not in OVERRUN_POLICIES:
+        return jsonify({"error": f"Invalid overrun_policy. Use one of: {', '.join(OVERRUN_POLICIES)}"}), 400
+    if change_mode not in CHANGE_MODES:
+        return jsonify({"error": f"Invalid change_mode. Use one of: {', '.join(CHANGE_MODES)}"}), 400
+    if burst_mode not in BURST_MODES:
+        return jsonify({"error": f"Invalid burst_mode. Use one of: {', '.join(BURST_MODES)}"}), 400
+    
+    try:
+        interval = float(interval)
+        if interval <= 0:
+            raise ValueError
+        parse_schedule_time(scheduled_start)
+        parse_schedule_time(scheduled_end)
+        live_fps = int(live_fps)
+        if live_fps <= 0:
+            raise ValueError
+        change["threshold"] = float(change["threshold"])
+        change["thin_every"] = int(change["thin_every"])
+        change["boost_seconds"] = float(change["boost_seconds"])
+        if change["boost_interval"] is not None:
+            change["boost_interval"] = float(change["boost_interval"])
+            if change["boost_interval"] <= 0:
+                raise ValueError
+        burst_settings["frames"] = int(burst_settings["frames"])
+        if not 1 <= burst_settings["frames"] <= MAX_BURST_FRAMES:
+            raise ValueError
+        if burst_settings["exposures"] is not None:
+            burst_settings["exposures"] = [int(value) for value in burst_settings["exposures"]]
+            if not burst_settings["exposures"] or min(burst_settings["exposures"]) <= 0:
+                raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid interval, schedule time, live_fps, change detection or burst setting"}), 400
+    if postprocess:
+        error = postprocess_error(postprocess)
+        if error:
+            return jsonify({"error": f"Invalid capture_postprocess: {error}"}), 400
+    
+    if live_encode:
+        try:
+            live_profile, _ = encoder_profile(data.get('encoder'))
+        except EncoderError as e:
+            return jsonify({"error": str(e)}), 400
     
     print(f"[Start] Starting timelapse:")
+    print(f"  - Device: {device}")
     print(f"  - Interval: {interval}s")
     print(f"  - Resolution: {resolution} (type: {type(resolution)})")
     print(f"  - Auto-adjust: {auto_adjust}")
     print(f"  - IR Mode: {ir_mode}")
-    
-    # Create new session
-    session_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-    print(f"  - Session ID: {session_id}")
-    
-    # Update state
-    timelapse_state["active"] = True
-    timelapse_state["current_session"] = session_id
-    timelapse_state["interval"] = interval
-    timelapse_state["total_frames"] = 0
-    timelapse_state["scheduled_start"] = scheduled_start
-    timelapse_state["scheduled_end"] = scheduled_end
-    timelapse_state["auto_adjust"] = auto_adjust
-    timelapse_state["ir_mode"] = ir_mode
-    
-    if not scheduled_start:
-        timelapse_state["start_time"] = datetime.now().isoformat()
-    else:
-        timelapse_state["start_time"] = None  # Will be set when actually starts
-    
-    # Start worker thread
-    thread = threading.Thread(
-        target=timelapse_worker,
-        args=(session_id, interval, resolution, scheduled_start, scheduled_end, auto_adjust, ir_mode),
-        daemon=True
-    )
-    thread.start()
-    timelapse_state["thread"] = thread
-    
-    print(f"[Start] Timelapse worker thread started")
+    print(f"  - Overrun policy: {overrun_policy}")
+    print(f"  - Live encode: {f'{live_fps} fps ({live_profile})' if live_encode else 'off'}")
+    print(f"  - Change detection: {change_mode}"
+          + (f", boost to {change['boost_interval']:g}s on motion" if change["boost_interval"] else ""))
+    print(f"  - Burst: {burst_mode}")
+    print(f"  - Post-processing: {', '.join(stage['stage'] for stage in postprocess) if postprocess else 'off'}")
+    
+    writer = make_frame_writer()
+    print(f"  - Durability: {writer.policy}")
+    
+    settings = {
+        "device": device,
+        "interval": interval,
+        "resolution": list(resolution),
+        "scheduled_start": scheduled_start,
+        "scheduled_end": scheduled_end,
+        "auto_adjust": auto_adjust,
+        "ir_mode": ir_mode,
+        "overrun_policy": overrun_policy,
+        "live_fps": live_fps if live_encode else None,
+        "live_profile": live_profile,
+        "start_time": None if scheduled_start else datetime.now().isoformat(),
+        "durability": {"policy": writer.policy, "every_frames": writer.every_frames,
+                       "every_seconds": writer.every_seconds},
+        "change": change,
+        "burst": burst_settings,
+        "postprocess": postprocess,
+        "postprocess_quality": config.get('postprocess_quality', frame_pipeline.DEFAULT_QUALITY)
+    }
+    with session_start_lock:
+        busy = capture_sessions.by_device(device)
+        if busy is not None:
+            return jsonify({"error": str(DeviceBusy(device, busy["id"])), "session_id": busy["id"]}), 409
+        
+        # Create new session
+        session_id = new_session_id()
+        print(f"  - Session ID: {session_id}")
+        # On disk before the first frame, so a restart at any point resumes it
+        frame_store.create(session_id)
+        session_journal.begin(session_id, settings)
+        session_index.set_device(session_id, device)
+        launch_session(session_id, settings)
     
     return jsonify({
         "success": True,
         "session_id": session_id,
+        "device": device,
         "interval": interval,
         "scheduled_start": scheduled_start,
         "scheduled_end": scheduled_end
     })
 
+def new_session_id():
+    """ID of a new session: its start time, with a suffix if another session started in the same second"""
+    base = datetime.now().strftime("%Y%m%d_%H%M%S")
+    session_id, n = base, 1
+    while capture_sessions.get(session_id) or frame_store.session_dir(session_id).exists():
+        n += 1
+        session_id = f"{base}_{n}"
+    return session_id
+
+def launch_session(session_id, settings, first_frame=0, resumed=False):
+    """Register a session and start its worker thread
+    
+    Args:
+        session_id: Session identifier
+        settings: Session settings as stored in the journal
+        first_frame: Number of the next frame to capture
+        resumed: Picking up a session interrupted by a restart
+    
+    Raises:
+        DeviceBusy: Another session is capturing from the session's device
+    """
+    session = new_session_state(session_id, settings, first_frame)
+    capture_sessions.add(session)
+    storage.configure(load_config())
+    if len(capture_sessions) == 1:
+        storage.reset_rate()
+    
+    # Start worker thread
+    def run_worker():
+        try:
+            timelapse_worker(session, first_frame, resumed)
+        finally:
+            session["active"] = False
+            frame_store.close(session_id)
+            capture_sessions.remove(session_id, session)
+            if not len(capture_sessions):
+                storage.reset_rate()
+            if session["suspending"]:
+                session_journal.close(session_id)
+            else:
+                session_journal.finish(session_id)
+                publish_status('session', session_id=session_id, state='stopped')
+                event_bus.publish('sessions', {"session_id": session_id})
+    
+    thread = threading.Thread(target=run_worker, name=f"capture-{session_id}", daemon=True)
+    session["thread"] = thread
+    thread.start()
+    
+    print(f"[Start] Timelapse worker thread started for {session_id} on {session['device']}")
+    waiting = settings["scheduled_start"] and not settings["start_time"]
+    publish_status('session', session_id=session_id, state='waiting' if waiting else 'recording')
+
+def session_frame_writer(settings):
+    """Frame writer with the durability policy a session was started with"""
+    durability = settings.get("durability")
+    if not durability:
+        return make_frame_writer()
+    return FrameWriter(durability["policy"], durability["every_frames"], durability["every_seconds"])
+
+def resume_sessions():
+    """Pick up the sessions that were running when capture last stopped
+    
+    Returns:
+        list: IDs of the resumed sessions
+    """
+    resumed = []
+    for state in session_journal.active():
+        session_id = resume_session(state)
+        if session_id is not None:
+            resumed.append(session_id)
+    return resumed
+
+def resume_session(state):
+    """Pick up one session that was running when capture last stopped
+    
+    The frame number continues from the journal's last record, so a
+    restart never overwrites frames already captured.
+    
+    Args:
+        state: The session's entry from SessionJournal.active()
+    
+    Returns:
+        The resumed session ID, or None
+    """
+    session_id = state["session_id"]
+    settings = state["settings"]
+    # Sessions journaled before multi-camera support used the selected camera
+    settings["device"] = settings.get("device") or configured_device()
+    end_dt = parse_schedule_time(settings["scheduled_end"])
+    if end_dt and seconds_until(end_dt) <= 0:
+        print(f"[Resume] Session {session_id} reached its scheduled end while stopped")
+        session_journal.finish(session_id)
+        return None
+    if state["first_capture"] is not None:
+        # A scheduled session had started; keep its real start time
+        settings["start_time"] = settings["start_time"] or \
+            datetime.fromtimestamp(state["first_capture"]).isoformat()
+    # Frames since the last flush may have been renamed into place without
+    # their data; recapture from the first incomplete one
+    next_frame = state["next_frame"]
+    # As many frames as the session captures between flushes at its fastest,
+    # which is the motion boost interval if it has one
+    boost_interval = (settings.get("change") or {}).get("boost_interval")
+    fastest = min(settings["interval"], boost_interval or settings["interval"])
+    window = session_frame_writer(settings).unsynced_window(fastest)
+    frame_store.migrate(session_id)  # started before sharding
+    resume_at = intact_frames(lambda n: frame_store.frame_path(session_id, n), next_frame, window)
+    # The manifest's tail may be ahead of the journal or lost with the crash
+    frame_store.rewind(session_id, resume_at)
+    if resume_at != next_frame:
+        print(f"[Resume] Frames {resume_at}-{next_frame - 1} of {session_id} are incomplete, recapturing")
+        session_index.rebuild(session_id)
+    last = state["last_capture"]
+    print(f"[Resume] Resuming session {session_id} on {settings['device']} at frame {resume_at}"
+          + (f", {time.time() - last:.0f} s after its last capture" if last else ""))
+    try:
+        launch_session(session_id, settings, resume_at, resumed=True)
+    except DeviceBusy as e:
+        print(f"[Resume] Can't resume {session_id}: {e}")
+        session_journal.finish(session_id)
+        return None
+    return session_id
+
+def stop_sessions(sessions, timeout=10, suspend=False):
+    """Stop session workers and wait for them to finish
+    
+    Args:
+        sessions: State dicts of the sessions to stop
+        suspend: Stopping for a shutdown; the sessions resume at the next start
+    """
+    # Wake every worker out of its wait first, so they finish together
+    for session in sessions:
+        session["suspending"] = suspend
+        session["active"] = False
+        session["stop_event"].set()
+    for session in sessions:
+        if session["thread"]:
+            session["thread"].join(timeout=timeout)
+
+def suspend_sessions(timeout=10):
+    """Stop the workers for a shutdown, leaving the sessions to resume at the next start"""
+    sessions = capture_sessions.running()
+    for session in sessions:
+        print(f"[Timelapse] Suspending session {session['id']} until restart")
+    stop_sessions(sessions, timeout, suspend=True)
+
 @app.route('/api/stop', methods=['POST'])
 def stop_timelapse():
-    """Stop the current timelapse"""
-    if not timelapse_state["active"]:
-        return jsonify({"error": "No active timelapse"}), 400
-    
-    session_id = timelapse_state["current_session"]
-    total_frames = timelapse_state["total_frames"]
+    """Stop one running timelapse (session_id), or all of them"""
+    data = request.get_json(silent=True) or {}
+    if capture_client is not None:
+        return forward_to_daemon('stop', params=data)
     
-    # Stop the timelapse
-    timelapse_state["active"] = False
+    session_id = data.get('session_id')
+    if session_id:
+        session = capture_sessions.get(session_id)
+        if session is None:
+            return jsonify({"error": "Session is not capturing"}), 400
+        sessions = [session]
+    else:
+        sessions = capture_sessions.running()
+        if not sessions:
+            return jsonify({"error": "No active timelapse"}), 400
     
-    # Wait for thread to finish
-    if timelapse_state["thread"]:
-        timelapse_state["thread"].join(timeout=10)
+    # Stop the timelapses (wakes the workers out of any wait immediately)
+    stop_sessions(sessions)
     
+    stopped = [{"session_id": s["id"], "device": s["device"], "total_frames": s["total_frames"]}
+               for s in sessions]
     return jsonify({
         "success": True,
-        "session_id": session_id,
-        "total_frames": total_frames
+        "session_id": stopped[0]["session_id"],
+        "total_frames": stopped[0]["total_frames"],
+        "stopped": stopped
     })
 
 @app.route('/api/compile', methods=['POST'])
@@ -597,162 +1489,329 @@ def compile_timelapse():
     data = request.json or {}
     session_id = data.get('session_id')
     fps = data.get('fps', 30)
-    rotation = data.get('rotation', 0)  # 0, 90, 180, 270
+    rotation = data.get('rotation')  # 0, 90, 180, 270 (default: the session's stored rotation)
+    reencode = bool(data.get('reencode', False))  # encode rotation into the pixels
+    skip_unchanged = bool(data.get('skip_unchanged', False))  # leave out frames marked unchanged
+    postprocess = requested_postprocess(data.get('postprocess'))  # stages, or true for the configured ones
     
     if not session_id:
         return jsonify({"error": "session_id required"}), 400
+    if rotation is not None and rotation not in ROTATIONS:
+        return jsonify({"error": "Invalid rotation. Use 0, 90, 180, or 270"}), 400
+    if postprocess:
+        error = postprocess_error(postprocess)
+        if error:
+            return jsonify({"error": f"Invalid postprocess: {error}"}), 400
     
     session_dir = IMAGES_DIR / session_id
     if not session_dir.exists():
         return jsonify({"error": "Session not found"}), 404
     
-    # Compile in background to avoid blocking
-    def compile_async():
-        compile_video(session_id, fps, rotation)
+    running = running_session_status(capture_status(), session_id)
+    if running and live_encoding(running):
+        return jsonify({"error": "Session is being encoded live; the video will be ready when it stops"}), 409
     
-    thread = threading.Thread(target=compile_async, daemon=True)
-    thread.start()
+    if rotation is None:
+        rotation, _ = session_rotation(session_id)
+    try:
+        encoder, _ = encoder_profile(data.get('encoder'), needs_filters=reencode and rotation != 0)
+    except EncoderError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Compile on the job queue to avoid blocking
+    job = submit_compile(session_id, fps, rotation, encoder, reencode, skip_unchanged, postprocess)
     
     return jsonify({
         "success": True,
-        "message": "Compilation started",
-        "session_id": session_id
+        "message": "Compilation queued" if job.state == 'queued' else "Compilation running",
+        "session_id": session_id,
+        "encoder": encoder,
+        "job_id": job.id
     })
 
-@app.route('/api/sessions')
-def list_sessions():
-    """List all timelapse sessions"""
-    sessions = []
+@app.route('/api/sessions/<session_id>/process', methods=['POST'])
+def process_frames(session_id):
+    """Run a session's frames through a post-processing pipeline, as a job
     
-    # Ensure directory exists
-    IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+    The processed frames are cached, so a compile with the same
+    "postprocess" stages afterwards only encodes them.
+    """
+    data = request.get_json(silent=True) or {}
+    postprocess = requested_postprocess(data.get('postprocess', True))
+    skip_unchanged = bool(data.get('skip_unchanged', False))
+    if not postprocess:
+        return jsonify({"error": "No postprocess stages given or configured"}), 400
+    error = postprocess_error(postprocess)
+    if error:
+        return jsonify({"error": f"Invalid postprocess: {error}"}), 400
+    if not frame_store.session_dir(session_id).is_dir():
+        return jsonify({"error": "Session not found"}), 404
     
+    def process_job(job):
+        config = load_config()
+        pipeline = FramePipeline(postprocess, config.get('postprocess_quality', frame_pipeline.DEFAULT_QUALITY))
+        paths, stats = process_session(frame_store, session_id, pipeline, PROCESSED_DIR, skip_unchanged,
+                                       on_progress=job.report, cancel_event=job.cancel_event,
+                                       workers=config.get('process_workers'))
+        if paths is None:
+            raise JobCancelled()
+        return dict(stats, key=pipeline.key)
+    
+    job = job_queue.submit('process', process_job, session_id,
+                           {"postprocess": postprocess, "skip_unchanged": skip_unchanged})
+    return jsonify({"success": True, "session_id": session_id, "job_id": job.id})
+
+@app.route('/api/encoders')
+def list_encoders():
+    """Encoder profiles, which ones this system can use and the automatic choice"""
+    return jsonify(describe_profiles(load_config().get('encoder_quality', DEFAULT_QUALITY)))
+
+@app.route('/api/jobs')
+def list_jobs():
+    """List queued, running and recently ended jobs (newest first)"""
+    session_id = request.args.get('session_id')
+    return jsonify({"jobs": [job.to_dict() for job in job_queue.list_jobs(session_id)]})
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """Get one job's state and progress"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued or running job"""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"success": True, "job": job.to_dict()})
+
+@app.route('/api/sessions')
+def list_sessions():
+    """List all timelapse sessions (from the session index)"""
     try:
-        for session_dir in sorted(IMAGES_DIR.iterdir(), reverse=True):
-            # Skip if not a directory, starts with dot, or is the preview folder
-            if not session_dir.is_dir() or session_dir.name.startswith('.') or session_dir.name == 'preview':
-                continue
-            
-            images = list(session_dir.glob("frame_*.jpg"))
-            video_file = VIDEOS_DIR / f"{session_dir.name}.mp4"
-            
-            # Skip if no images found (empty directory)
-            if len(images) == 0:
-                continue
-            
-            try:
-                created_time = datetime.strptime(session_dir.name, "%Y%m%d_%H%M%S").isoformat()
-            except:
-                # If directory name doesn't match expected format, use current time
-                created_time = datetime.now().isoformat()
-            
-            # Calculate video duration if video exists
-            duration_seconds = None
-            if video_file.exists():
-                try:
-                    # Use ffprobe to get video duration
-                    result = subprocess.run(
-                        ['ffprobe', '-v', 'error', '-show_entries', 
-                         'format=duration', '-of', 
-                         'default=noprint_wrappers=1:nokey=1', str(video_file)],
-                        capture_output=True,
-                        text=True,
-                        timeout=5
-                    )
-                    if result.returncode == 0 and result.stdout.strip():
-                        duration_seconds = float(result.stdout.strip())
-                except Exception as e:
-                    print(f"Error getting duration for {session_dir.name}: {e}")
-            
-            sessions.append({
-                "id": session_dir.name,
-                "frame_count": len(images),
-                "has_video": video_file.exists(),
-                "created": created_time,
-                "duration": duration_seconds
-            })
+        sessions = session_index.list_sessions()
     except Exception as e:
         print(f"Error listing sessions: {e}")
+        sessions = []
+    
+    capturing = {s["session_id"] for s in capture_status().get("sessions", [])}
+    for session in sessions:
+        session["capturing"] = session["id"] in capturing
     
     return jsonify({"sessions": sessions})
 
+@app.route('/api/sessions/reindex', methods=['POST'])
+def reindex_sessions():
+    """Rebuild the session index from the files on disk"""
+    data = request.json or {}
+    count = session_index.rebuild(data.get('session_id'))
+    event_bus.publish('sessions', {})
+    return jsonify({"success": True, "sessions": count})
+
 @app.route('/api/sessions/<session_id>/preview')
 def session_preview(session_id):
-    """Get a preview image from a session"""
+    """Get a preview image from a session (the first frame's thumbnail, ?full=1 for the original)"""
     session_dir = IMAGES_DIR / session_id
     
     if not session_dir.exists():
         return jsonify({"error": "Session not found"}), 404
     
-    # Get the first image
-    images = sorted(session_dir.glob("frame_*.jpg"))
-    if not images:
+    if not request.args.get('full'):
+        return session_thumbnail(session_id, 0)
+    
+    response = send_media(frame_store.frame_path(session_id, 0), 'image/jpeg', max_age=86400)
+    if response is None:
         return jsonify({"error": "No images in session"}), 404
+    return response
+
+THUMBNAIL_MAX_RANGE = 100
+
+def thumbnail_response(data, etag, mimetype='image/jpeg', headers=None):
+    """Cacheable thumbnail response (304 if the browser's copy is current)"""
+    response = Response(data, mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    # Thumbnails of a frame never change; the ETag covers regeneration
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
+@app.route('/api/sessions/<session_id>/thumbnails/<int:frame>')
+def session_thumbnail(session_id, frame):
+    """Small proxy image of one frame"""
+    result = thumbnails.get(session_id, frame)
+    if result is None:
+        return jsonify({"error": "Frame not found"}), 404
+    data, etag = result
+    return thumbnail_response(data, etag)
+
+@app.route('/api/sessions/<session_id>/thumbnails')
+def session_thumbnail_range(session_id):
+    """Thumbnails of frames start, start+step, ... in one response
     
-    return send_file(images[0], mimetype='image/jpeg')
+    The JPEGs are concatenated; X-Thumbnail-Frames and X-Thumbnail-Lengths
+    list each one's frame number and byte length, in order.
+    """
+    frame_count = session_frame_count(session_id)
+    start = request.args.get('start', 0, type=int)
+    count = request.args.get('count', 20, type=int)
+    step = request.args.get('step', 1, type=int)
+    if start < 0 or start >= frame_count:
+        return jsonify({"error": "No frames in range"}), 404
+    # A step past the end of the session would only ever return frame start
+    count = max(1, min(count, THUMBNAIL_MAX_RANGE))
+    step = max(1, min(step, frame_count))
+    
+    frames = thumbnails.get_range(session_id, start, count, step)
+    if not frames:
+        return jsonify({"error": "No frames in range"}), 404
+    
+    headers = {
+        "X-Thumbnail-Frames": ",".join(str(frame) for frame, _, _ in frames),
+        "X-Thumbnail-Lengths": ",".join(str(len(data)) for _, data, _ in frames),
+    }
+    etag = ";".join(tag for _, _, tag in frames)
+    return thumbnail_response(b"".join(data for _, data, _ in frames),
+                              f"{len(frames)}-{zlib.crc32(etag.encode()):08x}",
+                              'application/octet-stream', headers)
+
+@app.route('/api/thumbnails/backfill', methods=['POST'])
+def backfill_thumbnails():
+    """Make missing thumbnails of one session (session_id) or of all sessions, as jobs"""
+    data = request.json or {}
+    session_id = data.get('session_id')
+    if session_id:
+        if not (IMAGES_DIR / session_id).is_dir():
+            return jsonify({"error": "Session not found"}), 404
+        session_ids = [session_id]
+    else:
+        session_ids = [s["id"] for s in session_index.list_sessions()]
+    
+    def backfill_job(job):
+        frame_count = session_frame_count(job.session_id)
+        made = thumbnails.backfill(job.session_id, frame_count, job.report, job.cancel_event)
+        if job.cancelled:
+            raise JobCancelled()
+        return {"thumbnails": made}
+    
+    jobs = [job_queue.submit('thumbnails', backfill_job, sid).id for sid in session_ids]
+    return jsonify({"success": True, "job_ids": jobs, "cache": thumbnails.usage()})
+
+@app.route('/api/sessions/<session_id>/metering')
+def session_metering(session_id):
+    """Luminance statistics and histogram of one frame (default: the latest)"""
+    frame = request.args.get('frame', type=int)
+    if frame is None:
+        frame = session_frame_count(session_id) - 1
+    frame_file = frame_store.frame_path(session_id, frame)
+    if frame < 0 or not frame_file.exists():
+        return jsonify({"error": "Frame not found"}), 404
+    
+    stats = meter_frame(frame_file)
+    if stats is None:
+        return jsonify({"error": "Could not decode frame"}), 500
+    return jsonify(dict(stats, session_id=session_id, frame=frame))
 
 @app.route('/api/sessions/<session_id>/video')
 def download_video(session_id):
     """Download compiled video"""
-    video_file = VIDEOS_DIR / f"{session_id}.mp4"
-    
-    if not video_file.exists():
+    response = send_media(VIDEOS_DIR / f"{session_id}.mp4", 'video/mp4', as_attachment=True)
+    if response is None:
         return jsonify({"error": "Video not found"}), 404
-    
-    return send_file(video_file, mimetype='video/mp4', as_attachment=True)
+    return response
 
 @app.route('/api/sessions/<session_id>/rotate', methods=['POST'])
 def rotate_video(session_id):
-    """Rotate an existing video"""
+    """Rotate an existing video
+    
+    By default only the video's display-matrix metadata changes (stream
+    copy, seconds for any length). With "reencode": true the rotation is
+    encoded into the pixels instead, for players that ignore the metadata.
+    """
     data = request.json or {}
-    rotation = data.get('rotation', 90)  # Default 90° clockwise
+    rotation = data.get('rotation', 90)  # Default 90° clockwise from how it is shown now
+    reencode = bool(data.get('reencode', False))
     
     video_file = VIDEOS_DIR / f"{session_id}.mp4"
     
     if not video_file.exists():
         return jsonify({"error": "Video not found"}), 404
     
-    # Create rotated filename
-    rotated_file = VIDEOS_DIR / f"{session_id}_rotated.mp4"
-    
-    # Build ffmpeg command
-    cmd = ['ffmpeg', '-y', '-i', str(video_file)]
-    
-    if rotation == 90:
-        cmd.extend(['-vf', 'transpose=1'])  # 90° clockwise
-    elif rotation == 180:
-        cmd.extend(['-vf', 'transpose=1,transpose=1'])  # 180°
-    elif rotation == 270:
-        cmd.extend(['-vf', 'transpose=2'])  # 90° counter-clockwise
-    else:
+    if rotation not in (90, 180, 270):
         return jsonify({"error": "Invalid rotation. Use 90, 180, or 270"}), 400
     
-    cmd.extend(['-c:a', 'copy', str(rotated_file)])
-    
-    try:
-        # Run rotation in background
-        def rotate_async():
-            subprocess.run(cmd, check=True, capture_output=True, timeout=300)
-            # Replace original with rotated
-            rotated_file.replace(video_file)
+    encoder, encoder_args = None, None
+    if reencode:
+        try:
+            encoder, encoder_args = encoder_profile(data.get('encoder'), needs_filters=True)
+        except EncoderError as e:
+            return jsonify({"error": str(e)}), 400
+    
+    # Run rotation on the job queue
+    def rotate_job(job):
+        current, baked = session_rotation(session_id)
+        new_rotation = (current + rotation) % 360
         
-        thread = threading.Thread(target=rotate_async, daemon=True)
-        thread.start()
+        if reencode:
+            # ffmpeg applies the current display matrix while decoding, so
+            # the output pixels end up rotated by new_rotation in total
+            rotated_file = VIDEOS_DIR / f"{session_id}_rotated.mp4"
+            cmd = ['ffmpeg', '-y', '-i', str(video_file), '-vf', rotation_filter(rotation)]
+            cmd.extend(encoder_args)
+            cmd.extend(['-c:a', 'copy', str(rotated_file)])
+            total = session_frame_count(session_id)
+            returncode, error_msg = run_ffmpeg(
+                cmd, lambda frames: job.report(frames / total * 100) if total else None,
+                cancel_event=job.cancel_event, low_priority=True)
+            if returncode == 0:
+                # Replace original with rotated
+                rotated_file.replace(video_file)
+                baked = new_rotation
+            else:
+                rotated_file.unlink(missing_ok=True)
+        else:
+            returncode, error_msg = set_display_rotation(video_file, (new_rotation - baked) % 360,
+                                                         job.cancel_event, low_priority=True)
         
-        return jsonify({
-            "success": True,
-            "message": f"Rotating video {rotation}°..."
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        if returncode != 0:
+            if job.cancelled:
+                raise JobCancelled()
+            raise RuntimeError(f"ffmpeg failed: {error_msg[-200:]}")
+        session_index.set_rotation(session_id, new_rotation, baked)
+        session_index.record_video(session_id)
+        event_bus.publish('sessions', {"session_id": session_id})
+        return {"rotation": new_rotation, "reencoded": reencode, "encoder": encoder}
+    
+    job = job_queue.submit('rotate', rotate_job, session_id,
+                           {"rotation": rotation, "reencode": reencode, "encoder": encoder})
+    
+    return jsonify({
+        "success": True,
+        "message": f"Rotating video {rotation}°...",
+        "job_id": job.id
+    })
 
 @app.route('/api/sessions/<session_id>', methods=['DELETE'])
 def delete_session(session_id):
     """Delete a session and its files"""
+    remove_session(session_id)
+    return jsonify({"success": True})
+
+def remove_session(session_id):
+    """Delete a session: frames, videos, caches and index entry"""
     session_dir = IMAGES_DIR / session_id
     video_file = VIDEOS_DIR / f"{session_id}.mp4"
     preview_file = VIDEOS_DIR / f"{session_id}_preview.mp4"
     
+    session_journal.remove(session_id)
+    frame_store.forget(session_id)
+    
+    # Stop any compile/rotate still working on this session
+    for job in job_queue.list_jobs(session_id):
+        job_queue.cancel(job.id)
+    
     # Delete images
     if session_dir.exists():
         import shutil
@@ -766,71 +1825,153 @@ def delete_session(session_id):
     if preview_file.exists():
         preview_file.unlink()
     
-    return jsonify({"success": True})
+    # Delete cached encoded segments, processed frames and thumbnails
+    remove_segments(VIDEOS_DIR, session_id)
+    remove_processed(session_id)
+    thumbnails.remove(session_id)
+    
+    session_index.delete_session(session_id)
+    event_bus.publish('sessions', {"session_id": session_id})
+
+def remove_processed(session_id):
+    """Delete a session's cached post-processed frames"""
+    shutil.rmtree(PROCESSED_DIR / session_id, ignore_errors=True)
+
+def submit_retention():
+    """Queue a job applying the retention policies (see storage.py)"""
+    def run(job):
+        # The journal lists running sessions even when the capture daemon
+        # can't be asked (they resume when it is back)
+        protect = {s["session_id"] for s in capture_status().get("sessions", [])}
+        protect.update(session_journal.active_ids())
+        actions = storage.plan_retention(session_index.list_sessions(), protect)
+        done = []
+        for i, (action, session_id) in enumerate(actions):
+            if job.cancelled:
+                raise JobCancelled()
+            print(f"[Storage] Retention: {action} {session_id}")
+            if action == 'delete':
+                remove_session(session_id)
+            elif action == 'delete_frames':
+                frame_store.remove_frames(session_id)
+                remove_segments(VIDEOS_DIR, session_id)
+                remove_processed(session_id)
+                session_index.rebuild(session_id)
+            else:
+                recompress_session(frame_store, session_id, storage.recompress_width, storage.recompress_quality,
+                                   cancel_event=job.cancel_event)
+                if job.cancelled:
+                    raise JobCancelled()
+                session_index.rebuild(session_id)
+                session_index.set_recompressed(session_id)
+            event_bus.publish('sessions', {"session_id": session_id})
+            done.append([action, session_id])
+            job.report((i + 1) * 100.0 / len(actions))
+        if storage.check() != 'ok':
+            # Segments and processed frames are only caches
+            for session in session_index.list_sessions():
+                if session["id"] not in protect:
+                    remove_segments(VIDEOS_DIR, session["id"])
+                    remove_processed(session["id"])
+        return {"actions": done}
+    return job_queue.submit('retention', run)
+
+@app.route('/api/storage/retention', methods=['POST'])
+def run_retention():
+    """Apply the retention policies now, as a job"""
+    job = submit_retention()
+    return jsonify({"success": True, "job_id": job.id, "storage": storage.status()})
+
+# Camera the preview opened itself (only while no session holds the device)
+preview_camera = {"backend": None}
+
+def grab_preview_frame():
+    """Preview stream grab callback: one JPEG of the selected camera, from whichever source owns it
+    
+    Returns:
+        bytes, or None if there is no frame to take right now
+    """
+    if capture_client is not None:
+        return capture_client.preview()
+    device = configured_device()
+    device_lock = capture_sessions.device_lock(device)
+    if not device_lock.acquire(timeout=0.5):
+        return None  # a capture is in progress and offers its own frame
+    try:
+        session = capture_sessions.by_device(device)
+        if session is not None and session["active"] and not session["waiting_for_start"]:
+            close_preview_camera(device)
+            # A persistent V4L2 stream can spare a frame between captures;
+            # a one-shot fswebcam grab would hold the camera for seconds, so
+            # then the preview shows the captured frames only
+            backend = session["backend"]
+            if backend is None or backend.name != 'v4l2':
+                return None
+            return backend.grab()
+        
+        if device == LIBCAMERA_DEVICE or detect_camera() != 'usb':
+            return None
+        backend = preview_camera["backend"]
+        if backend is not None and backend.device != device:
+            # Another camera was selected
+            release_preview_camera()
+            backend = None
+        if backend is None:
+            config = load_config()
+            print(f"[Preview] Using device: {device}")
+            backend = open_capture_backend(device, tuple(config.get('preview_resolution', [640, 480])),
+                                           config.get('capture_backend', 'auto'))
+            preview_camera["backend"] = backend
+        return backend.grab()
+    finally:
+        device_lock.release()
+
+def close_preview_camera(device=None):
+    """Release the preview's own camera handle (call with its device's lock held)
+    
+    Args:
+        device: Only if the preview has this device open
+    """
+    backend = preview_camera["backend"]
+    if backend is not None and device in (None, backend.device):
+        preview_camera["backend"] = None
+        backend.close()
+
+def release_preview_camera():
+    """Preview stream release callback: the last viewer has gone"""
+    if capture_client is not None:
+        capture_client.release_preview()
+        return
+    backend = preview_camera["backend"]
+    if backend is not None:
+        with capture_sessions.device_lock(backend.device):
+            close_preview_camera(backend.device)
+
+preview_stream = PreviewStream(grab_preview_frame, release_preview_camera,
+                               fps=load_config().get('preview_fps', 5),
+                               size=load_config().get('preview_resolution', [640, 480]))
 
 @app.route('/api/camera/preview')
 def camera_preview():
-    """Live camera preview stream"""
+    """Live camera preview stream
+    
+    Every viewer is served from one shared producer (see preview_stream.py),
+    capped at the configured preview_fps and preview_resolution.
+    """
+    if capture_client is None and not claim_capture():
+        return capture_elsewhere_response()
+    if detect_camera() != 'usb' and not capture_status()["active"]:
+        print("[Preview] No USB camera detected")
+        return jsonify({"error": "Live preview needs a USB camera or a running session"}), 400
+    
+    config = load_config()
+    preview_stream.configure(config.get('preview_fps'), config.get('preview_resolution'))
+    
     def generate_frames():
         """Generate frames for MJPEG stream"""
-        camera_type = detect_camera()
-        
-        if camera_type != 'usb':
-            print("[Preview] No USB camera detected")
-            return
-        
-        # Get configured camera device
-        config = load_config()
-        video_device = config.get('camera_device', get_default_camera_device())
-        
-        print(f"[Preview] Using device: {video_device}")
-        
-        frame_count = 0
-        while True:
-            try:
-                # Capture directly to temp file without session directory
-                temp_file = Path('/tmp/timelapsepi_preview.jpg')
-                
-                # Simple fswebcam capture
-                cmd = [
-                    'fswebcam',
-                    '-d', video_device,
-                    '-r', '640x480',
-                    '--no-banner',
-                    '--jpeg', '90',
-                    '-S', '2',  # Skip 2 frames
-                    str(temp_file)
-                ]
-                
-                result = subprocess.run(cmd, capture_output=True, timeout=5)
-                
-                if result.returncode == 0 and temp_file.exists():
-                    with open(temp_file, 'rb') as f:
-                        frame = f.read()
-                    
-                    frame_count += 1
-                    if frame_count % 10 == 0:
-                        print(f"[Preview] Frame {frame_count} captured ({len(frame)} bytes)")
-                    
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-                    
-                    # Clean up
-                    temp_file.unlink()
-                else:
-                    error_msg = result.stderr.decode('utf-8') if result.stderr else "Unknown error"
-                    print(f"[Preview] Capture failed: {error_msg}")
-                
-                time.sleep(0.5)  # 2 FPS preview
-                
-            except subprocess.TimeoutExpired:
-                print(f"[Preview] Timeout capturing frame")
-                time.sleep(1)
-            except Exception as e:
-                print(f"[Preview] Error: {e}")
-                import traceback
-                traceback.print_exc()
-                time.sleep(1)
+        for frame in preview_stream.frames():
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
     
     return Response(generate_frames(),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
@@ -843,180 +1984,111 @@ def handle_config():
     else:
         config = request.json
         save_config(config)
+        storage.configure(config)
+        # The daemon's storage manager pauses capture and applies retention
+        if capture_client is not None and not capture_client.configure():
+            print("[Daemon] Capture daemon not reachable, it takes the new config when it starts")
         return jsonify({"success": True})
 
+# Frontend control names -> v4l2 control names
+CAMERA_CONTROL_NAMES = {
+    'brightness': 'brightness',
+    'contrast': 'contrast',
+    'saturation': 'saturation',
+    'exposure_auto': 'auto_exposure',  # Frontend uses exposure_auto, camera uses auto_exposure
+    'exposure_absolute': 'exposure_time_absolute'  # Frontend uses exposure_absolute, camera uses exposure_time_absolute
+}
+
+def controls_device():
+    """Control map of the camera the settings panel should adjust
+    
+    Some systems have multiple video devices (metadata, actual camera, etc.),
+    so prefer the configured camera, then any detected camera that has a
+    brightness control.
+    
+    Returns:
+        DeviceControls, or None if no camera's controls are known
+    """
+    candidates = [d['device'] for d in detect_usb_camera_devices()]
+    configured = load_config().get('camera_device')
+    if configured:
+        candidates.insert(0, configured)
+    
+    fallback = None
+    for device in candidates:
+        controls = control_registry.get(device)
+        if controls is None:
+            continue
+        if controls.has('brightness'):
+            return controls
+        fallback = fallback or controls
+    return fallback
+
 @app.route('/api/camera/controls', methods=['GET', 'POST'])
 def camera_controls():
-    """Get or set camera controls (USB camera only)"""
+    """Get or set camera controls (USB camera only)
+    
+    Values come from the control registry (v4l2_controls.py); GET with
+    ?refresh=1 re-reads them from the camera first.
+    """
     camera_type = detect_camera()
     
     if camera_type != 'usb':
         return jsonify({"error": "Camera controls only available for USB cameras"}), 400
     
-    # Find video device with actual controls
-    # Some systems have multiple video devices (metadata, actual camera, etc.)
-    video_device = None
-    video_devices = sorted(Path('/dev').glob('video*'))
-    
-    for device in video_devices:
-        try:
-            # Check if it's a video capture device
-            result = subprocess.run(['v4l2-ctl', '--device', str(device), '--all'], 
-                                  capture_output=True, timeout=1, text=True)
-            
-            if 'Video Capture' not in result.stdout:
-                continue
-            
-            # Check if it has controls we care about
-            ctrl_result = subprocess.run(['v4l2-ctl', '--device', str(device), '--list-ctrls'],
-                                        capture_output=True, timeout=1, text=True)
-            
-            # Look for brightness control as indicator this is the right device
-            if 'brightness' in ctrl_result.stdout.lower():
-                video_device = str(device)
-                print(f"[Camera Controls] Found camera with controls at {video_device}")
-                break
-        except:
-            pass
-    
-    if not video_device:
-        # Fallback to /dev/video0 if nothing found
-        video_device = '/dev/video0'
-        print(f"[Camera Controls] No device with controls found, using {video_device}")
+    controls = controls_device()
+    if controls is None:
+        return jsonify({"error": "No camera with controls found"}), 404
+    video_device = controls.device
     
     if request.method == 'GET':
-        # Get current controls - no camera lock needed, just reading settings
         try:
-            result = subprocess.run(['v4l2-ctl', '--device', video_device, '--list-ctrls'],
-                                  capture_output=True, text=True, timeout=2)
+            names = list(CAMERA_CONTROL_NAMES.values())
+            if request.args.get('refresh'):
+                controls.refresh(names)
+            described = controls.describe()
             
-            controls = {}
-            for line in result.stdout.split('\n'):
-                # More flexible parsing - handle various control name formats
-                line_lower = line.lower()
-                
-                if 'brightness' in line_lower and 'value=' in line:
-                    parts = line.split('value=')
-                    if len(parts) > 1:
-                        try:
-                            controls['brightness'] = int(parts[1].split()[0])
-                        except:
-                            pass
-                            
-                elif 'contrast' in line_lower and 'auto' not in line_lower and 'value=' in line:
-                    parts = line.split('value=')
-                    if len(parts) > 1:
-                        try:
-                            controls['contrast'] = int(parts[1].split()[0])
-                        except:
-                            pass
-                            
-                elif 'saturation' in line_lower and 'value=' in line:
-                    parts = line.split('value=')
-                    if len(parts) > 1:
-                        try:
-                            controls['saturation'] = int(parts[1].split()[0])
-                        except:
-                            pass
-                            
-                # Check for auto_exposure (actual v4l2 control name)
-                elif 'auto_exposure' in line_lower and 'value=' in line:
-                    parts = line.split('value=')
-                    if len(parts) > 1:
-                        try:
-                            # Map to frontend name
-                            controls['exposure_auto'] = int(parts[1].split()[0])
-                        except:
-                            pass
-                            
-                # Check for exposure_time_absolute (actual v4l2 control name)
-                elif 'exposure_time_absolute' in line_lower and 'value=' in line:
-                    parts = line.split('value=')
-                    if len(parts) > 1:
-                        try:
-                            # Map to frontend name
-                            controls['exposure_absolute'] = int(parts[1].split()[0])
-                        except:
-                            pass
+            values = {}
+            ranges = {}
+            for frontend_name, control in CAMERA_CONTROL_NAMES.items():
+                info = described.get(control)
+                if info is None:
+                    continue
+                if info['value'] is not None:
+                    values[frontend_name] = info['value']
+                ranges[frontend_name] = {key: info[key] for key in ('min', 'max', 'step', 'default')}
+                ranges[frontend_name]['inactive'] = 'inactive' in info['flags']
             
-            print(f"[Camera Controls] GET from {video_device}: {controls}")
+            print(f"[Camera Controls] GET from {video_device}: {values}")
             
             return jsonify({
                 "device": video_device,
-                "controls": controls
+                "controls": values,
+                "ranges": ranges
             })
         except Exception as e:
             return jsonify({"error": str(e)}), 500
     
     else:  # POST - set controls - no camera lock needed, just changing settings
-        data = request.json
+        data = request.json or {}
         
         print(f"[Camera Controls] Received request to set on {video_device}: {data}")
         
         try:
-            # First, get list of available controls for this device
-            available_result = subprocess.run(
-                ['v4l2-ctl', '--device', video_device, '--list-ctrls'],
-                capture_output=True,
-                text=True,
-                timeout=2
-            )
-            
-            # Parse available controls
-            available_controls = set()
-            for line in available_result.stdout.split('\n'):
-                # Extract control name from line like "brightness 0x00980900 (int) : ..."
-                parts = line.strip().split()
-                if parts and not line.startswith(' '):
-                    control_name = parts[0].lower()
-                    available_controls.add(control_name)
+            requested = {CAMERA_CONTROL_NAMES[name]: value for name, value in data.items()
+                         if name in CAMERA_CONTROL_NAMES}
+            frontend_names = {control: name for name, control in CAMERA_CONTROL_NAMES.items()}
             
-            print(f"[Camera Controls] Available controls: {available_controls}")
+            # All settings go to the camera in one round-trip
+            applied, failed, unavailable = controls.set(requested)
             
-            results = {}
-            errors = []
-            skipped = []
-            
-            for control, value in data.items():
-                # Map frontend control names to actual v4l2 control names
-                control_mapping = {
-                    'brightness': 'brightness',
-                    'contrast': 'contrast',
-                    'saturation': 'saturation',
-                    'exposure_auto': 'auto_exposure',  # Frontend uses exposure_auto, camera uses auto_exposure
-                    'exposure_absolute': 'exposure_time_absolute'  # Frontend uses exposure_absolute, camera uses exposure_time_absolute
-                }
-                
-                if control not in control_mapping:
-                    continue
-                
-                actual_control = control_mapping[control]
-                
-                # Check if this control exists on the camera
-                if actual_control not in available_controls:
-                    skipped.append(control)
-                    print(f"[Camera Controls] ⚠️  Skipping {control} ({actual_control} not available on this camera)")
-                    continue
-                
-                cmd = ['v4l2-ctl', '--device', video_device, f'--set-ctrl={actual_control}={value}']
-                print(f"[Camera Controls] Running: {' '.join(cmd)}")
-                
-                result = subprocess.run(
-                    cmd,
-                    capture_output=True,
-                    text=True,
-                    timeout=2
-                )
-                
-                if result.returncode == 0:
-                    results[control] = "success"
-                    print(f"[Camera Controls] ✅ Set {actual_control}={value}")
-                else:
-                    results[control] = "failed"
-                    error_msg = result.stderr.strip() if result.stderr else "Unknown error"
-                    errors.append(f"{control}: {error_msg}")
-                    print(f"[Camera Controls] ❌ Failed to set {actual_control}={value}: {error_msg}")
+            results = {frontend_names[control]: "success" for control in applied}
+            results.update({frontend_names[control]: "failed" for control in failed})
+            errors = [f"{frontend_names[control]}: {message}" for control, message in failed.items()]
+            skipped = [frontend_names[control] for control in unavailable]
             
+            if applied:
+                print(f"[Camera Controls] ✅ Set {applied}")
             if skipped:
                 print(f"[Camera Controls] Skipped unavailable controls: {skipped}")
             
@@ -1038,80 +2110,108 @@ def camera_controls():
 @app.route('/api/sessions/<session_id>/video/stream')
 def stream_video(session_id):
     """Stream compiled video for preview"""
-    video_file = VIDEOS_DIR / f"{session_id}.mp4"
-    
-    if not video_file.exists():
+    response = send_media(VIDEOS_DIR / f"{session_id}.mp4", 'video/mp4')
+    if response is None:
         return jsonify({"error": "Video not found"}), 404
-    
-    return send_file(video_file, mimetype='video/mp4')
+    return response
+
+# How long a preview request waits for its encode before answering with the job
+PREVIEW_WAIT_SECONDS = 60
 
 @app.route('/api/current-session/preview', methods=['POST'])
 def preview_current_session():
-    """Generate a preview video of the current recording session"""
-    session_id = timelapse_state.get("current_session")
+    """Generate a preview video of a recording session (session_id, default: the selected camera's)
+    
+    Answers once the preview is encoded, or after PREVIEW_WAIT_SECONDS
+    with 202 and the job_id of the encode to follow (/api/jobs/<job_id>).
+    """
+    data = request.json or {}
+    status = capture_status()
+    session_id = data.get('session_id') or status.get("session_id")
     
     if not session_id:
         return jsonify({"error": "No session available"}), 400
     
-    data = request.json or {}
     fps = data.get('fps', 30)
     
+    try:
+        encoder, encoder_args = encoder_profile(data.get('encoder'))
+    except EncoderError as e:
+        return jsonify({"error": str(e)}), 400
+    
     session_dir = IMAGES_DIR / session_id
     if not session_dir.exists():
         return jsonify({"error": "Session directory not found"}), 404
     
-    # Count current frames
-    images = sorted(session_dir.glob("frame_*.jpg"))
-    if len(images) < 2:
+    # Frames so far; capture goes on appending to the manifest meanwhile
+    frame_files = frame_store.frame_files(session_id)
+    frame_count = len(frame_files)
+    if frame_count < 2:
         return jsonify({"error": "Not enough frames yet (need at least 2)"}), 400
     
-    # Generate preview video
+    # A live-encoded session already has an up-to-date, playable video
+    running = running_session_status(status, session_id)
+    if running and live_encoding(running):
+        return jsonify({
+            "success": True,
+            "preview_url": f"/api/sessions/{session_id}/video/stream",
+            "frame_count": frame_count,
+            "encoded_frames": 0
+        })
+    
+    # Generate preview video, encoding only the frames added since last time
     preview_file = VIDEOS_DIR / f"{session_id}_preview.mp4"
     
-    try:
-        cmd = [
-            'ffmpeg',
-            '-y',  # Overwrite
-            '-framerate', str(fps),
-            '-pattern_type', 'glob',
-            '-i', str(session_dir / 'frame_*.jpg'),
-            '-c:v', 'libx264',
-            '-pix_fmt', 'yuv420p',
-            '-crf', '23',
-            str(preview_file)
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, timeout=60)
-        
-        if result.returncode == 0 and preview_file.exists():
-            return jsonify({
-                "success": True,
-                "preview_url": f"/api/current-session/preview/video",
-                "frame_count": len(images)
-            })
-        else:
-            error_msg = result.stderr.decode('utf-8') if result.stderr else "Unknown error"
+    def preview_job(job):
+        success, error_msg, stats = build_video(
+            session_id, frame_files, VIDEOS_DIR, preview_file, fps,
+            segment_frames=load_config().get('segment_frames', DEFAULT_SEGMENT_FRAMES),
+            on_progress=lambda frames: job.report(frames / frame_count * 100),
+            cancel_event=job.cancel_event, low_priority=True, encoder_args=encoder_args,
+            rotation=session_rotation(session_id)[0])
+        if not success:
+            if job.cancelled:
+                raise JobCancelled()
             print(f"FFmpeg error: {error_msg}")
-            return jsonify({"error": f"Failed to generate preview: {error_msg[:200]}"}), 500
-            
-    except subprocess.TimeoutExpired:
-        return jsonify({"error": "Preview generation timed out"}), 500
-    except Exception as e:
-        print(f"Preview error: {e}")
-        return jsonify({"error": str(e)}), 500
+            raise RuntimeError(error_msg[-200:])
+        return stats
+    
+    # Queued like any other encode; concurrent requests share one job
+    job = job_queue.submit('preview', preview_job, session_id, {"fps": fps, "encoder": encoder})
+    if not job.wait(PREVIEW_WAIT_SECONDS):
+        return jsonify({
+            "pending": True,
+            "job_id": job.id,
+            "job_url": f"/api/jobs/{job.id}",
+            "preview_url": f"/api/current-session/preview/video?session_id={session_id}",
+            "frame_count": frame_count
+        }), 202
+    
+    if job.state == 'finished' and preview_file.exists():
+        return jsonify({
+            "success": True,
+            "preview_url": f"/api/current-session/preview/video?session_id={session_id}",
+            "frame_count": frame_count,
+            "encoded_frames": job.result["encoded_frames"],
+            "encoder": encoder,
+            "job_id": job.id
+        })
+    if job.state == 'cancelled':
+        return jsonify({"error": "Preview cancelled", "job_id": job.id}), 409
+    print(f"Preview error: {job.error}")
+    return jsonify({"error": f"Failed to generate preview: {job.error}", "job_id": job.id}), 500
 
 @app.route('/api/current-session/preview/video')
 def stream_current_preview():
-    """Stream the current session preview video"""
-    if not timelapse_state["current_session"]:
+    """Stream a recording session's preview video (session_id, default: the selected camera's)"""
+    session_id = request.args.get('session_id') or capture_status().get("session_id")
+    if not session_id:
         return jsonify({"error": "No active session"}), 404
     
-    preview_file = VIDEOS_DIR / f"{timelapse_state['current_session']}_preview.mp4"
-    
-    if not preview_file.exists():
+    response = send_media(VIDEOS_DIR / f"{session_id}_preview.mp4", 'video/mp4')
+    if response is None:
         return jsonify({"error": "Preview not generated yet"}), 404
-    
-    return send_file(preview_file, mimetype='video/mp4')
+    return response
 
 @app.route('/api/system/shutdown', methods=['POST'])
 def shutdown_system():
@@ -1172,16 +2272,6 @@ def cancel_shutdown():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-if __name__ == '__main__':
-    # Perform initial device detection on startup to populate cache
-    print("=" * 60)
-    print("TimelapsePI Starting...")
-    print("=" * 60)
-    detect_usb_camera_devices(force_refresh=True)
-    print("=" * 60)
-    
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
-
 @app.route('/api/camera/test')
 def test_camera():
     """Test camera capture"""
@@ -1249,7 +2339,8 @@ def get_camera_devices():
         
         return jsonify({
             "devices": devices,
-            "current_device": current_device
+            "current_device": current_device,
+            "in_use": devices_in_use()
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1295,7 +2386,39 @@ def refresh_camera_devices():
         
         return jsonify({
             "devices": devices,
-            "current_device": current_device
+            "current_device": current_device,
+            "in_use": devices_in_use()
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+def start_background_services():
+    """Startup shared by `python3 app.py` and the production entry point (wsgi.py)"""
+    print("=" * 60)
+    print("TimelapsePI Starting...")
+    print("=" * 60)
+    if capture_client is not None:
+        print(f"[Startup] Capture runs in the capture daemon ({CAPTURE_SOCKET})")
+        threading.Thread(target=relay_daemon_events, daemon=True).start()
+        threading.Thread(target=probe_profiles, daemon=True).start()
+        camera_service.wait_ready()
+        print("=" * 60)
+        return
+    if not claim_capture():
+        print(f"[Startup] Capture runs in process {capture_owner()}; this process only serves requests")
+        print("=" * 60)
+        return
+    # Find usable encoders in the background (test-encodes a few frames each)
+    threading.Thread(target=probe_profiles, daemon=True).start()
+    # Perform initial device detection on startup to populate cache
+    camera_service.wait_ready()
+    resume_sessions()
+    # Sessions from before sharded storage, moved over while the app runs
+    threading.Thread(target=frame_store.migrate_all, daemon=True).start()
+    submit_retention()
+    print("=" * 60)
+
+if __name__ == '__main__':
+    # Development server; see SERVING.md for the production setup
+    start_background_services()
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
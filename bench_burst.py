@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Burst and HDR merge benchmark
+
+Generates a synthetic night scene (dark, with a few bright lights and
+heavy sensor noise), encodes bursts of it to JPEG like a camera would, and
+runs burst.py over them:
+
+- merge time per slot for average stacking and exposure fusion, which
+  bounds how short the interval can be before bursts are stored unmerged
+- noise left in an averaged frame, against a single frame
+- for hdr, how much of the frame is clipped (crushed or blown) in the
+  fused frame against the middle exposure
+- the pool: slots submitted at the given interval while the merges run,
+  how long submit blocks the capture loop, and how many slots fell back
+  to unmerged frames
+
+Usage:
+    python3 bench_burst.py [--width 1920 --height 1080] [--frames 4] [--slots 20] [--interval 1]
+"""
+
+import io
+import time
+import argparse
+import statistics
+
+import numpy as np
+from PIL import Image
+
+import burst
+import process_pool
+from burst import BurstMerger, merge_frames
+
+
+def make_scene(width, height, seed=1):
+    """Scene radiance (0-1, linear) with deep shadows and bright lights"""
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray((rng.random((height // 60 + 1, width // 60 + 1)) * 255).astype(np.uint8))
+    scene = np.asarray(coarse.resize((width, height), Image.BICUBIC), dtype=np.float32) / 255 * 0.15
+    scene = np.repeat(scene[..., None], 3, axis=2) * (1.0, 0.9, 0.8)
+    for _ in range(12):
+        x, y = rng.integers(0, width - 40), rng.integers(0, height - 40)
+        scene[y:y + 30, x:x + 30] = (1.5, 1.3, 0.9)
+    return scene
+
+
+def expose(scene, exposure, noise, rng, quality):
+    """JPEG of the scene at an exposure (1.0: a dark night frame) with sensor noise"""
+    pixels = scene * exposure * 255 + rng.normal(0, noise, scene.shape)
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+def pixels(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGB'), dtype=np.float32)
+
+
+def clipped(data):
+    """Fraction of pixels crushed to black or blown to white"""
+    grey = pixels(data).mean(axis=2)
+    return float(((grey < 4) | (grey > 251)).mean())
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return result, statistics.mean(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--frames', type=int, default=burst.DEFAULT_BURST_FRAMES, help='frames per average burst')
+    parser.add_argument('--noise', type=float, default=12.0, help='sensor noise (standard deviation, 0-255)')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the synthetic frames')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--slots', type=int, default=20, help='slots submitted to the pool')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between slots in the pool run')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(2)
+    scene = make_scene(args.width, args.height)
+    clean = np.clip(scene * 255, 0, 255)
+    print(f"{args.width}x{args.height}, noise {args.noise:g}, {process_pool.default_workers()} default worker(s)")
+    print()
+
+    frames = [expose(scene, 1.0, args.noise, rng, args.quality) for _ in range(args.frames)]
+    single_noise = float(np.std(pixels(frames[0]) - clean))
+    merged, merge_ms = timed(lambda: merge_frames(frames, 'average'), args.repeat)
+    merged_noise = float(np.std(pixels(merged) - clean))
+    print(f"average  {args.frames} frames  merge {merge_ms:7.1f} ms  noise {single_noise:5.2f} -> {merged_noise:5.2f} "
+          f"({single_noise / merged_noise:.2f}x lower, sqrt(n) = {args.frames ** 0.5:.2f})")
+
+    bracket = [expose(scene, factor, args.noise / 2, rng, args.quality) for factor in burst.DEFAULT_BRACKET]
+    fused, fuse_ms = timed(lambda: merge_frames(bracket, 'hdr'), args.repeat)
+    print(f"hdr      {len(bracket)} exposures  merge {fuse_ms:7.1f} ms  clipped {clipped(bracket[1]) * 100:5.1f}% "
+          f"(middle exposure) -> {clipped(fused) * 100:5.1f}% (fused)")
+    print()
+
+    # Start the (shared) pool outside the timing
+    warmup = BurstMerger('average', args.frames, workers=args.workers)
+    warmup.submit(0, frames)
+    warmup.drain()
+    warmup.close()
+    delivered = []
+    merger = BurstMerger('average', args.frames, workers=args.workers,
+                         on_merged=lambda n, jpeg, context: delivered.append(n))
+    submit_ms = []
+    started = time.monotonic()
+    for slot in range(args.slots):
+        time.sleep(max(0.0, started + slot * args.interval - time.monotonic()))
+        t = time.perf_counter()
+        merger.submit(slot, frames)
+        submit_ms.append((time.perf_counter() - t) * 1000)
+    merger.drain()
+    merger.close()
+    stats = merger.stats()
+    in_order = delivered == sorted(delivered)
+    print(f"pool     {args.slots} slots every {args.interval:g}s, {stats['workers']} worker(s): "
+          f"submit mean {statistics.mean(submit_ms):.2f} ms, max {max(submit_ms):.2f} ms")
+    print(f"         merged {stats['merged']}, unmerged (backlog) {stats['unmerged']}, failed {stats['failed']}, "
+          f"delivered in order: {in_order}")
+
+
+if __name__ == '__main__':
+    main()
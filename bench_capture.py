@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Capture backend benchmark
+
+Compares the persistent V4L2 backend with the per-frame fswebcam backend
+against a fake camera, so it runs anywhere (no /dev/video* needed):
+
+  * the V4L2 backend talks to a simulated driver that produces a frame
+    every 1/fps seconds into a ring of buffers
+  * the fswebcam backend runs a stand-in `fswebcam` script that pays the
+    same device open/format negotiation cost and skips the same warm-up
+    frames the real tool does
+
+Usage:
+    python3 bench_capture.py [--frames 50] [--fps 30] [--open-delay 0.4]
+"""
+
+import os
+import sys
+import time
+import stat
+import argparse
+import tempfile
+import statistics
+
+from capture_backends import V4L2Capture, FswebcamCapture
+
+FAKE_FRAME = (b'\xff\xd8\xff\xc4\x00\x02\xff\xda\x00\x02'
+              + bytes(180_000) + b'\xff\xd9')
+
+
+class FakeV4L2Capture(V4L2Capture):
+    """V4L2Capture wired to a simulated driver instead of ioctls"""
+
+    def __init__(self, *args, fps=30, open_delay=0.4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fps = fps
+        self.open_delay = open_delay
+
+    def _open_device(self):
+        time.sleep(self.open_delay)  # open + S_FMT + REQBUFS
+        self.fd = -1
+        self.actual_resolution = self.resolution
+        self.buffers = [bytearray(FAKE_FRAME) for _ in range(self.buffer_count)]
+        self.queued = list(range(self.buffer_count))
+        self.filled = []
+        self.stream_start = time.monotonic()
+        self.frames_produced = 0
+        self.streaming = True
+
+    def _close_device(self):
+        self.buffers = []
+        self.fd = None
+        self.streaming = False
+
+    def _produce(self):
+        # Move buffers from the queued list to the filled list at sensor rate
+        due = int((time.monotonic() - self.stream_start) * self.fps)
+        while self.frames_produced < due:
+            self.frames_produced += 1
+            if self.queued:
+                self.filled.append(self.queued.pop(0))
+
+    def _wait_readable(self, timeout):
+        self._produce()
+        if self.filled:
+            return True
+        next_frame = self.stream_start + (self.frames_produced + 1) / self.fps
+        time.sleep(max(0.0, min(timeout, next_frame - time.monotonic())))
+        self._produce()
+        return bool(self.filled)
+
+    def _dequeue(self):
+        self._produce()
+        if not self.filled:
+            return None
+        index = self.filled.pop(0)
+        return index, len(self.buffers[index])
+
+    def _queue(self, index):
+        self.queued.append(index)
+
+    def _read_buffer(self, index, length):
+        return bytes(self.buffers[index][:length])
+
+
+FAKE_FSWEBCAM = '''#!{python}
+import sys, time
+args = sys.argv[1:]
+skip = int(args[args.index('-S') + 1]) if '-S' in args else 0
+time.sleep({open_delay} + (skip + 1) / {fps})
+sys.stdout.buffer.write(bytes.fromhex('ffd8ffc40002ffda0002') + bytes(180000) + bytes.fromhex('ffd9'))
+'''
+
+
+def install_fake_fswebcam(directory, fps, open_delay):
+    path = os.path.join(directory, 'fswebcam')
+    with open(path, 'w') as f:
+        f.write(FAKE_FSWEBCAM.format(python=sys.executable, fps=fps, open_delay=open_delay))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = directory + os.pathsep + os.environ.get('PATH', '')
+
+
+def run(backend, frames):
+    latencies = []
+    started = time.monotonic()
+    backend.open()
+    open_time = time.monotonic() - started
+    loop_start = time.monotonic()
+    for _ in range(frames):
+        t0 = time.monotonic()
+        backend.grab()
+        latencies.append(time.monotonic() - t0)
+    total = time.monotonic() - loop_start
+    backend.close()
+    return open_time, total, latencies
+
+
+def report(name, open_time, total, latencies):
+    latencies_ms = sorted(l * 1000 for l in latencies)
+    p95 = latencies_ms[max(0, int(len(latencies_ms) * 0.95) - 1)]
+    print(f"{name:<10} open {open_time * 1000:7.1f} ms | "
+          f"{len(latencies) / total:7.2f} frames/s | "
+          f"latency mean {statistics.mean(latencies_ms):7.1f} ms, "
+          f"p50 {statistics.median(latencies_ms):7.1f} ms, "
+          f"p95 {p95:7.1f} ms, max {latencies_ms[-1]:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=50, help='frames to grab per backend')
+    parser.add_argument('--fps', type=float, default=30, help='simulated sensor frame rate')
+    parser.add_argument('--open-delay', type=float, default=0.4,
+                        help='simulated device open + format negotiation time (s)')
+    parser.add_argument('--skip', type=int, default=2, help='fswebcam warm-up frames (-S)')
+    args = parser.parse_args()
+
+    print(f"Fake camera: {args.fps:g} fps sensor, {args.open_delay * 1000:.0f} ms open cost, "
+          f"{len(FAKE_FRAME)} byte frames")
+    print()
+
+    v4l2 = FakeV4L2Capture('/dev/fake0', fps=args.fps, open_delay=args.open_delay)
+    report('v4l2', *run(v4l2, args.frames))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        install_fake_fswebcam(tmp, args.fps, args.open_delay)
+        fswebcam = FswebcamCapture('/dev/fake0', skip_frames=args.skip)
+        report('fswebcam', *run(fswebcam, max(5, args.frames // 5)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Change detection benchmark
+
+Generates a synthetic timelapse (a static textured scene with sensor
+noise, a slow brightness drift like dusk, and a few short motion events:
+an object crossing the frame), encodes it to JPEG like a camera would, and
+runs change_detect over it:
+
+- signature cost per frame (decode to the luminance grid, and the
+  comparison), which the capture loop pays on every frame
+- per mode, how many frames and bytes would be stored, and how many of
+  the frames with motion in them were kept
+
+The frames stored is also what a compile has to encode, so it is the
+compile time saved too. With --encode each mode's frames are actually
+encoded with ffmpeg (libx264 ultrafast) and timed.
+
+Usage:
+    python3 bench_change.py [--frames 240] [--width 1920 --height 1080] [--threshold 3] [--encode]
+"""
+
+import io
+import os
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import numpy as np
+from PIL import Image
+
+import change_detect
+from change_detect import ChangeDetector, difference, signature
+
+# Motion events: (first frame, length) as fractions of the sequence
+EVENTS = ((0.2, 0.03), (0.55, 0.05), (0.85, 0.02))
+
+
+def make_sequence(frames, width, height, quality, seed=1):
+    """Synthetic frames as (JPEG bytes, has motion) pairs"""
+    rng = np.random.default_rng(seed)
+    # Smooth large-scale structure plus fine texture
+    coarse = Image.fromarray((rng.random((height // 40, width // 40, 3)) * 255).astype(np.uint8))
+    base = np.asarray(coarse.resize((width, height), Image.BICUBIC), dtype=np.float32)
+    base = np.clip(base * 0.8 + rng.normal(0, 12, base.shape), 0, 255)
+
+    moving = set()
+    for start, length in EVENTS:
+        first = int(start * frames)
+        moving.update(range(first, first + max(1, int(length * frames))))
+
+    sequence = []
+    size = height // 4
+    for n in range(frames):
+        # Brightness falls by a third over the sequence; noise is per frame
+        frame = base * (1 - n / frames / 3) + rng.normal(0, 2.0, base.shape)
+        if n in moving:
+            x = int((n % 12) / 12 * (width - size))
+            frame[height // 3:height // 3 + size, x:x + size] = (235, 225, 200)
+        buf = io.BytesIO()
+        Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8)).save(buf, 'JPEG', quality=quality)
+        sequence.append((buf.getvalue(), n in moving))
+    return sequence
+
+
+def encode_seconds(sequence, keep, workdir):
+    """Time a libx264 ultrafast encode of the kept frames"""
+    paths = []
+    for i, n in enumerate(keep):
+        path = os.path.join(workdir, f"frame_{i:06d}.jpg")
+        with open(path, 'wb') as f:
+            f.write(sequence[n][0])
+        paths.append(path)
+    started = time.perf_counter()
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-framerate', '30', '-i', os.path.join(workdir, 'frame_%06d.jpg'),
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                    os.path.join(workdir, 'out.mp4')], check=True)
+    elapsed = time.perf_counter() - started
+    for path in paths:
+        os.unlink(path)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=240)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the synthetic frames')
+    parser.add_argument('--threshold', type=float, default=change_detect.DEFAULT_THRESHOLD)
+    parser.add_argument('--thin-every', type=int, default=change_detect.DEFAULT_THIN_EVERY)
+    parser.add_argument('--encode', action='store_true', help='also time an ffmpeg encode of each mode\'s frames')
+    args = parser.parse_args()
+
+    print(f"Generating {args.frames} frames of {args.width}x{args.height}...")
+    sequence = make_sequence(args.frames, args.width, args.height, args.quality)
+    total_bytes = sum(len(data) for data, _ in sequence)
+    moving = sum(1 for _, motion in sequence if motion)
+    print(f"{total_bytes / 1024 / 1024:.1f} MB, {moving} frames with motion, backend {change_detect.backend()}")
+    print()
+
+    signature_ms = []
+    signatures = []
+    for data, _ in sequence:
+        started = time.perf_counter()
+        signatures.append(signature(data=data))
+        signature_ms.append((time.perf_counter() - started) * 1000)
+    compare_ms = []
+    for a, b in zip(signatures, signatures[1:]):
+        started = time.perf_counter()
+        difference(a, b)
+        compare_ms.append((time.perf_counter() - started) * 1000)
+    signature_ms.sort()
+    print(f"signature  mean {statistics.mean(signature_ms):6.2f} ms  p95 {signature_ms[int(len(signature_ms) * 0.95)]:6.2f} ms")
+    print(f"compare    mean {statistics.mean(compare_ms):6.3f} ms")
+    print()
+
+    print(f"{'mode':<6} {'stored':>7} {'MB':>7} {'saved':>7} {'motion kept':>12}" + (f" {'encode':>8}" if args.encode else ''))
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in ('off', 'drop', 'thin', 'mark'):
+            detector = ChangeDetector(mode, args.threshold, args.thin_every)
+            keep = []
+            for n, (data, _) in enumerate(sequence):
+                # A marked frame is stored, but left out of a compile that skips them
+                if detector.judge(data=data) == 'keep':
+                    keep.append(n)
+            stored = range(len(sequence)) if mode == 'mark' else keep
+            stored_bytes = sum(len(sequence[n][0]) for n in stored)
+            motion_kept = sum(1 for n in keep if sequence[n][1])
+            line = (f"{mode:<6} {len(stored):>7} {stored_bytes / 1024 / 1024:>7.1f} "
+                    f"{(1 - stored_bytes / total_bytes) * 100:>6.1f}% {motion_kept:>6}/{moving:<5}")
+            if args.encode:
+                line += f" {encode_seconds(sequence, keep, workdir):>7.2f}s"
+            print(line)
+    print()
+    print("stored: frames written to the card; mark stores every frame but a compile with skip_unchanged")
+    print("only encodes the changed ones (what 'motion kept' and 'encode' count)")
+
+
+if __name__ == '__main__':
+    main()
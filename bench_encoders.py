@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Encoder profile benchmark
+
+Encodes the same synthetic frame set with every encoder profile this
+system can use (see encoders.py) and reports encode time, throughput and
+output size, so the profile choice and quality target can be tuned per Pi
+model. Frames are generated once with ffmpeg's testsrc2 pattern and saved
+as JPEGs, like captured frames.
+
+Usage:
+    python3 bench_encoders.py [--frames 120] [--resolution 1920x1080] [--fps 30]
+"""
+
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+from encoders import PROFILES, probe_profiles, select_profile, QUALITY_LEVELS
+from video_builder import run_ffmpeg
+
+
+def make_frames(directory, count, resolution):
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi',
+        '-i', f'testsrc2=size={resolution}:rate=30',
+        '-frames:v', str(count), '-q:v', '3',
+        str(directory / 'frame_%06d.jpg')
+    ], check=True)
+
+
+def encode(frames_dir, output, profile, fps):
+    cmd = ['ffmpeg', '-y', '-framerate', str(fps),
+           '-i', str(frames_dir / 'frame_%06d.jpg')] + PROFILES[profile]['args'] + [str(output)]
+    started = time.monotonic()
+    returncode, error_msg = run_ffmpeg(cmd)
+    return returncode, time.monotonic() - started, error_msg
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=120, help='frames in the synthetic set')
+    parser.add_argument('--resolution', default='1920x1080', help='frame size, WxH')
+    parser.add_argument('--fps', type=int, default=30, help='output frame rate')
+    args = parser.parse_args()
+
+    available = probe_profiles()
+    print("Automatic choice: " + ", ".join(f"{q} -> {select_profile(q)}" for q in QUALITY_LEVELS))
+    print()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        frames_dir = tmp / 'frames'
+        frames_dir.mkdir()
+        make_frames(frames_dir, args.frames, args.resolution)
+        source_bytes = sum(f.stat().st_size for f in frames_dir.iterdir())
+        print(f"{args.frames} frames at {args.resolution}, {source_bytes / 1e6:.1f} MB of JPEGs")
+        print()
+
+        print(f"{'profile':<16} {'quality':<8} {'time':>8} {'frames/s':>9} {'size':>10} {'of JPEGs':>9}")
+        for name in PROFILES:
+            if name not in available:
+                print(f"{name:<16} {'':<8} {'unavailable':>8}")
+                continue
+            output = tmp / f'{name}.mp4'
+            returncode, elapsed, error_msg = encode(frames_dir, output, name, args.fps)
+            if returncode != 0:
+                print(f"{name:<16} failed: {error_msg.strip().splitlines()[-1:]}")
+                continue
+            size = output.stat().st_size
+            print(f"{name:<16} {PROFILES[name]['quality']:<8} {elapsed:7.2f}s "
+                  f"{args.frames / elapsed:9.1f} {size / 1e6:8.2f}MB {size / source_bytes * 100:8.1f}%")
+
+
+if __name__ == '__main__':
+    main()
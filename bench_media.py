@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Media serving benchmark
+
+Serves one large MP4-sized file over loopback and measures, per server
+setup:
+
+- throughput and time to first byte of a full download
+- time to first byte of a seek (a 1 MB Range request from the middle of
+  the file, what the browser's player sends when you scrub)
+- server CPU time per GB sent (read from /proc, so it covers the server
+  process only)
+
+Setups: Flask's send_file and media.send_media on the Flask development
+server, plus send_media under gunicorn (sendfile) when gunicorn is
+installed. Each server runs in its own process.
+
+Usage:
+    python3 bench_media.py [--size-mb 2048] [--file existing.mp4] [--runs 3]
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import http.client
+
+SEEK_LENGTH = 1024 * 1024
+READ_CHUNK = 1024 * 1024
+
+
+def make_app(path):
+    from flask import Flask, send_file
+    from media import send_media
+
+    app = Flask(__name__)
+
+    @app.route('/send_file')
+    def baseline():
+        return send_file(path, mimetype='video/mp4')
+
+    @app.route('/send_media')
+    def media():
+        return send_media(path, 'video/mp4')
+
+    return app
+
+
+# gunicorn imports this module and looks for bench_app
+if os.environ.get('BENCH_MEDIA_FILE'):
+    bench_app = make_app(os.environ['BENCH_MEDIA_FILE'])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_file(path, size_mb):
+    block = os.urandom(4 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        for _ in range(size_mb // 4):
+            f.write(block)
+
+
+def cpu_seconds(pid):
+    """utime + stime of a process and its children so far"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = sum(int(x) for x in fields[11:15])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def start_server(kind, path, port):
+    env = dict(os.environ, BENCH_MEDIA_FILE=path)
+    if kind == 'gunicorn':
+        cmd = ['gunicorn', '-w', '1', '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'bench_media:bench_app']
+    else:
+        cmd = [sys.executable, __file__, '--serve', str(port), '--file', path]
+    process = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{kind} server did not start")
+
+
+def fetch(port, url, headers=None):
+    """GET a URL, discarding the body; returns (seconds to first byte, total seconds, bytes)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    buf = bytearray(READ_CHUNK)
+    started = time.monotonic()
+    conn.request('GET', url, headers=headers or {})
+    response = conn.getresponse()
+    received = response.readinto(buf)
+    first_byte = time.monotonic() - started
+    while True:
+        n = response.readinto(buf)
+        if not n:
+            break
+        received += n
+    total = time.monotonic() - started
+    conn.close()
+    return first_byte, total, received
+
+
+def bench(kind, url, path, size, runs):
+    port = free_port()
+    process = start_server(kind, path, port)
+    try:
+        fetch(port, url, {'Range': 'bytes=0-0'})  # warm up (imports, page cache)
+        cpu_before = cpu_seconds(process.pid)
+        downloads = [fetch(port, url) for _ in range(runs)]
+        cpu = cpu_seconds(process.pid) - cpu_before
+        seeks = []
+        for i in range(runs * 5):
+            start = (size // 2 + i * 7919 * 4096) % max(1, size - SEEK_LENGTH)
+            seeks.append(fetch(port, url, {'Range': f'bytes={start}-{start + SEEK_LENGTH - 1}'}))
+    finally:
+        process.terminate()
+        process.wait()
+
+    for _, _, received in downloads:
+        if received != size:
+            raise RuntimeError(f"{kind} {url}: got {received} of {size} bytes")
+    best = min(total for _, total, _ in downloads)
+    return {
+        'throughput': size / best / 1e6,
+        'ttfb_ms': min(first for first, _, _ in downloads) * 1000,
+        'seek_ms': sorted(first for first, _, _ in seeks)[len(seeks) // 2] * 1000,
+        'cpu_per_gb': cpu / (size * runs / 1e9),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size-mb', type=int, default=2048, help='size of the generated test file')
+    parser.add_argument('--file', help='serve this file instead of generating one')
+    parser.add_argument('--runs', type=int, default=3, help='full downloads per setup')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        # Child process: Flask development server, as app.py runs it
+        make_app(args.file).run(host='127.0.0.1', port=args.serve, threaded=True)
+        return
+
+    setups = [('flask-dev', '/send_file'), ('flask-dev', '/send_media')]
+    if subprocess.run(['which', 'gunicorn'], capture_output=True).returncode == 0:
+        setups.append(('gunicorn', '/send_media'))
+    else:
+        print("gunicorn not installed, skipping the sendfile setup")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if not path:
+            path = os.path.join(tmp, 'bench.mp4')
+            print(f"Writing {args.size_mb} MB test file...")
+            make_file(path, args.size_mb)
+        size = os.path.getsize(path)
+        print(f"Serving {size / 1e6:.0f} MB over loopback, {args.runs} downloads per setup")
+        print()
+        print(f"{'server':<10} {'handler':<12} {'MB/s':>8} {'TTFB':>8} {'seek TTFB':>10} {'CPU s/GB':>9}")
+        for kind, url in setups:
+            result = bench(kind, url, path, size, args.runs)
+            print(f"{kind:<10} {url.lstrip('/'):<12} {result['throughput']:8.0f} {result['ttfb_ms']:6.1f}ms "
+                  f"{result['seek_ms']:8.1f}ms {result['cpu_per_gb']:9.2f}")
+
+
+if __name__ == '__main__':
+    main()
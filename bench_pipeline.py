@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Post-processing pipeline benchmark
+
+Writes a synthetic session (a textured scene whose exposure jumps every
+few frames, like auto exposure hunting) to a temporary frame store and
+runs a frame_pipeline over it:
+
+- serial: every frame rendered one after another in this process
+- pool: process_session, rendered in the process pool, then again with
+  everything cached (what a recompile costs)
+- flicker before and after deflicker (standard deviation of the
+  frame-to-frame change in mean luminance)
+- peak memory of this process, to check it doesn't grow with --frames
+
+Usage:
+    python3 bench_pipeline.py [--frames 200] [--width 1920 --height 1080] [--workers N]
+"""
+
+import io
+import time
+import argparse
+import resource
+import tempfile
+import statistics
+
+import numpy as np
+from PIL import Image
+
+import process_pool
+from frame_store import FrameStore
+from frame_pipeline import FramePipeline, luminance, process_session
+
+STAGES = [
+    {"stage": "crop", "box": [0, 60, 1920, 960]},
+    {"stage": "resize", "width": 1280},
+    {"stage": "deflicker", "window": 15},
+    {"stage": "timestamp"},
+    {"stage": "rotate", "degrees": 180},
+]
+
+
+def make_session(store, session_id, frames, width, height, quality, seed=1):
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray((rng.random((height // 40, width // 40, 3)) * 255).astype(np.uint8))
+    base = np.asarray(coarse.resize((width, height), Image.BICUBIC), dtype=np.float32) * 0.7 + 30
+    store.create(session_id)
+    started = time.time()
+    for n in range(frames):
+        # Exposure steps of up to +-20% every few frames
+        gain = 1.0 + (rng.random() - 0.5) * 0.4 if n % 4 == 0 else 1.0
+        buf = io.BytesIO()
+        Image.fromarray(np.clip(base * gain + rng.normal(0, 3, base.shape), 0, 255).astype(np.uint8)).save(
+            buf, 'JPEG', quality=quality)
+        store.path_for_write(session_id, n).write_bytes(buf.getvalue())
+        store.add(session_id, n, len(buf.getvalue()), started + n * 60)
+
+
+def flicker(paths):
+    values = [luminance(path) for path in paths]
+    return statistics.pstdev(b - a for a, b in zip(values, values[1:]))
+
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the synthetic frames')
+    parser.add_argument('--serial-frames', type=int, default=20, help='frames timed in the serial run')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        store = FrameStore(f"{workdir}/images")
+        print(f"Generating {args.frames} frames of {args.width}x{args.height}...")
+        make_session(store, 'bench', args.frames, args.width, args.height, args.quality)
+        pipeline = FramePipeline(STAGES)
+        print(f"Stages: {', '.join(stage['stage'] for stage in STAGES)}")
+        print()
+
+        records = store.frames('bench')[:args.serial_frames]
+        started = time.perf_counter()
+        for frame_number, _, captured_at in records:
+            pipeline.render(store.frame_path('bench', frame_number), captured_at, 1.05)
+        serial = (time.perf_counter() - started) / len(records)
+        print(f"serial   {serial * 1000:7.1f} ms/frame  {1 / serial:6.1f} frames/s")
+
+        memory_before = peak_mb()
+        process_pool.get_pool(args.workers)
+        started = time.perf_counter()
+        paths, stats = process_session(store, 'bench', pipeline, f"{workdir}/processed")
+        elapsed = time.perf_counter() - started
+        print(f"pool     {elapsed / args.frames * 1000:7.1f} ms/frame  {args.frames / elapsed:6.1f} frames/s  "
+              f"({process_pool.size()} worker(s), {stats['rendered']} rendered)")
+
+        started = time.perf_counter()
+        _, stats = process_session(store, 'bench', pipeline, f"{workdir}/processed")
+        print(f"cached   {(time.perf_counter() - started) * 1000:7.1f} ms total  ({stats['reused']} reused)")
+        print(f"peak memory {peak_mb():.0f} MB (before processing {memory_before:.0f} MB)")
+        print()
+
+        sources = [store.frame_path('bench', n) for n, _, _ in store.frames('bench')]
+        print(f"flicker  {flicker(sources):5.2f} -> {flicker(paths):5.2f} (std of frame-to-frame luminance change)")
+
+
+if __name__ == '__main__':
+    main()
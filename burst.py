@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Burst and HDR capture
+
+Takes several frames per timelapse slot from the session's open camera
+and merges them into the one frame that is stored:
+
+    average   burst_frames frames in a row, mean-stacked: sensor noise
+              drops by about the square root of the number of frames, which
+              is what makes night frames from cheap USB cameras usable
+    hdr       one frame per exposure_time_absolute value (a bracket around
+              the camera's current exposure unless burst_exposures lists
+              them), merged by exposure fusion (Mertens et al.: each pixel
+              weighted by how well exposed, saturated and contrasty it is,
+              blended over a Laplacian pyramid so there are no seams)
+
+Grabbing the burst is all the capture loop waits for. Merging is NumPy
+work on full-size frames, so it runs in the shared process pool (see
+process_pool.py) and the results are stored in capture order, from the
+session's own delivery thread, as they come back. If merging falls
+behind, a slot's reference frame (the first one, or the middle exposure)
+is stored unmerged instead of letting the backlog grow.
+"""
+
+import io
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import process_pool
+
+BURST_MODES = ('off', 'average', 'hdr')
+DEFAULT_BURST_FRAMES = 4
+MAX_BURST_FRAMES = 16
+# Bracket around the current exposure when no exposures are configured
+DEFAULT_BRACKET = (0.25, 1.0, 4.0)
+# Frames thrown away after an exposure change, which may have been
+# exposed partly with the old setting
+SETTLE_FRAMES = 1
+DEFAULT_QUALITY = 92
+# Merges queued per pool process before slots are stored unmerged
+BACKLOG_PER_WORKER = 2
+# V4L2 auto_exposure menu value for manual exposure
+MANUAL_EXPOSURE = 1
+
+# Exposure fusion: spread of the well-exposedness weight around mid-grey
+_WELL_EXPOSED_SIGMA = 0.2
+_PYRAMID_MIN_SIZE = 16
+
+
+def available():
+    """Whether frames can be merged here (needs NumPy and Pillow)"""
+    return np is not None and Image is not None
+
+
+def _decode(data):
+    with Image.open(io.BytesIO(data)) as im:
+        return np.asarray(im.convert('RGB'), dtype=np.float32)
+
+
+def _encode(pixels, quality):
+    buf = io.BytesIO()
+    Image.fromarray(np.clip(pixels + 0.5, 0, 255).astype(np.uint8)).save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+def mean_stack(frames):
+    """Mean of a burst of JPEG frames, as float32 pixels (0-255)"""
+    total = None
+    for data in frames:
+        pixels = _decode(data)
+        if total is None:
+            total = pixels
+        elif pixels.shape != total.shape:
+            raise ValueError(f"Frame size changed within the burst ({pixels.shape} vs {total.shape})")
+        else:
+            total += pixels
+    return total / len(frames)
+
+
+def _down(image):
+    """Half size, 2x2 box filter"""
+    h, w = image.shape[0] // 2 * 2, image.shape[1] // 2 * 2
+    image = image[:h, :w]
+    return (image[0::2, 0::2] + image[1::2, 0::2] + image[0::2, 1::2] + image[1::2, 1::2]) * 0.25
+
+
+def _up(image, shape):
+    """Double size (to exactly `shape`), nearest neighbour"""
+    up = image.repeat(2, axis=0).repeat(2, axis=1)
+    pad = [(0, max(0, shape[0] - up.shape[0])), (0, max(0, shape[1] - up.shape[1]))]
+    pad += [(0, 0)] * (up.ndim - 2)
+    return np.pad(up, pad, mode='edge')[:shape[0], :shape[1]]
+
+
+def _fusion_weights(pixels):
+    """Mertens weight map of one exposure (pixels scaled 0-1)"""
+    grey = pixels.mean(axis=2)
+    padded = np.pad(grey, 1, mode='edge')
+    contrast = np.abs(4 * grey - padded[:-2, 1:-1] - padded[2:, 1:-1] - padded[1:-1, :-2] - padded[1:-1, 2:])
+    saturation = pixels.std(axis=2)
+    exposedness = np.exp(-((pixels - 0.5) ** 2) / (2 * _WELL_EXPOSED_SIGMA ** 2)).prod(axis=2)
+    return contrast * saturation * exposedness + 1e-12
+
+
+def exposure_fusion(frames):
+    """Fuse an exposure bracket of JPEG frames, as float32 pixels (0-255)"""
+    images = [_decode(data) / 255.0 for data in frames]
+    shape = images[0].shape
+    if any(image.shape != shape for image in images):
+        raise ValueError("Frame size changed within the bracket")
+    weights = [_fusion_weights(image) for image in images]
+    total = sum(weights)
+    weights = [w / total for w in weights]
+
+    levels = 1
+    size = min(shape[:2])
+    while size // 2 >= _PYRAMID_MIN_SIZE and levels < 6:
+        size //= 2
+        levels += 1
+
+    blended = None
+    for image, weight in zip(images, weights):
+        # Laplacian pyramid of the image, Gaussian pyramid of its weight
+        layers = []
+        for _ in range(levels - 1):
+            smaller = _down(image)
+            layers.append((image - _up(smaller, image.shape), weight))
+            image, weight = smaller, _down(weight)
+        layers.append((image, weight))
+        contribution = [detail * w[..., None] for detail, w in layers]
+        blended = contribution if blended is None else [b + c for b, c in zip(blended, contribution)]
+
+    result = blended[-1]
+    for detail in reversed(blended[:-1]):
+        result = _up(result, detail.shape) + detail
+    return result * 255.0
+
+
+def merge_frames(frames, mode, quality=DEFAULT_QUALITY):
+    """Merge a burst into one JPEG
+
+    Args:
+        frames: JPEG frames (an hdr bracket in any exposure order)
+        mode: 'average' or 'hdr'
+
+    Returns:
+        bytes: JPEG
+    """
+    if len(frames) == 1:
+        return frames[0]
+    pixels = exposure_fusion(frames) if mode == 'hdr' else mean_stack(frames)
+    return _encode(pixels, quality)
+
+
+def _merge_job(frames, mode, quality):
+    """Pool entry point: (JPEG, seconds spent merging)"""
+    started = time.perf_counter()
+    return merge_frames(frames, mode, quality), time.perf_counter() - started
+
+
+def bracket_exposures(controls, exposures=None):
+    """Exposure values of an hdr bracket, darkest first
+
+    Args:
+        controls: DeviceControls of the camera (v4l2_controls)
+        exposures: Configured exposure_time_absolute values, or None for
+                   DEFAULT_BRACKET around the camera's current exposure
+
+    Returns:
+        list of ints within the control's range, or None if the camera
+        has no exposure_time_absolute control
+    """
+    if controls is None or not controls.has('exposure_time_absolute'):
+        return None
+    control = controls.describe()['exposure_time_absolute']
+    if not exposures:
+        current = controls.refresh(['exposure_time_absolute']).get('exposure_time_absolute') \
+            or control['value'] or control['default']
+        exposures = [current * factor for factor in DEFAULT_BRACKET]
+    low = control['min'] if control['min'] is not None else 1
+    high = control['max'] if control['max'] is not None else max(exposures)
+    return sorted({int(min(max(value, low), high)) for value in exposures})
+
+
+def grab_burst(backend, count, exposures=None, controls=None):
+    """Grab the frames of one slot from an open capture backend
+
+    Args:
+        backend: Open capture backend (see capture_backends)
+        count: Frames to grab when there is no bracket
+        exposures: exposure_time_absolute values to bracket, or None
+        controls: DeviceControls to set the exposures with
+
+    Returns:
+        list of JPEG bytes (in exposure order for a bracket)
+
+    Raises:
+        CaptureError: The camera didn't deliver a frame
+    """
+    if not exposures:
+        return [backend.grab() for _ in range(count)]
+
+    saved = controls.values(['auto_exposure', 'exposure_time_absolute'])
+    frames = []
+    try:
+        for exposure in exposures:
+            _, errors, _ = controls.set({'auto_exposure': MANUAL_EXPOSURE, 'exposure_time_absolute': exposure})
+            if errors:
+                print(f"[Burst] Could not set exposure {exposure} on {backend.device}: {errors}")
+            for _ in range(SETTLE_FRAMES):
+                backend.grab()
+            frames.append(backend.grab())
+    finally:
+        # Back to how the camera was set (auto exposure included)
+        controls.set(saved)
+    return frames
+
+
+class BurstMerger:
+    """Merges one session's bursts in the process pool, handing results back in capture order"""
+
+    def __init__(self, mode, frames=DEFAULT_BURST_FRAMES, exposures=None, workers=None,
+                 quality=DEFAULT_QUALITY, on_merged=None, name='burst'):
+        """
+        Args:
+            mode: 'average' or 'hdr'
+            frames: Frames per burst for 'average'
+            exposures: Configured hdr exposures (None: bracket the current one)
+            workers: Pool processes (see process_pool.get_pool)
+            on_merged: callable(frame_number, jpeg, context) run for each
+                       slot on the merger's delivery thread, in the order
+                       the slots were submitted
+            name: Names the delivery thread (e.g. after the session)
+        """
+        if mode not in BURST_MODES or mode == 'off':
+            raise ValueError(f"Unknown burst mode {mode!r}, use one of {', '.join(BURST_MODES[1:])}")
+        self.mode = mode
+        self.frames = max(1, min(int(frames), MAX_BURST_FRAMES))
+        self.exposures = exposures
+        self.quality = quality
+        self.on_merged = on_merged
+        self._pool = process_pool.get_pool(workers)
+        self.workers = process_pool.size()
+        self._delivery = process_pool.OrderedDelivery(self._deliver, f"burst-{name}")
+        self.merged = 0
+        self.unmerged = 0
+        self.failed = 0
+        self.merge_seconds = 0.0
+
+    def reference(self, frames):
+        """The frame of a burst that stands for it (change detection, fallback)"""
+        return frames[len(frames) // 2] if self.mode == 'hdr' else frames[0]
+
+    def pending(self):
+        return self._delivery.pending()
+
+    def submit(self, frame_number, frames, context=None):
+        """Queue a slot's burst; on_merged gets the merged frame when it is its turn
+
+        Never blocks: if the pool is behind, the slot's reference frame is
+        passed on unmerged.
+        """
+        backlog = self.pending()
+        if len(frames) == 1 or backlog >= self.workers * BACKLOG_PER_WORKER:
+            if len(frames) > 1:
+                print(f"[Burst] Merging behind ({backlog} queued), storing frame {frame_number} unmerged")
+            future = process_pool.ready((self.reference(frames), None))
+        else:
+            try:
+                future = self._pool.submit(_merge_job, frames, self.mode, self.quality)
+            except RuntimeError as e:  # pool shut down or broken
+                print(f"[Burst] Merge pool unavailable ({e}), storing frame {frame_number} unmerged")
+                future = process_pool.ready((self.reference(frames), None))
+        self._delivery.submit(frame_number, future, (frames, context))
+
+    def _deliver(self, frame_number, future, context):
+        # On the delivery thread, strictly in submit order, whichever merge
+        # finishes first
+        frames, context = context
+        try:
+            jpeg, seconds = future.result()
+            if seconds is None:
+                self.unmerged += 1
+            else:
+                self.merged += 1
+                self.merge_seconds += seconds
+        except Exception as e:
+            print(f"[Burst] Could not merge frame {frame_number} ({e}), storing it unmerged")
+            self.failed += 1
+            jpeg = self.reference(frames)
+        try:
+            if self.on_merged:
+                self.on_merged(frame_number, jpeg, context)
+        except Exception as e:
+            print(f"[Burst] ERROR: Storing frame {frame_number} failed: {e}")
+
+    def drain(self, timeout=None):
+        """Wait until every submitted slot has been handed on
+
+        Returns:
+            bool: False if some were still pending at the timeout
+        """
+        return self._delivery.drain(timeout)
+
+    def close(self):
+        """Stop the delivery thread; slots not handed on by now are dropped
+
+        Returns:
+            int: Slots dropped
+        """
+        return self._delivery.close()
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "frames": self.frames if self.mode == 'average' else None,
+            "exposures": self.exposures,
+            "workers": self.workers,
+            "pending": self.pending(),
+            "merged": self.merged,
+            "unmerged": self.unmerged,
+            "failed": self.failed,
+            "merge_ms": round(self.merge_seconds / self.merged * 1000, 1) if self.merged else None,
+        }
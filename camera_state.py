@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Camera state service
+
+A background thread owns camera detection. It scans once at startup and
+again only when /dev/video* nodes appear or disappear (inotify on /dev,
+falling back to a cheap directory poll), or when a refresh is requested.
+Everything else reads the latest in-memory snapshot, so status requests
+never touch the hardware or spawn processes. Each scan also brings the
+V4L2 control registry (v4l2_controls.py) up to date, so a camera's
+controls are listed once, when it appears.
+
+Cameras held open, by this process or (see set_open_elsewhere) by the
+capture daemon, are never probed: a test capture would fail on them with
+EBUSY, or disturb the session streaming from them.
+"""
+
+import os
+import errno
+import shutil
+import select
+import struct
+import ctypes
+import threading
+import subprocess
+import time
+from pathlib import Path
+
+import capture_backends
+import v4l2_controls
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+# udev creates the node first and fixes permissions a moment later, and a
+# camera usually registers several nodes at once, so wait for things to
+# settle before probing
+HOTPLUG_SETTLE_SECONDS = 1.0
+POLL_INTERVAL_SECONDS = 5.0
+
+
+def _video_nodes():
+    return sorted(str(p) for p in Path('/dev').glob('video*'))
+
+
+def probe_usb_device(device):
+    """Check whether a /dev/video* node is a camera that can actually capture
+
+    Returns:
+        dict with 'device' and 'name', or None if the node can't capture
+    """
+    result = subprocess.run(
+        ['v4l2-ctl', '--device', device, '--all'],
+        capture_output=True,
+        timeout=1,
+        text=True
+    )
+
+    # Must have Video Capture capability
+    if 'Video Capture' not in result.stdout:
+        return None
+
+    # Extract device name
+    device_name = device.split('/')[-1]
+    for line in result.stdout.split('\n'):
+        if 'Card type' in line or 'Device name' in line:
+            parts = line.split(':', 1)
+            if len(parts) > 1:
+                device_name = parts[1].strip()
+                break
+
+    # Test if fswebcam can actually capture from this device
+    # This is the key test - some devices show as "Video Capture" but can't capture
+    test_result = subprocess.run(
+        ['fswebcam', '-d', device, '-r', '640x480', '--no-banner', '-'],
+        capture_output=True,
+        timeout=3
+    )
+
+    # If fswebcam succeeded and produced output, this device works
+    if test_result.returncode == 0 and len(test_result.stdout) > 1000:
+        return {'device': device, 'name': device_name}
+    return None
+
+
+class CameraStateService:
+    """Owns camera detection and publishes an immutable snapshot"""
+
+    def __init__(self):
+        self._snapshot = {
+            'devices': [],
+            'camera_type': None,
+            'camera_available': False,
+            'scanned_at': None,
+            'scan_count': 0,
+            'hotplug': None,
+        }
+        self._lock = threading.Lock()
+        self._scan_done = threading.Condition(self._lock)
+        self._thread = None
+        self._listeners = []
+        self._open_elsewhere = None
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+
+    # -- reading --
+
+    def snapshot(self):
+        """Latest camera state (never blocks on hardware)"""
+        if self._thread is None:
+            self.start()
+        return self._snapshot
+
+    def devices(self):
+        return self.snapshot()['devices']
+
+    def camera_type(self):
+        return self.snapshot()['camera_type']
+
+    # -- control --
+
+    def add_listener(self, callback):
+        """Call callback(snapshot) from the service thread whenever the cameras change"""
+        self._listeners.append(callback)
+
+    def set_open_elsewhere(self, source):
+        """Tell scans about cameras another process holds open
+
+        Args:
+            source: callable() returning a list of {'device', 'name'} dicts,
+                    asked at each scan
+        """
+        self._open_elsewhere = source
+
+    def start(self):
+        """Start the service thread if it isn't running yet"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='camera-state', daemon=True)
+            self._thread.start()
+
+    def wait_ready(self, timeout=30):
+        """Block until the first scan has completed"""
+        self.start()
+        with self._scan_done:
+            self._scan_done.wait_for(lambda: self._snapshot['scan_count'] >= 1, timeout)
+        return self._snapshot
+
+    def refresh(self, wait=True, timeout=30):
+        """Ask for a rescan now (e.g. the user pressed Refresh)
+
+        Args:
+            wait: Block until the rescan has finished
+            timeout: Maximum seconds to wait
+
+        Returns:
+            The snapshot after the rescan (or the current one if not waiting)
+        """
+        self.start()
+        with self._lock:
+            target = self._snapshot['scan_count'] + 1
+        os.write(self._wake_w, b'r')
+        if wait:
+            with self._scan_done:
+                self._scan_done.wait_for(lambda: self._snapshot['scan_count'] >= target, timeout)
+        return self._snapshot
+
+    # -- service thread --
+
+    def _scan(self):
+        print("[Device Detection] Scanning for cameras...")
+        previous = {d['device']: d for d in self._snapshot['devices']}
+        devices = []
+        held = {device: {'device': device, 'name': device.split('/')[-1]}
+                for device in capture_backends.open_devices}
+        if self._open_elsewhere is not None:
+            try:
+                held.update((d['device'], d) for d in self._open_elsewhere())
+            except Exception as e:
+                print(f"[Device Detection] Could not ask which cameras are in use: {e}")
+
+        for device in _video_nodes():
+            if device in held:
+                # Held open by a running session (or the preview), so it obviously works
+                devices.append(previous.get(device, held[device]))
+                continue
+            try:
+                info = probe_usb_device(device)
+                if info:
+                    devices.append(info)
+                    print(f"[Device Detection] Found working camera: {device} ({info['name']})")
+                else:
+                    print(f"[Device Detection] Skipping {device} - not a working capture device")
+            except Exception as e:
+                print(f"[Device Detection] Error checking {device}: {e}")
+
+        if devices:
+            camera_type = 'usb'
+        elif shutil.which('libcamera-still'):
+            camera_type = 'libcamera'
+        else:
+            camera_type = None
+
+        print(f"[Device Detection] Scan complete. Found {len(devices)} working camera(s)")
+
+        v4l2_controls.registry.sync(devices)
+
+        previous_state = (self._snapshot['devices'], self._snapshot['camera_type'])
+
+        with self._lock:
+            self._snapshot = {
+                'devices': devices,
+                'camera_type': camera_type,
+                'camera_available': camera_type is not None,
+                'scanned_at': time.time(),
+                'scan_count': self._snapshot['scan_count'] + 1,
+                'hotplug': self._snapshot['hotplug'],
+            }
+            self._scan_done.notify_all()
+
+        if (devices, camera_type) != previous_state:
+            for callback in self._listeners:
+                try:
+                    callback(self._snapshot)
+                except Exception as e:
+                    print(f"[Device Detection] Listener error: {e}")
+
+    def _set_hotplug_mode(self, mode):
+        with self._lock:
+            self._snapshot = dict(self._snapshot, hotplug=mode)
+
+    def _drain_wake_pipe(self):
+        try:
+            while os.read(self._wake_r, 64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _run(self):
+        self._scan()
+        try:
+            self._run_inotify()
+        except OSError as e:
+            print(f"[Device Detection] inotify unavailable ({e}), polling /dev every {POLL_INTERVAL_SECONDS:g}s")
+            self._run_polling()
+
+    def _run_inotify(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        mask = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, b'/dev', mask) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err))
+
+        self._set_hotplug_mode('inotify')
+        pending_since = None
+        while True:
+            timeout = None
+            if pending_since is not None:
+                timeout = max(0.0, pending_since + HOTPLUG_SETTLE_SECONDS - time.monotonic())
+            readable, _, _ = select.select([fd, self._wake_r], [], [], timeout)
+
+            if fd in readable and self._video_events(fd):
+                pending_since = time.monotonic()
+                print("[Device Detection] /dev/video* changed, rescanning shortly")
+            if self._wake_r in readable:
+                self._drain_wake_pipe()
+                pending_since = None
+                self._scan()
+                continue
+            if pending_since is not None and time.monotonic() - pending_since >= HOTPLUG_SETTLE_SECONDS:
+                pending_since = None
+                self._scan()
+
+    @staticmethod
+    def _video_events(fd):
+        """Read queued inotify events and report whether any concern video nodes"""
+        changed = False
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                _, _, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + name_len]
+                if name.startswith(b'video'):
+                    changed = True
+                offset += _EVENT_HEADER.size + name_len
+
+    def _run_polling(self):
+        self._set_hotplug_mode('poll')
+        known = _video_nodes()
+        while True:
+            readable, _, _ = select.select([self._wake_r], [], [], POLL_INTERVAL_SECONDS)
+            if readable:
+                self._drain_wake_pipe()
+                known = _video_nodes()
+                self._scan()
+                continue
+            current = _video_nodes()
+            if current != known:
+                known = current
+                time.sleep(HOTPLUG_SETTLE_SECONDS)
+                self._scan()
+
+
+camera_service = CameraStateService()
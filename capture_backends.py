@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Camera capture backends
+
+V4L2Capture keeps a USB camera open for the whole session using mmap'd
+V4L2 streaming buffers and hands back the camera's own MJPEG frames, so a
+capture costs one buffer dequeue instead of a full fswebcam start-up.
+FswebcamCapture is the original one-process-per-frame path, kept as a
+fallback for cameras that can't stream MJPEG.
+"""
+
+import os
+import mmap
+import time
+import fcntl
+import ctypes
+import select
+import errno
+import subprocess
+
+# ---------------------------------------------------------------------------
+# V4L2 ABI (linux/videodev2.h)
+# ---------------------------------------------------------------------------
+
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+
+def _ioc(direction, nr, struct_type):
+    return (direction << 30) | (ctypes.sizeof(struct_type) << 16) | (ord('V') << 8) | nr
+
+
+def _fourcc(code):
+    return ord(code[0]) | (ord(code[1]) << 8) | (ord(code[2]) << 16) | (ord(code[3]) << 24)
+
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_ANY = 0
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_STREAMING = 0x04000000
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_PIX_FMT_MJPEG = _fourcc('MJPG')
+V4L2_PIX_FMT_JPEG = _fourcc('JPEG')
+
+
+class v4l2_capability(ctypes.Structure):
+    _fields_ = [
+        ('driver', ctypes.c_char * 16),
+        ('card', ctypes.c_char * 32),
+        ('bus_info', ctypes.c_char * 32),
+        ('version', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('device_caps', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 3),
+    ]
+
+
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [
+        ('width', ctypes.c_uint32),
+        ('height', ctypes.c_uint32),
+        ('pixelformat', ctypes.c_uint32),
+        ('field', ctypes.c_uint32),
+        ('bytesperline', ctypes.c_uint32),
+        ('sizeimage', ctypes.c_uint32),
+        ('colorspace', ctypes.c_uint32),
+        ('priv', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('ycbcr_enc', ctypes.c_uint32),
+        ('quantization', ctypes.c_uint32),
+        ('xfer_func', ctypes.c_uint32),
+    ]
+
+
+class _v4l2_format_union(ctypes.Union):
+    # The kernel union also holds v4l2_window, which contains pointers, so
+    # it is pointer-aligned; _align reproduces that on 32 and 64 bit.
+    _fields_ = [
+        ('pix', v4l2_pix_format),
+        ('raw_data', ctypes.c_uint8 * 200),
+        ('_align', ctypes.c_void_p),
+    ]
+
+
+class v4l2_format(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('fmt', _v4l2_format_union),
+    ]
+
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [
+        ('count', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('memory', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('flags', ctypes.c_uint8),
+        ('reserved', ctypes.c_uint8 * 3),
+    ]
+
+
+class timeval(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec', ctypes.c_long),
+        ('tv_usec', ctypes.c_long),
+    ]
+
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('frames', ctypes.c_uint8),
+        ('seconds', ctypes.c_uint8),
+        ('minutes', ctypes.c_uint8),
+        ('hours', ctypes.c_uint8),
+        ('userbits', ctypes.c_uint8 * 4),
+    ]
+
+
+class _v4l2_buffer_m(ctypes.Union):
+    _fields_ = [
+        ('offset', ctypes.c_uint32),
+        ('userptr', ctypes.c_ulong),
+        ('planes', ctypes.c_void_p),
+        ('fd', ctypes.c_int32),
+    ]
+
+
+class v4l2_buffer(ctypes.Structure):
+    _fields_ = [
+        ('index', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('bytesused', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('field', ctypes.c_uint32),
+        ('timestamp', timeval),
+        ('timecode', v4l2_timecode),
+        ('sequence', ctypes.c_uint32),
+        ('memory', ctypes.c_uint32),
+        ('m', _v4l2_buffer_m),
+        ('length', ctypes.c_uint32),
+        ('reserved2', ctypes.c_uint32),
+        ('request_fd', ctypes.c_int32),
+    ]
+
+
+VIDIOC_QUERYCAP = _ioc(_IOC_READ, 0, v4l2_capability)
+VIDIOC_S_FMT = _ioc(_IOC_READ | _IOC_WRITE, 5, v4l2_format)
+VIDIOC_REQBUFS = _ioc(_IOC_READ | _IOC_WRITE, 8, v4l2_requestbuffers)
+VIDIOC_QUERYBUF = _ioc(_IOC_READ | _IOC_WRITE, 9, v4l2_buffer)
+VIDIOC_QBUF = _ioc(_IOC_READ | _IOC_WRITE, 15, v4l2_buffer)
+VIDIOC_DQBUF = _ioc(_IOC_READ | _IOC_WRITE, 17, v4l2_buffer)
+VIDIOC_STREAMON = _ioc(_IOC_WRITE, 18, ctypes.c_int)
+VIDIOC_STREAMOFF = _ioc(_IOC_WRITE, 19, ctypes.c_int)
+
+# ---------------------------------------------------------------------------
+# MJPEG helpers
+# ---------------------------------------------------------------------------
+
+# Many UVC cameras send "AVI1" MJPEG frames without Huffman tables and rely
+# on the decoder using the defaults from the JPEG spec (Annex K.3). Browsers
+# and most image viewers don't, so the tables are inserted before saving.
+_STD_HUFFMAN_TABLES = [
+    # (class/id, bits, values)
+    (0x00, [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], list(range(12))),
+    (0x10, [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d], [
+        0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+        0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08, 0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+        0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+        0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+        0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+        0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+        0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+        0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+        0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+        0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+        0xf9, 0xfa,
+    ]),
+    (0x01, [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0], list(range(12))),
+    (0x11, [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77], [
+        0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21, 0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+        0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91, 0xa1, 0xb1, 0xc1, 0x09, 0x23, 0x33, 0x52, 0xf0,
+        0x15, 0x62, 0x72, 0xd1, 0x0a, 0x16, 0x24, 0x34, 0xe1, 0x25, 0xf1, 0x17, 0x18, 0x19, 0x1a, 0x26,
+        0x27, 0x28, 0x29, 0x2a, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+        0x49, 0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+        0x69, 0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+        0x88, 0x89, 0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5,
+        0xa6, 0xa7, 0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3,
+        0xc4, 0xc5, 0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda,
+        0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+        0xf9, 0xfa,
+    ]),
+]
+
+
+def _build_dht_segment():
+    payload = bytearray()
+    for table_id, bits, values in _STD_HUFFMAN_TABLES:
+        payload.append(table_id)
+        payload.extend(bits)
+        payload.extend(values)
+    length = len(payload) + 2
+    return b'\xff\xc4' + bytes([length >> 8, length & 0xff]) + bytes(payload)
+
+
+_DHT_SEGMENT = _build_dht_segment()
+
+
+def add_huffman_tables(jpeg):
+    """Return a JPEG that is safe to save as a standalone .jpg
+
+    Inserts the standard Huffman tables in front of the scan if the frame
+    doesn't carry its own; frames that already have them are returned as-is.
+    """
+    sos = jpeg.find(b'\xff\xda')
+    if sos == -1 or jpeg.find(b'\xff\xc4', 0, sos) != -1:
+        return jpeg
+    return jpeg[:sos] + _DHT_SEGMENT + jpeg[sos:]
+
+
+# ---------------------------------------------------------------------------
+# Backends
+# ---------------------------------------------------------------------------
+
+class CaptureError(Exception):
+    """Raised when a backend can't open the camera or deliver a frame"""
+
+
+# Devices currently held open by a V4L2Capture in this process. Device
+# detection must not probe these (the probe would fail with EBUSY and the
+# camera would look unplugged mid-session).
+open_devices = set()
+
+
+class V4L2Capture:
+    """Persistent V4L2 streaming capture with MJPEG passthrough
+
+    The device is opened once, the driver keeps filling a small ring of
+    mmap'd buffers, and grab() returns the freshest JPEG the camera has
+    produced. Because the stream runs continuously the camera's own auto
+    exposure keeps converging between grabs, so no warm-up frames are thrown
+    away per capture (only once, when the stream is started).
+    """
+
+    name = 'v4l2'
+
+    def __init__(self, device, resolution=(1920, 1080), buffer_count=4, warmup_frames=5):
+        self.device = device
+        self.resolution = tuple(resolution)
+        self.buffer_count = buffer_count
+        self.warmup_frames = warmup_frames
+        self.fd = None
+        self.buffers = []
+        self.streaming = False
+        self.actual_resolution = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # -- low level hooks (overridden by the fake device in bench_capture.py) --
+
+    def _ioctl(self, request, arg):
+        while True:
+            try:
+                return fcntl.ioctl(self.fd, request, arg)
+            except InterruptedError:
+                continue
+
+    def _open_device(self):
+        self.fd = os.open(self.device, os.O_RDWR | os.O_NONBLOCK)
+
+        cap = v4l2_capability()
+        self._ioctl(VIDIOC_QUERYCAP, cap)
+        caps = cap.device_caps if cap.capabilities & V4L2_CAP_DEVICE_CAPS else cap.capabilities
+        if not caps & V4L2_CAP_VIDEO_CAPTURE:
+            raise CaptureError(f"{self.device} is not a video capture device")
+        if not caps & V4L2_CAP_STREAMING:
+            raise CaptureError(f"{self.device} does not support streaming I/O")
+
+        fmt = v4l2_format()
+        fmt.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        fmt.fmt.pix.width = self.resolution[0]
+        fmt.fmt.pix.height = self.resolution[1]
+        fmt.fmt.pix.pixelformat = V4L2_PIX_FMT_MJPEG
+        fmt.fmt.pix.field = V4L2_FIELD_ANY
+        self._ioctl(VIDIOC_S_FMT, fmt)
+        # The driver rewrites the struct with what it actually chose
+        if fmt.fmt.pix.pixelformat not in (V4L2_PIX_FMT_MJPEG, V4L2_PIX_FMT_JPEG):
+            raise CaptureError(f"{self.device} does not support MJPEG capture")
+        self.actual_resolution = (fmt.fmt.pix.width, fmt.fmt.pix.height)
+
+        req = v4l2_requestbuffers()
+        req.count = self.buffer_count
+        req.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        req.memory = V4L2_MEMORY_MMAP
+        self._ioctl(VIDIOC_REQBUFS, req)
+        if req.count < 2:
+            raise CaptureError(f"{self.device} gave us only {req.count} buffer(s)")
+
+        for index in range(req.count):
+            buf = v4l2_buffer()
+            buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+            buf.memory = V4L2_MEMORY_MMAP
+            buf.index = index
+            self._ioctl(VIDIOC_QUERYBUF, buf)
+            self.buffers.append(mmap.mmap(self.fd, buf.length, mmap.MAP_SHARED,
+                                          mmap.PROT_READ | mmap.PROT_WRITE,
+                                          offset=buf.m.offset))
+
+        for index in range(len(self.buffers)):
+            self._queue(index)
+
+        buf_type = ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        self._ioctl(VIDIOC_STREAMON, buf_type)
+        self.streaming = True
+        open_devices.add(self.device)
+
+    def _close_device(self):
+        if self.streaming:
+            try:
+                self._ioctl(VIDIOC_STREAMOFF, ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+            except OSError:
+                pass
+            self.streaming = False
+        for buf in self.buffers:
+            try:
+                buf.close()
+            except Exception:
+                pass
+        self.buffers = []
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        open_devices.discard(self.device)
+
+    def _wait_readable(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        return bool(readable)
+
+    def _dequeue(self):
+        """Dequeue one filled buffer; returns (index, bytesused) or None if none are ready"""
+        buf = v4l2_buffer()
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+        try:
+            self._ioctl(VIDIOC_DQBUF, buf)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return None
+            raise
+        return buf.index, buf.bytesused
+
+    def _queue(self, index):
+        buf = v4l2_buffer()
+        buf.type = V4L2_BUF_TYPE_VIDEO_CAPTURE
+        buf.memory = V4L2_MEMORY_MMAP
+        buf.index = index
+        self._ioctl(VIDIOC_QBUF, buf)
+
+    def _read_buffer(self, index, length):
+        return self.buffers[index][:length]
+
+    # -- public API --
+
+    def open(self):
+        """Open the device and start streaming"""
+        if self.fd is not None:
+            return
+        try:
+            self._open_device()
+            for _ in range(self.warmup_frames):
+                index, _ = self._next_frame(timeout=5.0)
+                self._queue(index)
+        except OSError as e:
+            self._close_device()
+            raise CaptureError(f"Could not open {self.device}: {e}") from e
+        except CaptureError:
+            self._close_device()
+            raise
+        print(f"[Capture] V4L2 stream open on {self.device} at "
+              f"{self.actual_resolution[0]}x{self.actual_resolution[1]} (MJPEG, {len(self.buffers)} buffers)")
+
+    def close(self):
+        """Stop streaming and release the device"""
+        if self.fd is not None:
+            self._close_device()
+            print(f"[Capture] V4L2 stream closed on {self.device}")
+
+    def _next_frame(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self._dequeue()
+            if frame is not None:
+                return frame
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._wait_readable(remaining):
+                raise CaptureError(f"Timed out waiting for a frame from {self.device}")
+
+    def grab(self, timeout=5.0):
+        """Return the freshest JPEG frame as bytes
+
+        Buffers the driver filled while we weren't looking are stale (they
+        may be seconds old at long intervals), so they are handed straight
+        back and we wait for the next frame off the sensor.
+        """
+        if self.fd is None:
+            self.open()
+        try:
+            while True:
+                stale = self._dequeue()
+                if stale is None:
+                    break
+                self._queue(stale[0])
+
+            index, length = self._next_frame(timeout)
+            try:
+                data = self._read_buffer(index, length)
+            finally:
+                self._queue(index)
+        except OSError as e:
+            raise CaptureError(f"V4L2 capture failed on {self.device}: {e}") from e
+
+        if not data:
+            raise CaptureError(f"Empty frame from {self.device}")
+        return add_huffman_tables(data)
+
+
+class FswebcamCapture:
+    """One fswebcam process per frame (the original capture path)
+
+    Each grab() re-opens the device, negotiates the format and throws away
+    skip_frames warm-up frames, so it costs one to three seconds per frame.
+    """
+
+    name = 'fswebcam'
+
+    def __init__(self, device, resolution=(1920, 1080), skip_frames=2, jpeg_quality=95):
+        self.device = device
+        self.resolution = tuple(resolution)
+        self.skip_frames = skip_frames
+        self.jpeg_quality = jpeg_quality
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def command(self):
+        return [
+            'fswebcam',
+            '-d', self.device,
+            '-r', f"{self.resolution[0]}x{self.resolution[1]}",
+            '--no-banner',
+            '--jpeg', str(self.jpeg_quality),
+            '-S', str(self.skip_frames),
+            '-',
+        ]
+
+    def grab(self, timeout=10.0):
+        """Return one JPEG frame as bytes"""
+        cmd = self.command()
+        try:
+            result = subprocess.run(cmd, capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            raise CaptureError(f"fswebcam timed out on {self.device}") from e
+        except OSError as e:
+            raise CaptureError(f"Could not run fswebcam: {e}") from e
+
+        if result.returncode != 0 or not result.stdout:
+            error_msg = result.stderr.decode('utf-8', 'replace').strip() if result.stderr else 'Unknown error'
+            raise CaptureError(f"fswebcam failed on {self.device}: {error_msg}")
+        return result.stdout
+
+
+def open_capture_backend(device, resolution=(1920, 1080), backend='auto', auto_adjust=False):
+    """Open the best available capture backend for a USB camera
+
+    Args:
+        device: Video device path like '/dev/video0'
+        resolution: Tuple of (width, height)
+        backend: 'auto' (V4L2 with fswebcam fallback), 'v4l2' or 'fswebcam'
+        auto_adjust: Give the camera more warm-up frames to settle exposure
+
+    Returns:
+        An opened backend exposing grab() and close()
+    """
+    if backend in ('auto', 'v4l2'):
+        capture = V4L2Capture(device, resolution, warmup_frames=15 if auto_adjust else 5)
+        try:
+            capture.open()
+            return capture
+        except CaptureError as e:
+            if backend == 'v4l2':
+                raise
+            print(f"[Capture] V4L2 backend unavailable ({e}), falling back to fswebcam")
+
+    capture = FswebcamCapture(device, resolution, skip_frames=10 if auto_adjust else 2)
+    capture.open()
+    print(f"[Capture] Using fswebcam backend on {device}")
+    return capture
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Capture daemon
+
+Runs the capture engine (the timelapse worker, the camera, live encoding)
+in its own long-running process, so restarting, reloading or crashing the
+web server never costs a frame. The web app talks to it over a Unix
+socket in timelapse_data/ when started with TIMELAPSEPI_CAPTURE=daemon;
+without it the web app captures in-process as before.
+
+Protocol: one request per connection, a JSON line
+
+    {"op": "status"}
+
+answered by a JSON line
+
+    {"ok": true, "result": {...}}
+    {"ok": false, "error": "...", "code": 400}
+
+A response with "length" is followed by that many raw bytes (a preview
+JPEG). The "events" op keeps the connection open and sends one JSON line
+per event ({"event": type, "data": {...}}), with a heartbeat line when
+nothing happened for a while.
+
+Ops: ping, status, start, stop (same parameters and answers as
+/api/start and /api/stop, in "params"), preview, preview_release,
+configure (re-read the saved config), events.
+
+Usage:
+    python3 capture_daemon.py
+"""
+
+import os
+import sys
+import json
+import queue
+import signal
+import socket
+import threading
+import socketserver
+
+HEARTBEAT_SECONDS = 15
+# /api/stop waits up to 10 s for the worker to finish
+CALL_TIMEOUT = 15
+
+
+class CaptureUnavailable(Exception):
+    """Raised when the capture daemon can't be reached"""
+
+
+def _read_message(f):
+    """One JSON line plus its trailing bytes, or (None, None) at EOF"""
+    line = f.readline()
+    if not line:
+        return None, None
+    message = json.loads(line)
+    payload = None
+    length = message.get("length")
+    if length is not None:
+        payload = f.read(length)
+        if len(payload) != length:
+            raise ConnectionError("connection closed mid-message")
+    return message, payload
+
+
+def _write_message(f, message, payload=None):
+    if payload is not None:
+        message = dict(message, length=len(payload))
+    f.write(json.dumps(message).encode() + b'\n')
+    if payload is not None:
+        f.write(payload)
+    f.flush()
+
+
+class CaptureClient:
+    """Web-side handle on the capture daemon"""
+
+    def __init__(self, path, timeout=CALL_TIMEOUT):
+        self.path = str(path)
+        self.timeout = timeout
+
+    def _connect(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise CaptureUnavailable(f"capture daemon not reachable at {self.path}: {e}") from e
+        return sock
+
+    def call(self, op, **params):
+        """Send one request
+
+        Returns:
+            tuple: (response dict, payload bytes or None)
+
+        Raises:
+            CaptureUnavailable: The daemon isn't running or didn't answer
+        """
+        sock = self._connect(self.timeout)
+        try:
+            with sock.makefile('rwb') as f:
+                _write_message(f, dict(params, op=op))
+                message, payload = _read_message(f)
+        except (OSError, ValueError) as e:
+            raise CaptureUnavailable(f"capture daemon request {op!r} failed: {e}") from e
+        finally:
+            sock.close()
+        if message is None:
+            raise CaptureUnavailable(f"capture daemon closed the connection on {op!r}")
+        return message, payload
+
+    def status(self):
+        """The daemon's capture status, or None if it isn't reachable"""
+        try:
+            message, _ = self.call('status')
+        except CaptureUnavailable:
+            return None
+        return message.get("result")
+
+    def preview(self):
+        """One preview JPEG from the daemon's camera (None if there is none right now)"""
+        try:
+            _, payload = self.call('preview')
+        except CaptureUnavailable:
+            return None
+        return payload
+
+    def release_preview(self):
+        try:
+            self.call('preview_release')
+        except CaptureUnavailable:
+            pass
+
+    def configure(self):
+        """Have the daemon re-read the saved config; False if it isn't reachable"""
+        try:
+            self.call('configure')
+        except CaptureUnavailable:
+            return False
+        return True
+
+    def events(self):
+        """Generate (event_type, data) from the daemon until the connection drops
+
+        Raises:
+            CaptureUnavailable: The daemon isn't running
+        """
+        sock = self._connect(HEARTBEAT_SECONDS * 2 + 5)
+        try:
+            with sock.makefile('rwb') as f:
+                _write_message(f, {"op": "events"})
+                while True:
+                    message, _ = _read_message(f)
+                    if message is None:
+                        return
+                    if message.get("event") != 'heartbeat':
+                        yield message["event"], message.get("data") or {}
+        except (OSError, ValueError):
+            return
+        finally:
+            sock.close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request, _ = _read_message(self.rfile)
+        except ValueError:
+            _write_message(self.wfile, {"ok": False, "error": "invalid request", "code": 400})
+            return
+        if request is None:
+            return
+        op = request.pop("op", None)
+        handler = getattr(self.server.daemon, f"op_{op}", None)
+        if handler is None:
+            _write_message(self.wfile, {"ok": False, "error": f"unknown op {op!r}", "code": 400})
+            return
+        try:
+            handler(self.wfile, request)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            print(f"[Daemon] ERROR: {op} failed: {e}")
+            try:
+                _write_message(self.wfile, {"ok": False, "error": str(e), "code": 500})
+            except OSError:
+                pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class CaptureDaemon:
+    """Serves the capture engine of an imported app module over a Unix socket"""
+
+    def __init__(self, timelapse, path):
+        """
+        Args:
+            timelapse: The imported app module (capture engine and state)
+            path: Socket path
+        """
+        self.timelapse = timelapse
+        self.path = str(path)
+        self._server = None
+
+    def serve_forever(self):
+        # Only the process holding the capture lock gets here, so a socket
+        # file left behind is stale
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._server = _Server(self.path, _Handler)
+        self._server.daemon = self
+        os.chmod(self.path, 0o660)
+        print(f"[Daemon] Listening on {self.path}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        if self._server is not None:
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+    def _view(self, view, params):
+        """Run an app view function as if it had been POSTed params"""
+        with self.timelapse.app.test_request_context(method='POST', json=params):
+            response = self.timelapse.app.make_response(view())
+        return response.get_json(), response.status_code
+
+    # -- ops --
+
+    def op_ping(self, out, request):
+        _write_message(out, {"ok": True, "result": {"pid": os.getpid()}})
+
+    def op_status(self, out, request):
+        _write_message(out, {"ok": True, "result": self.timelapse.capture_status()})
+
+    def op_start(self, out, request):
+        result, code = self._view(self.timelapse.start_timelapse, request.get("params") or {})
+        _write_message(out, {"ok": code < 400, "result": result, "code": code})
+
+    def op_stop(self, out, request):
+        result, code = self._view(self.timelapse.stop_timelapse, request.get("params") or {})
+        _write_message(out, {"ok": code < 400, "result": result, "code": code})
+
+    def op_preview(self, out, request):
+        frame = self.timelapse.grab_preview_frame()
+        _write_message(out, {"ok": True}, frame)
+
+    def op_preview_release(self, out, request):
+        self.timelapse.release_preview_camera()
+        _write_message(out, {"ok": True})
+
+    def op_configure(self, out, request):
+        self.timelapse.storage.configure(self.timelapse.load_config())
+        _write_message(out, {"ok": True, "result": self.timelapse.storage.status()})
+
+    def op_events(self, out, request):
+        event_bus = self.timelapse.event_bus
+        sub = event_bus.subscribe()
+        try:
+            while True:
+                try:
+                    _, event_type, data = sub.queue.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    _write_message(out, {"event": 'heartbeat'})
+                    continue
+                _write_message(out, {"event": event_type, "data": data})
+        finally:
+            event_bus.unsubscribe(sub)
+
+
+def main():
+    # The web app forwards to a daemon only when told to; this process is the daemon
+    os.environ.pop('TIMELAPSEPI_CAPTURE', None)
+    import app as timelapse
+
+    print("=" * 60)
+    print("TimelapsePI Capture Daemon Starting...")
+    print("=" * 60)
+    if not timelapse.claim_capture():
+        print(f"[Daemon] ERROR: Capture is already run by process {timelapse.capture_owner()}")
+        sys.exit(1)
+    threading.Thread(target=timelapse.probe_profiles, daemon=True).start()
+    timelapse.camera_service.wait_ready()
+    timelapse.resume_sessions()
+    threading.Thread(target=timelapse.frame_store.migrate_all, daemon=True).start()
+    timelapse.submit_retention()
+
+    daemon = CaptureDaemon(timelapse, timelapse.CAPTURE_SOCKET)
+
+    def stop(signum, frame):
+        # Finish the frames in progress; the sessions resume when the daemon starts again
+        print(f"[Daemon] Signal {signum}, stopping")
+        timelapse.suspend_sessions()
+        daemon.shutdown()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    daemon.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Running capture sessions
+
+Each running session is bound to one camera device and has its own worker
+thread, schedule, frame writer and state dict (see app.new_session_state).
+Sessions are kept here by ID, so a Pi with several USB cameras records
+from all of them at once, each at its own interval.
+
+Every device has its own lock, held while a frame is grabbed from it or
+its handle is opened or closed. Sessions on different cameras never wait
+for each other; the preview and a session on the same camera take turns.
+A device runs at most one session at a time.
+"""
+
+import threading
+
+# Device name the Raspberry Pi camera module (libcamera-still) is listed under
+LIBCAMERA_DEVICE = 'libcamera'
+
+
+class DeviceBusy(Exception):
+    """Raised when a session is started on a device another session is capturing from"""
+
+    def __init__(self, device, session_id):
+        super().__init__(f"{device} is already capturing session {session_id}")
+        self.device = device
+        self.session_id = session_id
+
+
+class SessionRegistry:
+    """Running sessions by ID, and the lock of each camera device"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._device_locks = {}
+
+    def device_lock(self, device):
+        """The lock serialising access to one camera device"""
+        with self._lock:
+            return self._device_locks.setdefault(device, threading.Lock())
+
+    def add(self, state):
+        """Register a session that is about to start
+
+        Args:
+            state: Session state dict with at least "id" and "device"
+
+        Raises:
+            DeviceBusy: Another session is capturing from the same device
+        """
+        with self._lock:
+            for other in self._sessions.values():
+                if other["device"] == state["device"] and other["id"] != state["id"]:
+                    raise DeviceBusy(state["device"], other["id"])
+            self._sessions[state["id"]] = state
+
+    def remove(self, session_id, state=None):
+        """Forget a session whose worker has ended
+
+        Args:
+            state: Only remove it if it is still this state dict (not a
+                   newer run of the same session)
+        """
+        with self._lock:
+            if state is None or self._sessions.get(session_id) is state:
+                self._sessions.pop(session_id, None)
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def by_device(self, device):
+        """The session capturing from a device, or None"""
+        with self._lock:
+            return next((s for s in self._sessions.values() if s["device"] == device), None)
+
+    def running(self):
+        """Running sessions, oldest first"""
+        with self._lock:
+            return sorted(self._sessions.values(), key=lambda s: s["id"])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Change detection
+
+Compares each captured frame with the last one kept, so a session of a
+static scene (a building site at night, a plant) doesn't store thousands
+of near-identical frames. The comparison uses a signature of the frame:
+its luminance averaged over a 32x24 grid, decoded at reduced size like
+the metering thumbnail (metering.decode_luminance: Pillow's draft mode,
+or one ffmpeg call without Pillow) and box-filtered down to the grid.
+NumPy does the comparison, or a pure-Python pass over the ~800 cells.
+
+The change between two frames is the mean absolute difference of their
+grids (0-255) after removing each grid's overall brightness, so exposure
+drift and flicker alone don't count as change. A frame also counts as
+changed when enough grid cells changed by a large step, so something
+small moving through a big static scene isn't averaged away. What happens
+to a frame that didn't change depends on the mode:
+
+    drop   it is not stored
+    thin   only every Nth of a run of unchanged frames is stored
+    mark   it is stored, and listed as unchanged so a compile can leave it
+           out (see FrameStore.mark_unchanged)
+
+Motion is the same large-step test against the previous frame instead of
+the last kept one. The capture loop uses it to capture faster for a
+while (see ChangeDetector.motion).
+"""
+
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# backend(): the same decode/comparison paths as metering
+from metering import backend, decode_luminance
+
+CHANGE_MODES = ('off', 'drop', 'thin', 'mark')
+GRID_SIZE = (32, 24)
+DEFAULT_THRESHOLD = 3.0
+DEFAULT_THIN_EVERY = 10
+# Motion: at least this fraction of cells changed by CELL_MOTION_LEVEL or more
+DEFAULT_MOTION_FRACTION = 0.02
+CELL_MOTION_LEVEL = 24
+
+
+def signature(path=None, data=None, size=GRID_SIZE):
+    """Luminance grid of a JPEG frame
+
+    Args:
+        path: JPEG file
+        data: JPEG bytes already in memory (skips reading the file)
+        size: Grid (width, height)
+
+    Returns:
+        numpy float32 array (height, width), or a list of floats without NumPy
+    """
+    pixels, width, height = decode_luminance(path, data, size, exact=True)
+    if np is not None:
+        return np.frombuffer(pixels, dtype=np.uint8).reshape(height, width).astype(np.float32)
+    return [float(value) for value in pixels]
+
+
+def difference(a, b):
+    """How much two signatures differ
+
+    Returns:
+        tuple: (change: mean absolute difference with the overall brightness
+                removed, 0-255; motion: fraction of cells that changed by
+                CELL_MOTION_LEVEL or more)
+    """
+    if np is not None:
+        delta = (a - a.mean()) - (b - b.mean())
+        return float(np.abs(delta).mean()), float((np.abs(a - b) >= CELL_MOTION_LEVEL).mean())
+    mean_a = sum(a) / len(a)
+    mean_b = sum(b) / len(b)
+    change = sum(abs((x - mean_a) - (y - mean_b)) for x, y in zip(a, b)) / len(a)
+    motion = sum(1 for x, y in zip(a, b) if abs(x - y) >= CELL_MOTION_LEVEL) / len(a)
+    return change, motion
+
+
+class ChangeDetector:
+    """Decides which captured frames are worth keeping"""
+
+    def __init__(self, mode='drop', threshold=DEFAULT_THRESHOLD, thin_every=DEFAULT_THIN_EVERY,
+                 motion_fraction=DEFAULT_MOTION_FRACTION):
+        """
+        Args:
+            mode: 'drop', 'thin', 'mark', or 'off' (keep everything, only
+                  detect motion)
+            threshold: Change (0-255) below which a frame counts as unchanged
+            thin_every: With 'thin', keep one in this many unchanged frames
+            motion_fraction: Fraction of cells that must change sharply for motion
+        """
+        if mode not in CHANGE_MODES:
+            raise ValueError(f"Unknown change mode {mode!r}, use one of {', '.join(CHANGE_MODES)}")
+        self.mode = mode
+        self.threshold = float(threshold)
+        self.thin_every = max(1, int(thin_every))
+        self.motion_fraction = float(motion_fraction)
+        self._reference = None  # signature of the last frame that counted as changed
+        self._previous = None
+        self._unchanged_run = 0
+        self.last_change = None
+        self.motion = False
+        self.judged = 0
+        self.dropped = 0
+        self.marked = 0
+        self.signature_seconds = 0.0
+
+    def judge(self, path=None, data=None):
+        """Look at a new frame
+
+        Returns:
+            str: 'keep', 'drop' (don't store it) or 'mark' (store it as unchanged)
+        """
+        started = time.perf_counter()
+        try:
+            current = signature(path, data)
+        except Exception as e:
+            # Never lose a frame to the detector
+            print(f"[Change] Could not read frame signature: {e}")
+            self.motion = False
+            return 'keep'
+        self.signature_seconds += time.perf_counter() - started
+        self.judged += 1
+
+        self.motion = False
+        if self._previous is not None:
+            _, moved = difference(current, self._previous)
+            self.motion = moved >= self.motion_fraction
+        self._previous = current
+
+        if self._reference is None:
+            self._reference = current
+            return 'keep'
+        self.last_change, moved = difference(current, self._reference)
+        if self.last_change >= self.threshold or moved >= self.motion_fraction or self.mode == 'off':
+            self._reference = current
+            self._unchanged_run = 0
+            return 'keep'
+
+        self._unchanged_run += 1
+        if self.mode == 'mark':
+            self.marked += 1
+            return 'mark'
+        if self.mode == 'thin' and self._unchanged_run % self.thin_every == 0:
+            return 'keep'
+        self.dropped += 1
+        return 'drop'
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "threshold": self.threshold,
+            "thin_every": self.thin_every if self.mode == 'thin' else None,
+            "judged": self.judged,
+            "dropped": self.dropped,
+            "marked": self.marked,
+            "last_change": round(self.last_change, 2) if self.last_change is not None else None,
+            "motion": self.motion,
+            "signature_ms": round(self.signature_seconds / self.judged * 1000, 2) if self.judged else None,
+        }
@@ -10,13 +10,23 @@ echo ""
 
 cd ~/timelapsepi/timelapse_data
 
+# Frames in a session directory: from its frame manifest (12-byte header,
+# 20 bytes per frame), or counted for sessions not migrated to shards yet
+count_frames() {
+    if [ -f "$1frames.manifest" ]; then
+        echo $(( ($(stat -c %s "$1frames.manifest") - 12) / 20 ))
+    else
+        ls -1 "$1"frame_*.jpg 2>/dev/null | wc -l
+    fi
+}
+
 echo "📁 Image Sessions:"
 if [ -d "images" ]; then
     for dir in images/*/; do
         if [ -d "$dir" ]; then
             session=$(basename "$dir")
             if [ "$session" != "preview" ]; then
-                frame_count=$(ls -1 "$dir"frame_*.jpg 2>/dev/null | wc -l)
+                frame_count=$(count_frames "$dir")
                 echo "  • $session ($frame_count frames)"
             fi
         fi
@@ -55,7 +65,7 @@ if [ -d "images" ]; then
                 if [ -f "$video_file" ]; then
                     echo "  ✅ $session → has video"
                 else
-                    frame_count=$(ls -1 "$dir"frame_*.jpg 2>/dev/null | wc -l)
+                    frame_count=$(count_frames "$dir")
                     if [ $frame_count -gt 0 ]; then
                         echo "  ⚠️  $session → no video (but has $frame_count frames)"
                     fi
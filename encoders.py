@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Encoder profiles
+
+A profile is the ffmpeg output arguments for one way of encoding a
+session. The ones this ffmpeg build can actually use are found once, by
+listing `ffmpeg -encoders` and test-encoding a few frames with each:
+hardware encoders are often compiled in without a device behind them.
+
+The default choice is the fastest usable profile that meets the configured
+quality target ('low', 'medium' or 'high'); any request can name a profile
+explicitly instead. MJPEG passthrough (the captured JPEGs stream-copied
+into the MP4) is the fastest of all but most browsers can't play it, so it
+is only used when asked for by name.
+"""
+
+import shutil
+import threading
+import subprocess
+
+QUALITY_LEVELS = ('low', 'medium', 'high')
+DEFAULT_QUALITY = 'medium'
+
+# Fastest first. 'quality' is the lowest target a profile satisfies.
+PROFILES = {
+    'mjpeg-copy': {
+        'encoder': None,
+        'description': 'Captured JPEGs copied into the MP4 (no encoding, large, limited playback)',
+        'args': ['-c:v', 'copy'],
+        'quality': 'high',
+        'browser': False,
+        'filters': False,
+    },
+    'v4l2m2m': {
+        'encoder': 'h264_v4l2m2m',
+        'description': 'Raspberry Pi hardware H.264 (V4L2 M2M)',
+        'args': ['-c:v', 'h264_v4l2m2m', '-pix_fmt', 'yuv420p', '-b:v', '10M'],
+        'quality': 'medium',
+        'browser': True,
+        'filters': True,
+    },
+    'omx': {
+        'encoder': 'h264_omx',
+        'description': 'Raspberry Pi hardware H.264 (OpenMAX, legacy OS images)',
+        'args': ['-c:v', 'h264_omx', '-pix_fmt', 'yuv420p', '-b:v', '10M'],
+        'quality': 'medium',
+        'browser': True,
+        'filters': True,
+    },
+    'x264-ultrafast': {
+        'encoder': 'libx264',
+        'description': 'Software H.264, ultrafast preset',
+        'args': ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-crf', '23'],
+        'quality': 'low',
+        'browser': True,
+        'filters': True,
+    },
+    'x264-veryfast': {
+        'encoder': 'libx264',
+        'description': 'Software H.264, veryfast preset',
+        'args': ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-crf', '23'],
+        'quality': 'medium',
+        'browser': True,
+        'filters': True,
+    },
+    'x264': {
+        'encoder': 'libx264',
+        'description': 'Software H.264, default preset (slowest, smallest files)',
+        'args': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '23'],
+        'quality': 'high',
+        'browser': True,
+        'filters': True,
+    },
+}
+
+FALLBACK_PROFILE = 'x264'
+
+_available = None
+_probe_lock = threading.Lock()
+
+
+class EncoderError(Exception):
+    """Unknown or unusable encoder profile"""
+
+
+def _listed_encoders():
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                            capture_output=True, text=True, timeout=10)
+    names = set()
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        # " V....D libx264   libx264 H.264 ..." - flags, name, description
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] in 'VAS':
+            names.add(parts[1])
+    return names
+
+
+def _test_encode(profile):
+    """Encode a few synthetic frames to check the encoder really works"""
+    cmd = ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=320x240:rate=30',
+           '-frames:v', '8'] + profile['args'] + ['-f', 'null', '-']
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=20).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def probe_profiles():
+    """Find the profiles this ffmpeg build can use (cached after the first call)
+
+    Returns:
+        list of profile names, fastest first
+    """
+    global _available
+    with _probe_lock:
+        if _available is not None:
+            return _available
+
+        if not shutil.which('ffmpeg'):
+            print("[Encoders] ffmpeg not found")
+            _available = []
+            return _available
+
+        try:
+            listed = _listed_encoders()
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"[Encoders] Could not list encoders: {e}")
+            listed = set()
+
+        available = []
+        tested = {}
+        for name, profile in PROFILES.items():
+            encoder = profile['encoder']
+            if encoder is None:
+                available.append(name)  # stream copy needs no encoder
+                continue
+            if encoder not in listed:
+                continue
+            if encoder not in tested:
+                tested[encoder] = _test_encode(profile)
+            if tested[encoder]:
+                available.append(name)
+
+        print(f"[Encoders] Usable profiles: {', '.join(available) or 'none'}")
+        _available = available
+        return _available
+
+
+def select_profile(quality=DEFAULT_QUALITY):
+    """Fastest usable, browser-playable profile meeting the quality target"""
+    if quality not in QUALITY_LEVELS:
+        quality = DEFAULT_QUALITY
+    target = QUALITY_LEVELS.index(quality)
+    for name in probe_profiles():
+        profile = PROFILES[name]
+        if profile['browser'] and QUALITY_LEVELS.index(profile['quality']) >= target:
+            return name
+    return FALLBACK_PROFILE
+
+
+def resolve_profile(name=None, quality=DEFAULT_QUALITY, needs_filters=False):
+    """Pick the profile for one encode
+
+    Args:
+        name: Explicit profile name (per-request override), or None/'auto'
+        quality: Quality target used when choosing automatically
+        needs_filters: True if the encode applies a video filter (rotation)
+
+    Returns:
+        tuple: (profile name, ffmpeg output args)
+
+    Raises:
+        EncoderError: Unknown, unavailable or unsuitable profile
+    """
+    if not name or name == 'auto':
+        name = select_profile(quality)
+        if needs_filters and not PROFILES[name]['filters']:
+            name = FALLBACK_PROFILE
+    elif name not in PROFILES:
+        raise EncoderError(f"Unknown encoder '{name}'. Use one of: auto, {', '.join(PROFILES)}")
+    elif name not in probe_profiles():
+        raise EncoderError(f"Encoder '{name}' is not available on this system")
+    elif needs_filters and not PROFILES[name]['filters']:
+        raise EncoderError(f"Encoder '{name}' copies frames as-is and can't rotate")
+    return name, list(PROFILES[name]['args'])
+
+
+def describe_profiles(quality=DEFAULT_QUALITY):
+    """All profiles with availability, for /api/encoders"""
+    available = probe_profiles()
+    return {
+        "selected": select_profile(quality),
+        "quality": quality,
+        "profiles": [
+            {
+                "name": name,
+                "description": profile['description'],
+                "quality": profile['quality'],
+                "browser": profile['browser'],
+                "available": name in available,
+            }
+            for name, profile in PROFILES.items()
+        ],
+    }
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Server-push event bus
+
+Publishers (capture worker, compiler, device detection) call publish();
+each connected browser gets its own bounded queue that /api/events drains
+as a Server-Sent Events stream. A slow client only loses its own oldest
+events and is told to resync; it never blocks a publisher.
+"""
+
+import json
+import queue
+import threading
+import itertools
+
+HEARTBEAT_SECONDS = 15
+
+
+class Subscription:
+    """One connected client"""
+
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+    def put(self, event):
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+class EventBus:
+    """Fan-out of events to any number of subscribers"""
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        sub = Subscription(self.max_queue)
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def publish(self, event_type, data=None):
+        """Send an event to every subscriber (never blocks)"""
+        event = (next(self._ids), event_type, data or {})
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.put(event)
+
+    def stream(self, sub, initial=None):
+        """Generate the SSE wire format for one subscriber
+
+        Args:
+            sub: Subscription from subscribe()
+            initial: Optional list of (event_type, data) sent first, so the
+                     client starts from a full snapshot
+        """
+        try:
+            # Ask EventSource to wait 3 s before reconnecting
+            yield 'retry: 3000\n\n'
+            for event_type, data in initial or []:
+                yield format_sse(None, event_type, data)
+
+            while True:
+                try:
+                    event_id, event_type, data = sub.queue.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # Comment line keeps proxies and the browser from timing out
+                    yield ': ping\n\n'
+                    continue
+
+                if sub.dropped:
+                    # Client fell behind and missed events: tell it to refetch
+                    sub.dropped = 0
+                    yield format_sse(None, 'resync', {})
+                yield format_sse(event_id, event_type, data)
+        finally:
+            self.unsubscribe(sub)
+
+
+def format_sse(event_id, event_type, data):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event_type}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+event_bus = EventBus()
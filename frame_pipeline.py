@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Frame post-processing
+
+A pipeline is a list of stages, each a dict naming the stage and its
+options, applied to every frame in order:
+
+    [{"stage": "crop", "box": [0, 120, 1920, 840]},
+     {"stage": "resize", "width": 1280},
+     {"stage": "deflicker", "window": 15},
+     {"stage": "timestamp", "format": "%Y-%m-%d %H:%M"},
+     {"stage": "rotate", "degrees": 180}]
+
+    crop       keep box [x, y, width, height] (pixels of the captured frame)
+    resize     fit within width x height (either may be left out), keeping
+               the aspect ratio; frames are never scaled up
+    deflicker  scale each frame's brightness to the mean luminance of the
+               `window` frames around it, evening out steps between frames
+               (auto exposure hunting, passing clouds)
+    timestamp  draw the capture time (strftime format) in a corner
+    rotate     turn the pixels clockwise by 90, 180 or 270 degrees (a
+               camera mounted sideways or upside down)
+
+Other stages can be added with register_stage().
+
+A stored session is processed as a batch (process_session), e.g. before
+a compile: frames stream through in capture order and are rendered in the
+shared process pool (process_pool.py), a bounded number ahead of the one
+being waited for, so memory doesn't grow with the session. Results are
+cached per pipeline with the source frame's size and deflicker gain, so a
+recompile only renders frames that are new (or whose deflicker window
+changed because frames were added after them).
+
+At capture time (CaptureProcessor) each frame is rendered in the pool
+too, and stored, processed, in capture order from the session's delivery
+thread; the capture loop only waits if the pool falls a few frames per
+process behind. Deflicker then uses the window of frames before it.
+"""
+
+import io
+import os
+import json
+import time
+import hashlib
+import collections
+from datetime import datetime
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageStat
+except ImportError:
+    Image = None
+
+import process_pool
+from frame_store import frame_name
+
+DEFAULT_QUALITY = 90
+DEFAULT_DEFLICKER_WINDOW = 15
+DEFAULT_MAX_GAIN = 2.0
+# Frames submitted to the pool ahead of the one being waited for, per process
+# (also how far capture may run ahead of capture-time processing)
+AHEAD_PER_WORKER = 4
+# Cached frames per subdirectory, like the frame store's shards
+SHARD_FRAMES = 1000
+CORNERS = ('top-left', 'top-right', 'bottom-left', 'bottom-right')
+
+STAGES = {}
+
+
+def available():
+    """Whether frames can be processed here (needs Pillow)"""
+    return Image is not None
+
+
+def register_stage(cls):
+    """Make a Stage subclass usable in pipelines under its name (a class decorator)"""
+    STAGES[cls.name] = cls
+    return cls
+
+
+class Stage:
+    """One step of a pipeline, made from the stage's dict (without "stage") as keyword options"""
+
+    name = None
+
+    def draft_size(self):
+        """Smallest decode size this stage needs if it comes first, or None for full size"""
+        return None
+
+    def apply(self, image, frame):
+        """Process one frame
+
+        Args:
+            image: PIL RGB image
+            frame: dict with the frame's "captured_at" (epoch seconds) and
+                   deflicker "gain" (None without deflicker)
+
+        Returns:
+            PIL image
+        """
+        raise NotImplementedError
+
+
+@register_stage
+class Crop(Stage):
+    name = 'crop'
+
+    def __init__(self, box):
+        x, y, width, height = (int(value) for value in box)
+        if x < 0 or y < 0 or width <= 0 or height <= 0:
+            raise ValueError("crop box is [x, y, width, height] with a positive width and height")
+        self.box = (x, y, x + width, y + height)
+
+    def apply(self, image, frame):
+        # A box reaching past the frame is cut to it rather than padded
+        left, top, right, bottom = self.box
+        return image.crop((min(left, image.width - 1), min(top, image.height - 1),
+                           min(right, image.width), min(bottom, image.height)))
+
+
+@register_stage
+class Resize(Stage):
+    name = 'resize'
+
+    def __init__(self, width=None, height=None):
+        if width is None and height is None:
+            raise ValueError("resize needs a width or a height")
+        self.width = int(width) if width is not None else None
+        self.height = int(height) if height is not None else None
+        if (self.width is not None and self.width <= 0) or (self.height is not None and self.height <= 0):
+            raise ValueError("resize width and height must be positive")
+
+    def draft_size(self):
+        return (self.width or 1, self.height or 1)
+
+    def apply(self, image, frame):
+        scale = min(self.width / image.width if self.width else 1.0,
+                    self.height / image.height if self.height else 1.0)
+        if scale >= 1.0:
+            return image
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        return image.resize(size, Image.LANCZOS)
+
+
+@register_stage
+class Deflicker(Stage):
+    name = 'deflicker'
+
+    def __init__(self, window=DEFAULT_DEFLICKER_WINDOW, max_gain=DEFAULT_MAX_GAIN):
+        self.window = int(window)
+        self.max_gain = float(max_gain)
+        if self.window < 2 or self.max_gain < 1.0:
+            raise ValueError("deflicker window must be 2 or more frames and max_gain at least 1")
+
+    def apply(self, image, frame):
+        gain = frame.get("gain")
+        if gain is None or abs(gain - 1.0) < 0.002:
+            return image
+        table = [min(255, int(value * gain + 0.5)) for value in range(256)]
+        return image.point(table * len(image.getbands()))
+
+
+@register_stage
+class Timestamp(Stage):
+    name = 'timestamp'
+
+    def __init__(self, format='%Y-%m-%d %H:%M', position='bottom-right', size=None):
+        if position not in CORNERS:
+            raise ValueError(f"timestamp position must be one of {', '.join(CORNERS)}")
+        datetime.now().strftime(format)  # a format that isn't a string fails here, not per frame
+        self.format = format
+        self.position = position
+        self.size = int(size) if size is not None else None
+        self._fonts = {}
+
+    def _font(self, size):
+        font = self._fonts.get(size)
+        if font is None:
+            try:
+                font = ImageFont.load_default(size=size)
+            except TypeError:  # Pillow before 10.1: fixed-size bitmap font only
+                font = ImageFont.load_default()
+            self._fonts[size] = font
+        return font
+
+    def apply(self, image, frame):
+        text = datetime.fromtimestamp(frame["captured_at"]).strftime(self.format)
+        size = self.size or max(12, image.height // 30)
+        font = self._font(size)
+        draw = ImageDraw.Draw(image)
+        stroke = max(1, size // 12)
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=font, stroke_width=stroke)
+        margin = size // 2
+        x = margin if self.position.endswith('left') else image.width - margin - (right - left)
+        y = margin if self.position.startswith('top') else image.height - margin - (bottom - top)
+        draw.text((x - left, y - top), text, font=font, fill=(255, 255, 255),
+                  stroke_width=stroke, stroke_fill=(0, 0, 0))
+        return image
+
+
+@register_stage
+class Rotate(Stage):
+    name = 'rotate'
+
+    _TRANSPOSE = {90: 'ROTATE_270', 180: 'ROTATE_180', 270: 'ROTATE_90'}
+
+    def __init__(self, degrees):
+        if degrees not in self._TRANSPOSE:
+            raise ValueError("rotate degrees must be 90, 180 or 270")
+        self.degrees = degrees
+
+    def apply(self, image, frame):
+        # PIL's rotations are counter-clockwise
+        return image.transpose(getattr(Image.Transpose, self._TRANSPOSE[self.degrees]))
+
+
+def build_stages(spec):
+    """Stage objects of a pipeline spec
+
+    Raises:
+        ValueError: Unknown stage or invalid options
+    """
+    if not isinstance(spec, list):
+        raise ValueError("a pipeline is a list of stages")
+    stages = []
+    for entry in spec:
+        if not isinstance(entry, dict) or entry.get("stage") not in STAGES:
+            raise ValueError(f"unknown stage {entry!r}, use one of {', '.join(STAGES)}")
+        options = {key: value for key, value in entry.items() if key != "stage"}
+        try:
+            stages.append(STAGES[entry["stage"]](**options))
+        except TypeError as e:
+            raise ValueError(f"invalid options for {entry['stage']}: {e}")
+    return stages
+
+
+def luminance(path=None, data=None):
+    """Mean luminance (0-255) of a JPEG frame, from a reduced-size decode"""
+    with Image.open(io.BytesIO(data) if data is not None else path) as im:
+        im.draft('L', (im.width // 8, im.height // 8))
+        return ImageStat.Stat(im.convert('L')).mean[0]
+
+
+def deflicker_gain(value, target, max_gain=DEFAULT_MAX_GAIN):
+    """Brightness gain taking a frame's luminance to the target, or None if it can't be measured"""
+    if value is None or target is None or value < 1.0:
+        return None
+    return round(min(max(target / value, 1.0 / max_gain), max_gain), 3)
+
+
+def deflicker_gains(items, window=DEFAULT_DEFLICKER_WINDOW, max_gain=DEFAULT_MAX_GAIN):
+    """Deflicker gains of a stream of frames, each against the window centred on it
+
+    Consumes `items` lazily, holding only the frames of one window.
+
+    Args:
+        items: Iterable of (payload, luminance or None)
+
+    Yields:
+        (payload, luminance, gain)
+    """
+    half = max(1, window // 2)
+    ahead = collections.deque()  # the frame whose gain is next, and up to `half` after it
+    behind = collections.deque(maxlen=half)
+
+    def next_gain():
+        payload, value = ahead[0]
+        around = [v for _, v in behind if v is not None] + [v for _, v in ahead if v is not None]
+        target = sum(around) / len(around) if around else None
+        return payload, value, deflicker_gain(value, target, max_gain)
+
+    for item in items:
+        ahead.append(item)
+        if len(ahead) > half:
+            yield next_gain()
+            behind.append(ahead.popleft())
+    while ahead:
+        yield next_gain()
+        behind.append(ahead.popleft())
+
+
+def parallel_map(fn, items, workers=None, cancel_event=None):
+    """Run fn(*args) for each item in the shared process pool, yielding results in order
+
+    Only a bounded number of items are taken from `items` ahead of the
+    result being waited for, so it streams.
+
+    Args:
+        items: Iterable of argument tuples, or of already done futures
+               (process_pool.ready) for results that need no work
+        cancel_event: threading.Event that stops it when set
+    """
+    pool = process_pool.get_pool(workers)
+    ahead = process_pool.size() * AHEAD_PER_WORKER
+    pending = collections.deque()
+    try:
+        for item in items:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            pending.append(item if hasattr(item, 'result') else pool.submit(fn, *item))
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+        while pending:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class FramePipeline:
+    """A pipeline spec, ready to process frames"""
+
+    def __init__(self, spec, quality=DEFAULT_QUALITY):
+        """
+        Args:
+            spec: List of stage dicts (see the module docstring)
+            quality: JPEG quality of the processed frames
+
+        Raises:
+            ValueError: Unknown stage or invalid options
+        """
+        self.stages = build_stages(spec)
+        self.spec = spec
+        self.quality = int(quality)
+        self.deflicker = next((stage for stage in self.stages if isinstance(stage, Deflicker)), None)
+        # Names the cache: the same spec always renders the same frames
+        self.key = hashlib.sha1(json.dumps({"stages": spec, "quality": self.quality},
+                                           sort_keys=True).encode()).hexdigest()[:12]
+        self._recent = collections.deque(maxlen=self.deflicker.window if self.deflicker else 1)
+
+    def render(self, source, captured_at, gain=None):
+        """Run the stages over one frame
+
+        Args:
+            source: JPEG file path, or a file-like object of JPEG bytes
+            captured_at: Capture time (epoch seconds), for the timestamp
+            gain: Deflicker gain (see deflicker_gains)
+
+        Returns:
+            bytes: the processed JPEG
+        """
+        with Image.open(source) as im:
+            draft = self.stages[0].draft_size() if self.stages else None
+            if draft:
+                im.draft('RGB', draft)
+            image = im.convert('RGB')
+        frame = {"captured_at": captured_at, "gain": gain}
+        for stage in self.stages:
+            image = stage.apply(image, frame)
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=self.quality)
+        return out.getvalue()
+
+    def capture_gain(self, data):
+        """Deflicker gain of a frame as it is captured, against the frames before it
+
+        Call in capture order. None without a deflicker stage.
+        """
+        if not self.deflicker:
+            return None
+        value = luminance(data=data)
+        self._recent.append(value)
+        return deflicker_gain(value, sum(self._recent) / len(self._recent), self.deflicker.max_gain)
+
+    def stats(self):
+        return {
+            "key": self.key,
+            "stages": [stage.name for stage in self.stages],
+        }
+
+
+class CaptureProcessor:
+    """Processes one session's frames in the process pool as they are captured, handing them back in capture order"""
+
+    def __init__(self, pipeline, on_processed=None, workers=None, name='capture'):
+        """
+        Args:
+            pipeline: FramePipeline
+            on_processed: callable(frame_number, jpeg, context) run for each
+                          frame on the processor's delivery thread, in the
+                          order the frames were submitted
+            workers: Pool processes (see process_pool.get_pool)
+            name: Names the delivery thread (e.g. after the session)
+        """
+        self.pipeline = pipeline
+        self.on_processed = on_processed
+        process_pool.get_pool(workers)
+        self.workers = process_pool.size()
+        self._delivery = process_pool.OrderedDelivery(self._deliver, f"process-{name}")
+        self.processed = 0
+        self.failed = 0
+        self.process_seconds = 0.0
+
+    def pending(self):
+        return self._delivery.pending()
+
+    def submit(self, frame_number, data, captured_at, context=None):
+        """Queue a captured frame; on_processed gets the processed frame when it is its turn
+
+        Never blocks (see throttle).
+        """
+        self._delivery.submit(frame_number, lambda: self._start(data, captured_at), (data, context))
+
+    def _start(self, data, captured_at):
+        # On the delivery thread in capture order, which the trailing
+        # deflicker window needs
+        gain = self.pipeline.capture_gain(data)
+        return process_pool.get_pool().submit(_process_job, self.pipeline.spec, self.pipeline.quality,
+                                              data, captured_at, gain)
+
+    def _deliver(self, frame_number, future, context):
+        data, context = context
+        try:
+            jpeg, seconds = future.result()
+            self.processed += 1
+            self.process_seconds += seconds
+        except Exception as e:
+            print(f"[Process] Could not process frame {frame_number} ({e}), storing it as captured")
+            self.failed += 1
+            jpeg = data
+        try:
+            if self.on_processed:
+                self.on_processed(frame_number, jpeg, context)
+        except Exception as e:
+            print(f"[Process] ERROR: Storing frame {frame_number} failed: {e}")
+
+    def throttle(self, timeout=None):
+        """Wait while the pool is more than AHEAD_PER_WORKER frames per process behind"""
+        return self._delivery.drain(timeout, leave=self.workers * AHEAD_PER_WORKER)
+
+    def drain(self, timeout=None):
+        """Wait until every submitted frame has been handed on
+
+        Returns:
+            bool: False if some were still pending at the timeout
+        """
+        return self._delivery.drain(timeout)
+
+    def close(self):
+        """Stop the delivery thread; frames not handed on by now are dropped
+
+        Returns:
+            int: Frames dropped
+        """
+        return self._delivery.close()
+
+    def stats(self):
+        return dict(self.pipeline.stats(), **{
+            "workers": self.workers,
+            "pending": self.pending(),
+            "processed": self.processed,
+            "failed": self.failed,
+            "process_ms": round(self.process_seconds / self.processed * 1000, 1) if self.processed else None,
+        })
+
+
+# Pool worker side: pipelines built once per process and spec
+_worker_pipelines = {}
+
+
+def _luminance_job(path):
+    try:
+        return luminance(path)
+    except Exception:
+        return None
+
+
+def _worker_pipeline(spec, quality):
+    key = json.dumps([spec, quality], sort_keys=True)
+    pipeline = _worker_pipelines.get(key)
+    if pipeline is None:
+        pipeline = _worker_pipelines[key] = FramePipeline(spec, quality)
+    return pipeline
+
+
+def _process_job(spec, quality, data, captured_at, gain):
+    """Render one captured frame: (JPEG, seconds spent rendering)"""
+    started = time.perf_counter()
+    result = _worker_pipeline(spec, quality).render(io.BytesIO(data), captured_at, gain)
+    return result, time.perf_counter() - started
+
+
+def _render_job(spec, quality, source, output, captured_at, gain):
+    """Render one frame to `output`; (size, None), or (None, error) if it failed"""
+    pipeline = _worker_pipeline(spec, quality)
+    try:
+        data = pipeline.render(source, captured_at, gain)
+        output = Path(output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp = output.with_name(f".{output.name}.tmp")
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, output)
+        return len(data), None
+    except Exception as e:
+        return None, str(e)
+
+
+def cache_dir(processed_dir, session_id, pipeline):
+    return Path(processed_dir) / session_id / pipeline.key
+
+
+def _load_cache(path, spec):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache.get("spec") == spec:
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {"spec": spec, "frames": {}}
+
+
+def _save_cache(path, cache):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
+def process_session(frame_store, session_id, pipeline, processed_dir, skip_unchanged=False,
+                    on_progress=None, cancel_event=None, workers=None):
+    """Process a stored session's frames through a pipeline, reusing cached results
+
+    Args:
+        frame_store: FrameStore holding the session
+        pipeline: FramePipeline
+        processed_dir: Root of the processed frame caches
+        skip_unchanged: Leave out frames change detection marked unchanged
+        on_progress: Optional callable(percent)
+        cancel_event: threading.Event that stops it when set (frames done so far stay cached)
+        workers: Pool size if the pool isn't running yet
+
+    Returns:
+        tuple: (processed frame paths in capture order, stats dict), or
+        (None, stats) if cancelled. A frame that fails to process is
+        listed as captured. stats["changed_from"] is the position of the
+        first frame not reused from the cache (rendered, or listed as
+        captured), None if there is none: an earlier video of these frames
+        is out of date from there on.
+    """
+    records = frame_store.frames(session_id)
+    if skip_unchanged:
+        skip = frame_store.unchanged(session_id)
+        records = [record for record in records if record[0] not in skip]
+    out_dir = cache_dir(processed_dir, session_id, pipeline)
+    cache_path = out_dir / 'frames.json'
+    cache = _load_cache(cache_path, pipeline.spec)
+    cached = cache["frames"]
+    total = len(records)
+
+    def output_path(frame_number):
+        return out_dir / f"{frame_number // SHARD_FRAMES:04d}" / frame_name(frame_number)
+
+    def measured():
+        # (record, luminance): cached for frames that haven't changed size
+        if pipeline.deflicker is None:
+            return ((record, None) for record in records)
+
+        def jobs():
+            for frame_number, size, _ in records:
+                entry = cached.get(str(frame_number))
+                if entry and entry[0] == size and entry[1] is not None:
+                    yield process_pool.ready(entry[1])
+                else:
+                    yield (frame_store.frame_path(session_id, frame_number),)
+        return zip(records, parallel_map(_luminance_job, jobs(), workers, cancel_event))
+
+    if pipeline.deflicker is not None:
+        gained = deflicker_gains(measured(), pipeline.deflicker.window, pipeline.deflicker.max_gain)
+    else:
+        gained = ((record, value, None) for record, value in measured())
+
+    frames = collections.deque()  # frames handed to the pool, waiting for their result
+    stats = {"frames": total, "rendered": 0, "reused": 0, "failed": 0, "changed_from": None}
+
+    def renders():
+        for (frame_number, size, captured_at), value, gain in gained:
+            frames.append((frame_number, size, value, gain))
+            entry = cached.get(str(frame_number))
+            if entry == [size, value, gain] and output_path(frame_number).exists():
+                yield process_pool.ready((None, 'cached'))
+            else:
+                yield (pipeline.spec, pipeline.quality, str(frame_store.frame_path(session_id, frame_number)),
+                       str(output_path(frame_number)), captured_at, gain)
+
+    paths = []
+    try:
+        for i, (out_size, error) in enumerate(parallel_map(_render_job, renders(), workers, cancel_event)):
+            frame_number, size, value, gain = frames.popleft()
+            if error != 'cached' and stats["changed_from"] is None:
+                stats["changed_from"] = i
+            if error == 'cached':
+                stats["reused"] += 1
+                paths.append(output_path(frame_number))
+            elif error is None:
+                stats["rendered"] += 1
+                cached[str(frame_number)] = [size, value, gain]
+                paths.append(output_path(frame_number))
+            else:
+                print(f"[Process] Could not process {session_id} frame {frame_number}: {error}")
+                stats["failed"] += 1
+                cached.pop(str(frame_number), None)
+                paths.append(frame_store.frame_path(session_id, frame_number))
+            if on_progress and i % 20 == 0:
+                on_progress(i * 100.0 / total)
+    finally:
+        _save_cache(cache_path, cache)
+    if len(paths) < total:
+        return None, stats
+    print(f"[Process] {session_id} through {', '.join(s.name for s in pipeline.stages)}: "
+          f"{stats['rendered']} frames rendered, {stats['reused']} reused")
+    return paths, stats
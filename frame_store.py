@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Frame storage layout
+
+A session's frames are spread over subdirectories of SHARD_FRAMES frames
+each, so no directory grows past a few thousand entries however long the
+session runs (a flat directory of 100,000+ frames makes every lookup,
+listing and backup crawl on an SD card):
+
+    images/<session>/frames.manifest
+    images/<session>/frames.unchanged   (frames change detection marked, if any)
+    images/<session>/0000/frame_000000.jpg ... frame_000999.jpg
+    images/<session>/0001/frame_001000.jpg ...
+
+The manifest is the session's list of frames: a small header, then one
+fixed-size record per captured frame (frame number, size, capture time),
+appended as the frame is captured. Everything that needs the frames
+(video builds, the session index, resume) reads it instead of listing
+directories; frame N's path follows from its number alone.
+
+The manifest is flushed with the frames (see frame_writer's durability
+policies) and when the session ends. After a crash its tail is made to
+agree with the session journal on resume (see rewind).
+
+Sessions captured before sharding (frames directly in images/<session>/)
+are migrated by moving their frames into shards and writing the manifest
+last; an interrupted migration is simply run again. Until then they are
+read the old way.
+
+Usage:
+    python3 frame_store.py migrate [SESSION_ID]
+"""
+
+import os
+import sys
+import shutil
+import struct
+import threading
+from pathlib import Path
+
+from frame_writer import TEMP_PREFIX, atomic_write, sync_filesystem
+
+SHARD_FRAMES = 1000
+MANIFEST_NAME = 'frames.manifest'
+UNCHANGED_NAME = 'frames.unchanged'
+
+_HEADER = struct.Struct('<4sII')  # magic, version, frames per shard
+_MAGIC = b'TLFM'
+_VERSION = 1
+_RECORD = struct.Struct('<QId')  # frame number, size, capture time
+RECORD_SIZE = _RECORD.size
+_MARK = struct.Struct('<Q')  # frame number
+
+
+def frame_name(frame_number):
+    return f"frame_{frame_number:06d}.jpg"
+
+
+def _frame_number(name):
+    """Frame number of a frame_NNNNNN.jpg file name, or None"""
+    if not (name.startswith('frame_') and name.endswith('.jpg')):
+        return None
+    try:
+        return int(name[6:-4])
+    except ValueError:
+        return None
+
+
+class FrameStore:
+    """Sharded frame files and the per-session manifest listing them"""
+
+    def __init__(self, images_dir, shard_frames=SHARD_FRAMES):
+        self.images_dir = Path(images_dir)
+        self.shard_frames = shard_frames
+        self._shards = {}  # session -> frames per shard, once known to be sharded
+        self._fds = {}
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def _session_lock(self, session_id):
+        with self._lock:
+            return self._locks.setdefault(session_id, threading.Lock())
+
+    def session_dir(self, session_id):
+        return self.images_dir / session_id
+
+    def manifest_path(self, session_id):
+        return self.images_dir / session_id / MANIFEST_NAME
+
+    def _unchanged_path(self, session_id):
+        return self.images_dir / session_id / UNCHANGED_NAME
+
+    def _shard_size(self, session_id):
+        """Frames per shard of a sharded session, or None for a flat one"""
+        shard_frames = self._shards.get(session_id)
+        if shard_frames is not None:
+            return shard_frames
+        try:
+            with open(self.manifest_path(session_id), 'rb') as f:
+                magic, version, shard_frames = _HEADER.unpack(f.read(_HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return None
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"{session_id}: unknown frame manifest format")
+        self._shards[session_id] = shard_frames
+        return shard_frames
+
+    def sharded(self, session_id):
+        return self._shard_size(session_id) is not None
+
+    def _shard_path(self, session_id, frame_number, shard_frames):
+        return self.images_dir / session_id / f"{frame_number // shard_frames:04d}" / frame_name(frame_number)
+
+    def frame_path(self, session_id, frame_number):
+        """Where frame N of a session is (or will be) stored"""
+        shard_frames = self._shard_size(session_id)
+        if shard_frames is not None:
+            return self._shard_path(session_id, frame_number, shard_frames)
+        # Not migrated yet, or part way through
+        flat = self.images_dir / session_id / frame_name(frame_number)
+        if flat.exists():
+            return flat
+        moved = self._shard_path(session_id, frame_number, self.shard_frames)
+        return moved if moved.exists() else flat
+
+    # -- writing --
+
+    def create(self, session_id):
+        """Set up a new session with an empty manifest"""
+        session_dir = self.session_dir(session_id)
+        session_dir.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.manifest_path(session_id), _HEADER.pack(_MAGIC, _VERSION, self.shard_frames))
+        self._shards[session_id] = self.shard_frames
+
+    def path_for_write(self, session_id, frame_number):
+        """Path to capture frame N to, creating its shard directory"""
+        if not self.sharded(session_id):
+            self.migrate(session_id)
+        path = self.frame_path(session_id, frame_number)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def add(self, session_id, frame_number, size, timestamp):
+        """Append a captured frame to the session's manifest
+
+        Call after the frame's file has been written. The record reaches
+        the disk with the next flush of the frames or when the session is
+        closed.
+        """
+        with self._lock:
+            fd = self._fds.get(session_id)
+            if fd is None:
+                fd = os.open(self.manifest_path(session_id), os.O_WRONLY | os.O_APPEND)
+                self._fds[session_id] = fd
+            os.write(fd, _RECORD.pack(frame_number, size, timestamp))
+
+    def mark_unchanged(self, session_id, frame_number):
+        """List a stored frame as unchanged from the one before (see change_detect)"""
+        fd = os.open(self._unchanged_path(session_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, _MARK.pack(frame_number))
+        finally:
+            os.close(fd)
+
+    def close(self, session_id):
+        """Flush and close the manifest of a session that stopped capturing"""
+        with self._lock:
+            fd = self._fds.pop(session_id, None)
+        if fd is not None:
+            os.fsync(fd)
+            os.close(fd)
+
+    def forget(self, session_id):
+        """Drop what is known about a deleted session"""
+        with self._lock:
+            fd = self._fds.pop(session_id, None)
+            self._shards.pop(session_id, None)
+        if fd is not None:
+            os.close(fd)
+
+    def rewind(self, session_id, next_frame):
+        """Make the manifest list exactly the frames before next_frame
+
+        For a session resumed after a crash: records of frames that are
+        being captured again are cut off, and frames whose record was lost
+        with the unflushed tail are added back from their files.
+
+        Returns:
+            int: Records cut off
+        """
+        if not self.sharded(session_id):
+            self.migrate(session_id)
+        self.close(session_id)
+        records = self.frames(session_id)
+        keep = [r for r in records if r[0] < next_frame]
+        cut = len(records) - len(keep)
+        last = keep[-1][0] if keep else -1
+        for frame_number in range(last + 1, next_frame):
+            try:
+                st = self.frame_path(session_id, frame_number).stat()
+            except FileNotFoundError:
+                continue
+            keep.append((frame_number, st.st_size, st.st_mtime))
+        # Rewritten even if nothing changed: a record torn by the crash would
+        # throw every record appended after it out of step
+        self._write_manifest(session_id, keep, self._shards[session_id])
+        unchanged = self.unchanged(session_id)
+        if unchanged:
+            self._write_unchanged(session_id, [n for n in sorted(unchanged) if n < next_frame])
+        return cut
+
+    def rewrite(self, session_id, records):
+        """Replace the manifest of a session that isn't capturing
+
+        Args:
+            records: (frame number, size, capture time) of every frame
+        """
+        self._write_manifest(session_id, records, self._shard_size(session_id) or self.shard_frames)
+
+    def remove_frames(self, session_id):
+        """Delete a session's frames but keep the session (its video and thumbnails)"""
+        if not self.sharded(session_id):
+            self.migrate(session_id)
+        self.close(session_id)
+        # Emptied before the files go, so no reader is sent to a missing frame
+        self.rewrite(session_id, [])
+        self._unchanged_path(session_id).unlink(missing_ok=True)
+        with os.scandir(self.session_dir(session_id)) as entries:
+            shards = [entry.path for entry in entries if entry.is_dir()]
+        for shard in shards:
+            shutil.rmtree(shard)
+
+    def _write_unchanged(self, session_id, frame_numbers):
+        atomic_write(self._unchanged_path(session_id), b''.join(_MARK.pack(n) for n in frame_numbers))
+
+    def _write_manifest(self, session_id, records, shard_frames):
+        data = _HEADER.pack(_MAGIC, _VERSION, shard_frames) + b''.join(_RECORD.pack(*r) for r in records)
+        atomic_write(self.manifest_path(session_id), data)
+        self._shards[session_id] = shard_frames
+
+    # -- reading --
+
+    def frames(self, session_id):
+        """The session's frames in capture order
+
+        Returns:
+            list of (frame number, size, capture time)
+        """
+        if not self.sharded(session_id):
+            return self._scan(session_id)
+        try:
+            with open(self.manifest_path(session_id), 'rb') as f:
+                f.seek(_HEADER.size)
+                raw = f.read()
+        except FileNotFoundError:
+            return []
+        # A record still being appended is left out
+        return list(_RECORD.iter_unpack(raw[:len(raw) - len(raw) % RECORD_SIZE]))
+
+    def unchanged(self, session_id):
+        """Numbers of the frames marked unchanged"""
+        try:
+            raw = self._unchanged_path(session_id).read_bytes()
+        except FileNotFoundError:
+            return set()
+        return {n for n, in _MARK.iter_unpack(raw[:len(raw) - len(raw) % _MARK.size])}
+
+    def frame_files(self, session_id, limit=None, skip_unchanged=False):
+        """Paths of the session's frames in capture order
+
+        Args:
+            limit: At most this many (of all frames, before skipping)
+            skip_unchanged: Leave out frames marked unchanged
+        """
+        records = self.frames(session_id)
+        if limit is not None:
+            records = records[:limit]
+        skip = self.unchanged(session_id) if skip_unchanged else ()
+        return [self.frame_path(session_id, frame_number) for frame_number, _, _ in records
+                if frame_number not in skip]
+
+    def stats(self, session_id):
+        """Frame count, total bytes and first/last capture time of a session"""
+        records = self.frames(session_id)
+        return {
+            "frame_count": len(records),
+            "bytes": sum(size for _, size, _ in records),
+            "first": min((ts for _, _, ts in records), default=None),
+            "last": max((ts for _, _, ts in records), default=None),
+        }
+
+    def sessions(self):
+        """IDs of the sessions on disk"""
+        if not self.images_dir.is_dir():
+            return []
+        with os.scandir(self.images_dir) as entries:
+            return sorted(e.name for e in entries
+                          if e.is_dir() and not e.name.startswith('.') and e.name != 'preview')
+
+    # -- migration --
+
+    def _scan(self, session_id):
+        """Frames of an unmigrated session, from its directories"""
+        session_dir = self.session_dir(session_id)
+        found = {}
+        try:
+            with os.scandir(session_dir) as entries:
+                subdirs = []
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    frame_number = _frame_number(entry.name)
+                    if frame_number is not None:
+                        st = entry.stat()
+                        found[frame_number] = (frame_number, st.st_size, st.st_mtime)
+        except FileNotFoundError:
+            return []
+        # Frames a previous, interrupted migration already moved
+        for subdir in subdirs:
+            with os.scandir(subdir) as entries:
+                for entry in entries:
+                    frame_number = _frame_number(entry.name)
+                    if frame_number is not None and frame_number not in found:
+                        st = entry.stat()
+                        found[frame_number] = (frame_number, st.st_size, st.st_mtime)
+        return [found[n] for n in sorted(found)]
+
+    def migrate(self, session_id):
+        """Move a flat session's frames into shards and write its manifest
+
+        Safe to run again after being interrupted; does nothing for a
+        session that is already sharded.
+
+        Returns:
+            int: Frames moved
+        """
+        with self._session_lock(session_id):
+            if self.sharded(session_id):
+                return 0
+            session_dir = self.session_dir(session_id)
+            if not session_dir.is_dir():
+                return 0
+            records = self._scan(session_id)
+            moved = 0
+            made = set()
+            for frame_number, _, _ in records:
+                flat = session_dir / frame_name(frame_number)
+                target = self._shard_path(session_id, frame_number, self.shard_frames)
+                if target.parent not in made:
+                    target.parent.mkdir(exist_ok=True)
+                    made.add(target.parent)
+                try:
+                    os.replace(flat, target)
+                    moved += 1
+                except FileNotFoundError:
+                    pass  # moved by the earlier attempt
+            for tmp in session_dir.glob(f"{TEMP_PREFIX}frame_*.jpg"):
+                tmp.unlink()
+            # Frames are only found through the manifest once it exists, so
+            # it goes last, after the renames are on disk
+            sync_filesystem(session_dir)
+            self._write_manifest(session_id, records, self.shard_frames)
+            if moved:
+                print(f"[Frames] Migrated {session_id}: {moved} frame(s) into "
+                      f"{len(made)} shard(s) of {self.shard_frames}")
+            return moved
+
+    def migrate_all(self, skip=()):
+        """Migrate every flat session (not those in `skip`)
+
+        Returns:
+            int: Sessions migrated
+        """
+        migrated = 0
+        for session_id in self.sessions():
+            if session_id in skip or self.sharded(session_id):
+                continue
+            try:
+                self.migrate(session_id)
+                migrated += 1
+            except OSError as e:
+                print(f"[Frames] Could not migrate {session_id}: {e}")
+        if migrated:
+            print(f"[Frames] Migrated {migrated} session(s) to sharded storage")
+        return migrated
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print(__doc__.strip().split('\n\n')[-1])
+        sys.exit(1)
+    from app import frame_store, session_index
+    if len(sys.argv) > 2:
+        frame_store.migrate(sys.argv[2])
+        session_index.rebuild(sys.argv[2])
+    else:
+        frame_store.migrate_all()
+        session_index.rebuild()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Durable frame writes
+
+Every frame is written to a hidden temp file next to its final name and
+renamed into place, so frame_NNNNNN.jpg is either absent or complete; a
+power cut mid-write leaves only a temp file (removed on resume) instead
+of a truncated JPEG that breaks compilation later.
+
+When the data reaches the SD card is a policy, trading card wear and write
+latency against how many of the newest frames a power cut can take:
+
+    frame   fsync each frame (and its directory) before it counts as
+            captured; nothing is lost, every frame pays a flush
+    count   flush the filesystem once every N frames
+    time    flush the filesystem at most every T seconds
+
+Between flushes the kernel writes back on its own schedule, so with count
+or time a power cut loses at most the frames since the last flush. Those
+frames may have been renamed into place without their data, so on resume
+the unflushed tail is checked (see intact_frames) and recaptured.
+
+A flush is one syncfs() of the frame's filesystem, which also covers the
+session journal and thumbnails written meanwhile.
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+import threading
+from pathlib import Path
+
+DURABILITY_POLICIES = ('frame', 'count', 'time')
+DEFAULT_SYNC_FRAMES = 10
+DEFAULT_SYNC_SECONDS = 30.0
+TEMP_PREFIX = '.tmp_'
+# Frames checked at the end of a session on resume when every frame was flushed
+TAIL_CHECK_FRAMES = 2
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _syncfs = _libc.syncfs
+except (OSError, AttributeError):
+    _syncfs = None
+
+
+def fsync_dir(path):
+    """Make a rename or new file in a directory durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, data):
+    """Replace a file with `data` so a crash leaves either the old or the new content"""
+    path = Path(path)
+    tmp = temp_path(path)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path.parent)
+
+
+def sync_filesystem(path):
+    """Flush everything written to the filesystem holding `path`"""
+    if _syncfs is None:
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+    finally:
+        os.close(fd)
+
+
+def temp_path(path):
+    """Temp name a frame is written under before it is renamed into place"""
+    path = Path(path)
+    return path.with_name(f"{TEMP_PREFIX}{path.name}")
+
+
+def jpeg_complete(path):
+    """Whether a frame file is a whole JPEG (ends with the EOI marker)"""
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 4:
+                return False
+            f.seek(max(0, size - 1024))
+            tail = f.read()
+    except FileNotFoundError:
+        return False
+    # Some cameras pad MJPEG frames with zeros after the marker
+    return tail.rstrip(b'\0').endswith(b'\xff\xd9')
+
+
+def intact_frames(frame_path, next_frame, window):
+    """Where to resume a session whose last frames may not have reached the disk
+
+    Checks frames next_frame-window .. next_frame-1, removes temp files
+    left by an interrupted write and the frames from the first incomplete
+    one on (they are captured again).
+
+    Args:
+        frame_path: Callable giving a frame number's file (see frame_store)
+        next_frame: Frame number the journal says comes next
+        window: How many of the last frames may be incomplete
+
+    Returns:
+        int: The first incomplete frame's number, or next_frame if all are whole
+    """
+    first = max(0, next_frame - window)
+    for directory in {frame_path(n).parent for n in range(first, next_frame + 1)}:
+        for tmp in directory.glob(f"{TEMP_PREFIX}frame_*.jpg"):
+            tmp.unlink()
+    resume_at = next_frame
+    for frame_number in range(next_frame - 1, first - 1, -1):
+        if not jpeg_complete(frame_path(frame_number)):
+            resume_at = frame_number
+    for frame_number in range(resume_at, next_frame):
+        try:
+            frame_path(frame_number).unlink()
+        except FileNotFoundError:
+            pass
+    return resume_at
+
+
+class FrameWriter:
+    """Writes frames atomically and flushes them according to a durability policy"""
+
+    def __init__(self, policy='frame', every_frames=DEFAULT_SYNC_FRAMES, every_seconds=DEFAULT_SYNC_SECONDS):
+        """
+        Args:
+            policy: 'frame', 'count' or 'time' (see DURABILITY_POLICIES)
+            every_frames: Frames between flushes with 'count'
+            every_seconds: Seconds between flushes with 'time'
+        """
+        if policy not in DURABILITY_POLICIES:
+            raise ValueError(f"Unknown durability policy {policy!r}")
+        self.policy = policy
+        self.every_frames = max(1, int(every_frames))
+        self.every_seconds = max(0.0, float(every_seconds))
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._pending_dir = None
+        self.writes = 0
+        self.syncs = 0
+        self.sync_seconds = 0.0
+
+    @property
+    def syncs_each_frame(self):
+        return self.policy == 'frame'
+
+    def write(self, path, data):
+        """Write one frame under its final name
+
+        With the 'frame' policy the frame is on disk when this returns;
+        otherwise call commit() once the frame is recorded.
+        """
+        tmp = temp_path(path)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            if self.syncs_each_frame:
+                f.flush()
+                os.fsync(f.fileno())
+        self._install(tmp, Path(path))
+
+    def place(self, tmp, path):
+        """Rename a frame written elsewhere (e.g. by libcamera-still) into place"""
+        if self.syncs_each_frame:
+            fd = os.open(tmp, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._install(tmp, Path(path))
+
+    def _install(self, tmp, path):
+        os.replace(tmp, path)
+        if self.syncs_each_frame:
+            fsync_dir(path.parent)
+        with self._lock:
+            self.writes += 1
+            self._pending_dir = path.parent
+            if not self.syncs_each_frame:
+                self._unsynced += 1
+
+    def commit(self):
+        """Flush if the policy says it's time
+
+        Returns:
+            bool: True if frames were flushed now
+        """
+        with self._lock:
+            if self.syncs_each_frame:
+                return False
+            if self.policy == 'count':
+                due = self._unsynced >= self.every_frames
+            else:
+                due = time.monotonic() - self._last_sync >= self.every_seconds
+            if not due or not self._unsynced:
+                return False
+        self.sync()
+        return True
+
+    def sync(self):
+        """Flush every frame written so far"""
+        with self._lock:
+            directory = self._pending_dir
+            if directory is None or not self._unsynced:
+                self._last_sync = time.monotonic()
+                return
+            self._unsynced = 0
+        started = time.monotonic()
+        try:
+            sync_filesystem(directory)
+        except OSError as e:
+            print(f"[Frames] Could not flush {directory}: {e}")
+            return
+        finished = time.monotonic()
+        with self._lock:
+            self._last_sync = finished
+            self.syncs += 1
+            self.sync_seconds += finished - started
+
+    def unsynced_window(self, interval):
+        """How many of the newest frames a power cut could leave incomplete
+
+        Args:
+            interval: Seconds between frames
+        """
+        if self.policy == 'frame':
+            return TAIL_CHECK_FRAMES
+        if self.policy == 'count':
+            return self.every_frames + 1
+        return int(self.every_seconds / max(interval, 0.001)) + 2
+
+    def stats(self):
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "every_frames": self.every_frames if self.policy == 'count' else None,
+                "every_seconds": self.every_seconds if self.policy == 'time' else None,
+                "writes": self.writes,
+                "syncs": self.syncs,
+                "unsynced": self._unsynced,
+                "sync_ms": round(self.sync_seconds / self.syncs * 1000, 1) if self.syncs else None,
+            }
@@ -0,0 +1,42 @@
+"""
+TimelapsePI - gunicorn configuration
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+One worker process with gevent: every request, including the long-lived
+MJPEG preview and /api/events streams, is a greenlet rather than a
+thread, so open streams don't use up workers. Capture, the job queue and
+the camera state service are threads in that same process (gevent makes
+them cooperative). See SERVING.md.
+"""
+
+import os
+
+try:
+    import gevent  # noqa: F401
+    worker_class = 'gevent'
+    worker_connections = 1000
+except ImportError:
+    # Without gevent each open stream holds one of these threads
+    worker_class = 'gthread'
+    threads = 32
+
+bind = os.environ.get('TIMELAPSEPI_BIND', '0.0.0.0:5000')
+
+# Capture state lives in the worker process, so there must be exactly one
+# (a second one would find the capture lock taken and refuse camera requests)
+workers = 1
+
+# Load the app in the worker, after gevent has patched the standard library
+preload_app = False
+
+# Streams stay open indefinitely; the worker heartbeat is separate from
+# request duration, so this only catches a wedged worker
+timeout = 120
+graceful_timeout = 10
+keepalive = 5
+
+accesslog = None
+errorlog = '-'
+loglevel = 'info'
+capture_output = True
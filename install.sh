@@ -33,6 +33,9 @@ echo "📦 Installing dependencies..."
 sudo apt-get install -y \
     python3 \
     python3-pip \
+    python3-numpy \
+    python3-pil \
+    python3-gevent \
     python3-venv \
     ffmpeg \
     avahi-daemon \
@@ -73,11 +76,13 @@ chmod +x app.py
 
 # Set up systemd service
 echo "⚙️  Setting up systemd service..."
-sudo cp timelapsepi.service /etc/systemd/system/
-sudo sed -i "s|User=pi|User=$USER|g" /etc/systemd/system/timelapsepi.service
-sudo sed -i "s|/home/pi/timelapsepi|$INSTALL_DIR|g" /etc/systemd/system/timelapsepi.service
+for unit in timelapsepi.service timelapsepi-capture.service; do
+    sudo cp $unit /etc/systemd/system/
+    sudo sed -i "s|User=pi|User=$USER|g" /etc/systemd/system/$unit
+    sudo sed -i "s|/home/pi/timelapsepi|$INSTALL_DIR|g" /etc/systemd/system/$unit
+done
 sudo systemctl daemon-reload
-sudo systemctl enable timelapsepi.service
+sudo systemctl enable timelapsepi-capture.service timelapsepi.service
 
 # Set up sudoers for system commands
 echo "🔐 Setting up sudo permissions..."
@@ -33,6 +33,9 @@ echo "📦 Installing dependencies..."
 sudo apt-get install -y \
     python3 \
     python3-pip \
+    python3-numpy \
+    python3-pil \
+    python3-gevent \
     python3-venv \
     ffmpeg \
     avahi-daemon \
@@ -59,7 +62,8 @@ cd "$INSTALL_DIR"
 
 # Create virtual environment
 echo "🐍 Creating Python virtual environment..."
-python3 -m venv venv
+# System site packages so the apt-installed NumPy/Pillow (frame metering) and gevent (serving) are visible
+python3 -m venv --system-site-packages venv
 
 # Activate and install packages
 echo "📦 Installing Python packages in virtual environment..."
@@ -85,15 +89,39 @@ echo "⚙️  Setting up systemd service..."
 cat > timelapsepi-venv.service << EOF
 [Unit]
 Description=TimelapsePI Camera Controller
+After=network.target timelapsepi-capture.service
+Wants=timelapsepi-capture.service
+
+[Service]
+Type=simple
+User=$USER
+WorkingDirectory=$INSTALL_DIR
+ExecStart=$INSTALL_DIR/venv/bin/python3 -m gunicorn -c $INSTALL_DIR/gunicorn.conf.py wsgi:application
+Restart=always
+RestartSec=10
+StandardOutput=journal
+StandardError=journal
+
+Environment="PYTHONUNBUFFERED=1"
+Environment="TIMELAPSEPI_CAPTURE=daemon"
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+cat > timelapsepi-capture-venv.service << EOF
+[Unit]
+Description=TimelapsePI Capture Daemon
 After=network.target
 
 [Service]
 Type=simple
 User=$USER
 WorkingDirectory=$INSTALL_DIR
-ExecStart=$INSTALL_DIR/venv/bin/python3 $INSTALL_DIR/app.py
+ExecStart=$INSTALL_DIR/venv/bin/python3 $INSTALL_DIR/capture_daemon.py
 Restart=always
 RestartSec=10
+TimeoutStopSec=20
 StandardOutput=journal
 StandardError=journal
 
@@ -104,8 +132,9 @@ WantedBy=multi-user.target
 EOF
 
 sudo cp timelapsepi-venv.service /etc/systemd/system/timelapsepi.service
+sudo cp timelapsepi-capture-venv.service /etc/systemd/system/timelapsepi-capture.service
 sudo systemctl daemon-reload
-sudo systemctl enable timelapsepi.service
+sudo systemctl enable timelapsepi-capture.service timelapsepi.service
 
 # Set up sudoers for system commands
 echo "🔐 Setting up sudo permissions..."
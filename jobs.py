@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Background job queue
+
+Compiles, previews and rotations run as jobs on a fixed number of worker
+threads instead of one unbounded thread per request, so a few clicks on
+big sessions can't pile up ffmpeg processes and starve the capture thread.
+Every job has an ID, a state and a progress figure (fed from ffmpeg's
+-progress output), can be cancelled, and stays inspectable through
+/api/jobs for a while after it ends.
+
+The ffmpeg processes jobs start run below capture priority (see
+video_builder.low_priority_prefix).
+"""
+
+import time
+import queue
+import threading
+import itertools
+from collections import OrderedDict
+
+JOB_STATES = ('queued', 'running', 'finished', 'failed', 'cancelled')
+DEFAULT_WORKERS = 1
+DEFAULT_HISTORY = 50
+
+
+class JobCancelled(Exception):
+    """Raised by a job function that stopped because it was cancelled"""
+
+
+class Job:
+    """One unit of background work"""
+
+    def __init__(self, job_id, kind, session_id, func, params, on_change):
+        self.id = job_id
+        self.kind = kind
+        self.session_id = session_id
+        self.params = params
+        self.state = 'queued'
+        self.progress = 0.0
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.ended = None
+        self.cancel_event = threading.Event()
+        self._func = func
+        self._on_change = on_change
+        self._done = threading.Event()
+        self._state_lock = threading.Lock()
+        self._last_report = 0
+
+    @property
+    def active(self):
+        return self.state in ('queued', 'running')
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def report(self, progress):
+        """Update progress (0-100); rate-limited notifications"""
+        self.progress = round(min(max(progress, 0.0), 100.0), 1)
+        now = time.monotonic()
+        if now - self._last_report >= 1.0:
+            self._last_report = now
+            self._notify()
+
+    def wait(self, timeout=None):
+        """Block until the job has ended; returns False on timeout"""
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "session_id": self.session_id,
+            "params": self.params,
+            "state": self.state,
+            "progress": self.progress,
+            "error": self.error,
+            "result": self.result,
+            "created": self.created,
+            "started": self.started,
+            "ended": self.ended,
+        }
+
+    def _notify(self):
+        if self._on_change:
+            try:
+                self._on_change(self)
+            except Exception as e:
+                print(f"[Jobs] Listener error: {e}")
+
+    def _end(self, state, error=None, result=None):
+        self.state = state
+        self.error = error
+        self.result = result
+        self.ended = time.time()
+        if state == 'finished':
+            self.progress = 100.0
+        self._done.set()
+        self._notify()
+
+    def _cancel(self):
+        with self._state_lock:
+            self.cancel_event.set()
+            if self.state != 'queued':
+                return
+            self.state = 'cancelled'
+        self._end('cancelled')
+
+    def _run(self):
+        with self._state_lock:
+            if self.state != 'queued':
+                return  # cancelled while waiting
+            self.state = 'running'
+            self.started = time.time()
+        self._notify()
+        try:
+            result = self._func(self)
+        except JobCancelled:
+            self._end('cancelled')
+        except Exception as e:
+            print(f"[Jobs] {self.kind} job {self.id} failed: {e}")
+            self._end('cancelled' if self.cancelled else 'failed', error=str(e))
+        else:
+            self._end('cancelled' if self.cancelled else 'finished', result=result)
+
+
+class JobQueue:
+    """FIFO of jobs executed by a fixed pool of worker threads"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, history=DEFAULT_HISTORY, on_change=None):
+        self.workers = max(1, int(workers))
+        self.history = history
+        self.on_change = on_change
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._threads = []
+
+    def submit(self, kind, func, session_id=None, params=None):
+        """Queue func(job) to run on a worker
+
+        An identical job (same kind, session and parameters) that is still
+        queued or running is returned instead of starting a second one.
+
+        Returns:
+            Job
+        """
+        params = params or {}
+        with self._lock:
+            for job in self._jobs.values():
+                if job.active and job.kind == kind and job.session_id == session_id and job.params == params:
+                    return job
+            job = Job(f"{next(self._ids)}", kind, session_id, func, params, self.on_change)
+            self._jobs[job.id] = job
+            self._trim()
+            self._start_workers()
+        print(f"[Jobs] Queued {kind} job {job.id}" + (f" for {session_id}" if session_id else ""))
+        job._notify()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list_jobs(self, session_id=None):
+        """All known jobs, newest first"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job for job in reversed(jobs) if session_id is None or job.session_id == session_id]
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job
+
+        Returns:
+            The job, or None if there is no such job
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if job.active:
+            print(f"[Jobs] Cancelling {job.kind} job {job.id}")
+            job._cancel()
+        return job
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'job-worker-{len(self._threads)}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _trim(self):
+        """Forget the oldest finished jobs beyond the history limit"""
+        ended = [job_id for job_id, job in self._jobs.items() if not job.active]
+        for job_id in ended[:max(0, len(ended) - self.history)]:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job._run()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Live encoding
+
+Optional session mode: a long-running ffmpeg process reads JPEG frames
+from a pipe (image2pipe) and writes a fragmented MP4 as the session is
+captured, so the video is always playable and is ready as soon as the
+session stops.
+
+The capture loop only hands the frame path to a bounded queue; a writer
+thread reads the file and feeds ffmpeg. If the encoder falls behind, the
+pipe fills up and the writer blocks, never the capture loop. Once the
+queue is full, new frames are left out of the live video and counted, and
+the session is compiled from the JPEGs on disk when it stops instead.
+"""
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from video_builder import ENCODER_ARGS
+
+DEFAULT_QUEUE_FRAMES = 16
+
+_STOP = object()
+
+
+def _lower_priority():
+    # Encoding must never compete with capture for the CPU
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+
+class LiveEncoder:
+    """Feeds captured frames to one ffmpeg process for the whole session"""
+
+    def __init__(self, output_file, fps=30, video_filter=None, max_queue=DEFAULT_QUEUE_FRAMES,
+                 encoder_args=None):
+        self.output_file = output_file
+        self.fps = fps
+        self.video_filter = video_filter
+        self.encoder_args = encoder_args or ENCODER_ARGS
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._process = None
+        self._thread = None
+        self._stderr = None
+        self.state = 'idle'
+        self.error = None
+        self.submitted = 0
+        self.encoded = 0
+        self.dropped = 0
+
+    @property
+    def complete(self):
+        """True if every submitted frame made it into the video"""
+        return self.state == 'finished' and self.dropped == 0 and self.encoded == self.submitted
+
+    def start(self):
+        """Start ffmpeg and the writer thread
+
+        Returns:
+            bool: True if the encoder is running
+        """
+        if not shutil.which('ffmpeg'):
+            self.state = 'failed'
+            self.error = 'ffmpeg not found'
+            return False
+
+        cmd = [
+            'ffmpeg', '-y',
+            # Start encoding from the first frame instead of buffering input
+            # to probe it (the codec is known)
+            '-probesize', '32', '-analyzeduration', '0',
+            '-f', 'image2pipe',
+            '-c:v', 'mjpeg',
+            '-framerate', str(self.fps),
+            '-i', '-',
+        ]
+        if self.video_filter:
+            cmd.extend(['-vf', self.video_filter])
+        cmd.extend(self.encoder_args)
+        # No lookahead (x264 would otherwise hold back ~40 frames, minutes of
+        # capture) and a keyframe, so a new fragment, every second of output:
+        # the file stays playable up to the last few frames
+        if 'libx264' in self.encoder_args:
+            cmd.extend(['-tune', 'zerolatency'])
+        cmd.extend([
+            '-g', str(self.fps),
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-flush_packets', '1',
+            '-f', 'mp4',
+            str(self.output_file)
+        ])
+
+        self._stderr = tempfile.TemporaryFile()
+        try:
+            self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                             stderr=self._stderr, preexec_fn=_lower_priority)
+        except OSError as e:
+            self._stderr.close()
+            self.state = 'failed'
+            self.error = str(e)
+            return False
+
+        self.state = 'running'
+        self._thread = threading.Thread(target=self._writer, name='live-encoder', daemon=True)
+        self._thread.start()
+        print(f"[Live] Encoding to {self.output_file.name} at {self.fps} fps")
+        return True
+
+    def submit(self, frame_path):
+        """Queue a captured frame for encoding (never blocks)
+
+        Returns:
+            bool: False if the frame was left out of the live video
+        """
+        if self.state != 'running':
+            return False
+        self.submitted += 1
+        try:
+            self._queue.put_nowait(frame_path)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            print(f"[Live] Encoder behind, {frame_path.name} left out of live video")
+            return False
+
+    def finish(self, timeout=None):
+        """Encode the remaining queued frames and close the MP4
+
+        Returns:
+            bool: True if the video contains every submitted frame
+        """
+        if self._thread is None:
+            return False
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self.error = 'timed out finishing encode'
+            self._process.kill()
+            self._thread.join()
+        if self.state == 'running':
+            self.state = 'finished'
+        print(f"[Live] {self.state}: {self.encoded}/{self.submitted} frames encoded, "
+              f"{self.dropped} dropped")
+        return self.complete
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'submitted': self.submitted,
+            'encoded': self.encoded,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize(),
+            'error': self.error,
+        }
+
+    def _writer(self):
+        stdin = self._process.stdin
+        try:
+            while True:
+                frame_path = self._queue.get()
+                if frame_path is _STOP:
+                    break
+                if self.state != 'running':
+                    continue  # ffmpeg is gone: just drain the queue
+                try:
+                    with open(frame_path, 'rb') as f:
+                        data = f.read()
+                    stdin.write(data)
+                    stdin.flush()
+                    self.encoded += 1
+                except BrokenPipeError:
+                    self._fail('ffmpeg exited')
+                except OSError as e:
+                    print(f"[Live] Could not read {frame_path}: {e}")
+        finally:
+            try:
+                stdin.close()
+            except OSError:
+                pass
+            returncode = self._process.wait()
+            if returncode != 0 and self.state == 'running':
+                self._fail(f'ffmpeg exited with {returncode}')
+            self._stderr.close()
+
+    def _fail(self, reason):
+        self._stderr.seek(0)
+        tail = self._stderr.read().decode('utf-8', 'replace')[-300:]
+        self.state = 'failed'
+        self.error = f"{reason}: {tail}" if tail else reason
+        print(f"[Live] Encoder failed: {self.error}")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Status polling vs. server push load test
+
+Starts the app on a loopback port and connects N simulated browsers, first
+using the old polling model (GET /api/status every 1 s, /api/sessions every
+10 s) and then the event stream (/api/events). A background thread inside
+the server publishes a frame event every --event-interval seconds to mimic
+a running timelapse. Reports HTTP requests/s, events delivered and server
+CPU usage (from /proc) for each model and client count.
+
+Usage:
+    python3 loadtest_events.py [--clients 1,5,10] [--duration 20] [--event-interval 5]
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+
+BOOTSTRAP = '''
+import sys, time, threading
+sys.path.insert(0, {root!r})
+import app
+
+def fake_session():
+    frame = 0
+    while True:
+        time.sleep({event_interval})
+        app.publish_status('frame', session_id='loadtest', frame=frame, lateness_ms=0.0)
+        frame += 1
+
+threading.Thread(target=fake_session, daemon=True).start()
+app.app.run(host='127.0.0.1', port={port}, debug=False, threaded=True)
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are fields 14 and 15 (1-based), i.e. 11/12 after the comm
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def start_server(port, event_interval):
+    root = os.path.dirname(os.path.abspath(__file__))
+    code = BOOTSTRAP.format(root=root, port=port, event_interval=event_interval)
+    server = subprocess.Popen([sys.executable, '-c', code],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.events = 0
+
+    def add(self, requests=0, events=0):
+        with self.lock:
+            self.requests += requests
+            self.events += events
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('GET', path)
+    conn.getresponse().read()
+    conn.close()
+
+
+def polling_client(port, stop, counters):
+    tick = 0
+    while not stop.is_set():
+        get(port, '/api/status')
+        counters.add(requests=1)
+        if tick % 10 == 0:
+            get(port, '/api/sessions')
+            counters.add(requests=1)
+        tick += 1
+        stop.wait(1.0)
+
+
+def push_client(port, stop, counters):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('GET', '/api/events')
+    response = conn.getresponse()
+    counters.add(requests=1)
+    # The initial sessions load the page does once
+    get(port, '/api/sessions')
+    counters.add(requests=1)
+    while not stop.is_set():
+        line = response.fp.readline()
+        if not line:
+            break
+        if line.startswith(b'event:'):
+            counters.add(events=1)
+            if line.strip() == b'event: sessions':
+                get(port, '/api/sessions')
+                counters.add(requests=1)
+    conn.close()
+
+
+def run_model(model, clients, duration, port, pid):
+    stop = threading.Event()
+    counters = Counters()
+    target = polling_client if model == 'poll' else push_client
+    threads = [threading.Thread(target=target, args=(port, stop, counters), daemon=True)
+               for _ in range(clients)]
+
+    cpu_start = cpu_seconds(pid)
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    elapsed = time.monotonic() - started
+    cpu_used = cpu_seconds(pid) - cpu_start
+    return counters.requests / elapsed, counters.events, cpu_used / elapsed * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', default='1,5,10', help='comma separated client counts')
+    parser.add_argument('--duration', type=float, default=20, help='seconds per run')
+    parser.add_argument('--event-interval', type=float, default=5,
+                        help='seconds between simulated frame events')
+    args = parser.parse_args()
+
+    print(f"{'model':<6} {'clients':>7} {'req/s':>8} {'events':>7} {'server CPU':>11}")
+    for clients in [int(c) for c in args.clients.split(',')]:
+        for model in ('poll', 'push'):
+            # Fresh server per run so push streams from the last run don't linger
+            port = free_port()
+            server = start_server(port, args.event_interval)
+            try:
+                time.sleep(1.0)  # let startup work (device scan) finish
+                rate, events, cpu = run_model(model, clients, args.duration, port, server.pid)
+            finally:
+                server.kill()
+                server.wait()
+            print(f"{model:<6} {clients:>7} {rate:>8.2f} {events:>7} {cpu:>10.1f}%")
+
+
+if __name__ == '__main__':
+    main()
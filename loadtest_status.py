@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Status latency under open preview streams
+
+Starts the app on a loopback port with a simulated camera, opens N MJPEG
+preview streams (/api/camera/preview) that keep reading, and meanwhile
+hammers /api/status from --pollers concurrent keep-alive clients. Reports
+status requests/s, p50/p99 latency, the preview frame rate each stream
+actually got, and server CPU, for the Flask development server and for
+the production setup (gunicorn -c gunicorn.conf.py, when gunicorn is
+installed).
+
+Usage:
+    python3 loadtest_status.py [--streams 0,4,16] [--pollers 4] [--duration 10]
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Imported by gunicorn (as loadtest_app:application) or run directly for the
+# development server. The camera is simulated: the preview producer hands
+# out a canned 640x480 JPEG.
+BOOTSTRAP = '''
+import io, sys
+sys.path.insert(0, {root!r})
+import app as timelapse
+
+try:
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (640, 480), (90, 120, 150)).save(buf, 'JPEG', quality=80)
+    JPEG = buf.getvalue()
+except ImportError:
+    JPEG = b'\\xff\\xd8' + bytes(30000) + b'\\xff\\xd9'
+
+timelapse.detect_camera = lambda: 'usb'
+timelapse.preview_stream.grab = lambda: JPEG
+timelapse.preview_stream.release = None
+timelapse.claim_capture()
+application = timelapse.app
+
+if __name__ == '__main__':
+    application.run(host='127.0.0.1', port=int(sys.argv[1]), debug=False, threaded=True)
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid):
+    """utime + stime of a process and its reaped children"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return sum(int(x) for x in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+
+
+def worker_pid(pid):
+    """The gunicorn worker under an arbiter (or the process itself)"""
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = f.read().split()
+        return int(children[0]) if children else pid
+    except OSError:
+        return pid
+
+
+def start_server(kind, port, bootstrap_dir):
+    if kind == 'gunicorn':
+        cmd = ['gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), '-b', f'127.0.0.1:{port}',
+               '--pythonpath', f'{bootstrap_dir},{ROOT}', 'loadtest_app:application']
+    else:
+        cmd = [sys.executable, os.path.join(bootstrap_dir, 'loadtest_app.py'), str(port)]
+    server = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/status')
+            conn.getresponse().read()
+            conn.close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"{kind} server did not start")
+
+
+def preview_client(port, stop, frames, index):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('GET', '/api/camera/preview')
+    response = conn.getresponse()
+    if response.status != 200:
+        return
+    while not stop.is_set():
+        line = response.fp.readline()
+        if not line:
+            break
+        if line.startswith(b'--frame'):
+            frames[index] += 1
+    conn.close()
+
+
+def status_client(port, stop, latencies):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while not stop.is_set():
+        started = time.perf_counter()
+        conn.request('GET', '/api/status')
+        conn.getresponse().read()
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(kind, streams, pollers, duration, bootstrap_dir):
+    port = free_port()
+    server = start_server(kind, port, bootstrap_dir)
+    try:
+        stop = threading.Event()
+        frames = [0] * streams
+        viewers = [threading.Thread(target=preview_client, args=(port, stop, frames, i), daemon=True)
+                   for i in range(streams)]
+        for t in viewers:
+            t.start()
+        time.sleep(1.0)  # streams connected and producing
+
+        latencies = []
+        clients = [threading.Thread(target=status_client, args=(port, stop, latencies), daemon=True)
+                   for _ in range(pollers)]
+        pid = worker_pid(server.pid)
+        cpu_start = cpu_seconds(pid)
+        frames_start = list(frames)
+        started = time.monotonic()
+        for t in clients:
+            t.start()
+        time.sleep(duration)
+        stop.set()
+        elapsed = time.monotonic() - started
+        cpu = (cpu_seconds(pid) - cpu_start) / elapsed * 100
+        for t in clients:
+            t.join(5)
+        stream_fps = [(after - before) / elapsed for before, after in zip(frames_start, frames)]
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    return {
+        'rate': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50) * 1000 if latencies else float('nan'),
+        'p99': percentile(latencies, 0.99) * 1000 if latencies else float('nan'),
+        'fps': min(stream_fps) if stream_fps else None,
+        'cpu': cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--streams', default='0,4,16', help='comma separated preview stream counts')
+    parser.add_argument('--pollers', type=int, default=4, help='concurrent /api/status clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--servers', default='dev,gunicorn', help='dev and/or gunicorn')
+    args = parser.parse_args()
+
+    servers = args.servers.split(',')
+    if 'gunicorn' in servers and subprocess.run(['which', 'gunicorn'], capture_output=True).returncode != 0:
+        print("gunicorn not installed, skipping the production setup")
+        servers.remove('gunicorn')
+
+    with tempfile.TemporaryDirectory() as bootstrap_dir:
+        with open(os.path.join(bootstrap_dir, 'loadtest_app.py'), 'w') as f:
+            f.write(BOOTSTRAP.format(root=ROOT))
+
+        print(f"{args.pollers} status pollers, {args.duration:g} s per run")
+        print(f"{'server':<9} {'streams':>7} {'req/s':>8} {'p50':>8} {'p99':>8} {'min fps':>8} {'server CPU':>11}")
+        for kind in servers:
+            for streams in [int(s) for s in args.streams.split(',')]:
+                result = run(kind, streams, args.pollers, args.duration, bootstrap_dir)
+                fps = f"{result['fps']:.1f}" if result['fps'] is not None else '-'
+                print(f"{kind:<9} {streams:>7} {result['rate']:>8.0f} {result['p50']:>6.1f}ms "
+                      f"{result['p99']:>6.1f}ms {fps:>8} {result['cpu']:>10.1f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Media file serving
+
+send_media() serves videos and frames with:
+
+- HTTP Range requests (206 Partial Content), so seeking in the browser's
+  video player fetches only the part it needs. A single range, open-ended
+  ranges and suffix ranges are supported; a multi-range request gets the
+  whole file (allowed by RFC 9110, and players don't send them).
+- Conditional requests: a strong ETag from inode, size and mtime,
+  If-None-Match (304), and If-Range, so a resumed download never mixes two
+  versions of a file that was rotated or recompiled meanwhile.
+- Zero-copy where the server can do it. The open file is handed to the
+  server's wsgi.file_wrapper, positioned at the range start and limited by
+  Content-Length; gunicorn turns that into sendfile(2). Servers without a
+  file wrapper (the Flask development server) get large pread() chunks
+  instead of the 8 KB reads of the default.
+
+Files that are still growing (a live-encoded session) are served up to
+their size when the request arrives.
+"""
+
+import os
+import re
+import stat
+import mimetypes
+
+from flask import Response, request
+
+CHUNK_SIZE = 1024 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileBody:
+    """Response body reading `length` bytes from `offset` of an open file
+
+    Exposes fileno() and a file position at `offset`, so a WSGI file
+    wrapper can send it with sendfile().
+    """
+
+    def __init__(self, f, offset, length, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.offset = offset
+        self.remaining = length
+        self.chunk_size = chunk_size
+        f.seek(offset)
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = os.pread(self.f.fileno(), size, self.offset)
+        self.offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self.f.close()
+
+
+def parse_range(header, size):
+    """Byte range requested by a Range header
+
+    Args:
+        header: Range header value
+        size: File size
+
+    Returns:
+        (start, end) inclusive, None to serve the whole file (no header,
+        unsupported unit, several ranges), or 'unsatisfiable'
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip().replace(' ', ''))
+    if not match:
+        return None  # other units or several ranges: send everything
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return 'unsatisfiable'
+    return start, end
+
+
+def make_etag(st):
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    # Weak comparison for If-None-Match
+    tags = [t.strip() for t in header.split(',')]
+    return any(t.removeprefix('W/') == etag for t in tags)
+
+
+def send_media(path, mimetype=None, as_attachment=False, download_name=None, max_age=0):
+    """Serve a file with Range, ETag and zero-copy support
+
+    Args:
+        path: File to send
+        mimetype: Content type (guessed from the name if None)
+        as_attachment: Send Content-Disposition: attachment
+        download_name: File name offered to the browser
+        max_age: Cache-Control max-age; 0 means revalidate each time (cheap 304s)
+
+    Returns:
+        flask.Response (200, 206, 304 or 416), or None if the file doesn't exist
+    """
+    try:
+        f = open(path, 'rb')
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    try:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            f.close()
+            return None
+        size = st.st_size
+        etag = make_etag(st)
+        mimetype = mimetype or mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+
+        headers = {
+            'ETag': etag,
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': f'max-age={max_age}' if max_age else 'no-cache',
+        }
+        if as_attachment:
+            name = download_name or os.path.basename(str(path))
+            headers['Content-Disposition'] = f'attachment; filename="{name}"'
+
+        if _etag_matches(request.headers.get('If-None-Match'), etag):
+            f.close()
+            return Response(status=304, headers=headers)
+
+        byte_range = parse_range(request.headers.get('Range'), size)
+        if_range = request.headers.get('If-Range')
+        if byte_range is not None and if_range and if_range.strip() != etag:
+            byte_range = None  # the file changed since the client's copy: send it all
+
+        if byte_range == 'unsatisfiable':
+            f.close()
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+
+        if byte_range is None:
+            status, start, length = 200, 0, size
+        else:
+            start, end = byte_range
+            status, length = 206, end - start + 1
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(length)
+
+        body = FileBody(f, start, length)
+        if request.method == 'HEAD':
+            body.close()
+            body = b''
+        else:
+            file_wrapper = request.environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                body = file_wrapper(body, CHUNK_SIZE)
+    except Exception:
+        f.close()
+        raise
+
+    response = Response(body, status=status, mimetype=mimetype, headers=headers,
+                        direct_passthrough=True)
+    if request.method == 'HEAD':
+        response.headers['Content-Length'] = str(length)
+    return response
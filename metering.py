@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Frame metering
+
+Luminance statistics (mean, centre-weighted mean, percentiles, histogram)
+of captured frames, computed in-process. With Pillow the JPEG is decoded
+straight to greyscale at 1/8 scale (DCT scaling via Image.draft, no full
+decode); NumPy does the counting. Without NumPy the same numbers come
+from a pure-Python pass over the ~5000-pixel thumbnail, and without Pillow
+a single ffmpeg call produces the thumbnail instead.
+
+Results are cached per frame, so the IR controller and the UI share one
+decode.
+"""
+
+import io
+import os
+import threading
+import subprocess
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+THUMBNAIL_SIZE = (80, 60)
+HISTOGRAM_BINS = 32
+CACHE_SIZE = 128
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def backend():
+    """Which decode/statistics path is in use"""
+    decode = 'pillow' if Image is not None else 'ffmpeg'
+    return f"{decode}+{'numpy' if np is not None else 'python'}"
+
+
+def decode_luminance(path=None, data=None, size=THUMBNAIL_SIZE, exact=False):
+    """Reduced-size greyscale decode of a JPEG frame
+
+    Also used for change detection signatures (change_detect.py).
+
+    Args:
+        path: JPEG file
+        data: JPEG bytes already in memory (skips reading the file)
+        size: (width, height) to scale down to
+        exact: Box-filter to exactly `size` instead of fitting within it
+               with the aspect ratio kept (ffmpeg always scales to `size`)
+
+    Returns:
+        tuple: (8-bit pixels as bytes, width, height)
+
+    Raises:
+        ValueError: ffmpeg could not decode the frame
+    """
+    width, height = size
+    if Image is not None:
+        with Image.open(io.BytesIO(data) if data is not None else path) as im:
+            # Ask the JPEG decoder for a reduced-size greyscale decode
+            im.draft('L', (width * 2, height * 2))
+            im = im.convert('L')
+            if exact:
+                im = im.resize(size, Image.BOX)
+            else:
+                im.thumbnail(size)
+            return im.tobytes(), im.width, im.height
+
+    result = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', 'pipe:0' if data is not None else str(path),
+         '-vf', f'scale={width}:{height}:flags=area,format=gray', '-f', 'rawvideo', '-'],
+        input=data, capture_output=True, timeout=5
+    )
+    if result.returncode != 0 or len(result.stdout) != width * height:
+        raise ValueError(f"ffmpeg could not decode frame: {result.stderr[-200:]!r}")
+    return result.stdout, width, height
+
+
+def _histogram_and_center(pixels, width, height):
+    """256-bin histogram and the mean of the central half of the frame"""
+    x0, x1 = width // 4, width - width // 4
+    y0, y1 = height // 4, height - height // 4
+    if np is not None:
+        arr = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width)
+        hist = np.bincount(arr.ravel(), minlength=256).tolist()
+        center = float(arr[y0:y1, x0:x1].mean())
+        return hist, center
+
+    hist = [0] * 256
+    for value in pixels:
+        hist[value] += 1
+    center_total = 0
+    for y in range(y0, y1):
+        center_total += sum(pixels[y * width + x0:y * width + x1])
+    return hist, center_total / ((y1 - y0) * (x1 - x0))
+
+
+def _percentile(hist, total, fraction):
+    target = fraction * total
+    running = 0
+    for value, count in enumerate(hist):
+        running += count
+        if running >= target:
+            return value
+    return 255
+
+
+def compute_stats(path=None, data=None):
+    """Luminance statistics of one JPEG (uncached)
+
+    Args:
+        path: JPEG file
+        data: JPEG bytes already in memory (skips reading the file)
+
+    Returns:
+        dict with mean, center_mean, p5, p50, p95 (0-255) and a
+        HISTOGRAM_BINS-bin histogram of pixel fractions
+    """
+    pixels, width, height = decode_luminance(path, data)
+    hist, center = _histogram_and_center(pixels, width, height)
+    total = width * height
+    step = 256 // HISTOGRAM_BINS
+    return {
+        "mean": round(sum(value * count for value, count in enumerate(hist)) / total, 1),
+        "center_mean": round(center, 1),
+        "p5": _percentile(hist, total, 0.05),
+        "p50": _percentile(hist, total, 0.50),
+        "p95": _percentile(hist, total, 0.95),
+        "histogram": [round(sum(hist[i:i + step]) / total, 4) for i in range(0, 256, step)],
+    }
+
+
+def meter_frame(path, data=None):
+    """Cached luminance statistics of a frame file
+
+    Args:
+        path: Frame file (cache key, together with its size and mtime)
+        data: The frame's bytes if the caller still has them
+
+    Returns:
+        dict from compute_stats(), or None if the frame can't be decoded
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (str(path), st.st_mtime_ns, st.st_size)
+
+    with _cache_lock:
+        stats = _cache.get(key)
+        if stats is not None:
+            _cache.move_to_end(key)
+            return stats
+
+    try:
+        stats = compute_stats(path, data)
+    except Exception as e:
+        print(f"[Metering] Could not meter {path}: {e}")
+        return None
+
+    with _cache_lock:
+        _cache[key] = stats
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return stats
+
+
+class IRController:
+    """Decides when to switch a camera's IR mode, with hysteresis
+
+    IR turns on after `frames` consecutive frames darker than `on_below`
+    and off after `frames` consecutive frames brighter than `off_above`;
+    the device is only touched when the state actually changes.
+    """
+
+    def __init__(self, set_ir, on_below=30, off_above=50, frames=3):
+        """
+        Args:
+            set_ir: Callable(enable) that switches the device, returns True on success
+            on_below: Brightness (0-255) under which IR should come on
+            off_above: Brightness over which IR should go off
+            frames: Consecutive frames needed before switching
+        """
+        self.set_ir = set_ir
+        self.on_below = on_below
+        self.off_above = off_above
+        self.frames = frames
+        self.state = None  # unknown until first switched
+        self._pending = None
+        self._streak = 0
+        self._lock = threading.Lock()
+
+    def force(self, enable):
+        """'on'/'off' modes: switch only if not already in that state"""
+        with self._lock:
+            self._streak = 0
+            self._apply(enable)
+
+    def update(self, brightness):
+        """'auto' mode: feed one frame's brightness
+
+        Returns:
+            The new state if this frame caused a switch, else None
+        """
+        with self._lock:
+            if brightness < self.on_below:
+                wanted = True
+            elif brightness > self.off_above:
+                wanted = False
+            else:
+                self._streak = 0  # in the dead band: keep the current state
+                return None
+
+            if wanted == self.state:
+                self._streak = 0
+                return None
+            if wanted != self._pending:
+                self._pending = wanted
+                self._streak = 0
+            self._streak += 1
+            if self._streak < self.frames:
+                return None
+            self._streak = 0
+            return wanted if self._apply(wanted) else None
+
+    def _apply(self, enable):
+        if enable == self.state:
+            return False
+        if self.set_ir(enable):
+            self.state = enable
+            return True
+        return False
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Live preview stream
+
+One producer thread fills a small ring buffer of preview JPEGs; every
+connected viewer reads from that ring on its own. A viewer that falls
+more than a ring's length behind skips straight to the oldest frame still
+held, so the preview is never more than `ring` frames stale for anyone,
+and a slow viewer never holds up the producer or other viewers.
+
+The producer asks a grab callback for a frame at most `fps` times a
+second, while at least one viewer is connected. Frames can also be
+offered by the capture loop (each timelapse frame during a session) so
+the preview keeps running when the camera is busy. Frames larger than the
+preview size are scaled down (Pillow's reduced-size JPEG decode); without
+Pillow they are passed through as they are.
+"""
+
+import io
+import time
+import threading
+import itertools
+from collections import deque
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DEFAULT_FPS = 5
+DEFAULT_SIZE = (640, 480)
+DEFAULT_RING = 3
+KEEPALIVE_SECONDS = 5
+# How long the producer keeps the camera after the last viewer leaves
+IDLE_SECONDS = 2.0
+
+
+def scale_jpeg(data, size, quality=80):
+    """Shrink a JPEG to fit within size (returned unchanged if it already fits)"""
+    if Image is None:
+        return data
+    with Image.open(io.BytesIO(data)) as im:
+        if im.width <= size[0] and im.height <= size[1]:
+            return data
+        # Let the JPEG decoder do most of the downscaling
+        im.draft('RGB', size)
+        im = im.convert('RGB')
+        im.thumbnail(size)
+        out = io.BytesIO()
+        im.save(out, 'JPEG', quality=quality)
+        return out.getvalue()
+
+
+class PreviewClient:
+    """One connected viewer"""
+
+    def __init__(self, client_id):
+        self.id = client_id
+        self.sent = 0
+        self.dropped = 0
+        self.last_seq = 0
+
+
+class PreviewStream:
+    """Single-producer preview frames fanned out to any number of viewers"""
+
+    def __init__(self, grab, release=None, fps=DEFAULT_FPS, size=DEFAULT_SIZE, ring=DEFAULT_RING):
+        """
+        Args:
+            grab: Callable returning one JPEG (bytes), or None if no frame is available now
+            release: Callable run when the producer stops (e.g. close the camera)
+            fps: Maximum preview frame rate
+            size: Maximum preview (width, height)
+            ring: Frames kept; also the most a viewer can lag behind
+        """
+        self.grab = grab
+        self.release = release
+        self.fps = fps
+        self.size = tuple(size)
+        self._ring = deque(maxlen=ring)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._clients = {}
+        self._client_ids = itertools.count(1)
+        self._offered = None
+        self._wake = threading.Event()
+        self._thread = None
+        self.produced = 0
+        self.grab_errors = 0
+
+    @property
+    def client_count(self):
+        return len(self._clients)
+
+    def configure(self, fps=None, size=None):
+        """Change the frame rate / size caps (applies from the next frame)"""
+        if fps:
+            self.fps = max(0.1, float(fps))
+        if size:
+            self.size = (int(size[0]), int(size[1]))
+
+    def offer(self, frame):
+        """Hand over a frame captured elsewhere (never blocks, no work if nobody watches)"""
+        if not self._clients:
+            return
+        self._offered = frame
+        self._wake.set()
+
+    def stats(self):
+        with self._cond:
+            clients = list(self._clients.values())
+        return {
+            "clients": len(clients),
+            "fps": self.fps,
+            "size": list(self.size),
+            "produced": self.produced,
+            "dropped": sum(c.dropped for c in clients),
+            "grab_errors": self.grab_errors,
+        }
+
+    def frames(self):
+        """Generate preview JPEGs for one viewer until it disconnects
+
+        Waits for frames newer than the last one sent; if the viewer fell
+        behind the ring, the missed frames are counted as dropped. With no
+        new frame for KEEPALIVE_SECONDS the last one is repeated, which is
+        also how a silently disconnected viewer gets noticed.
+        """
+        client = self._connect()
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._seq > client.last_seq, KEEPALIVE_SECONDS)
+                    if not self._ring:
+                        continue
+                    oldest_seq = self._seq - len(self._ring) + 1
+                    next_seq = max(client.last_seq + 1, oldest_seq)
+                    if next_seq > self._seq:
+                        next_seq = self._seq  # keepalive: repeat the newest
+                    else:
+                        client.dropped += next_seq - client.last_seq - 1
+                    frame = self._ring[next_seq - oldest_seq]
+                    client.last_seq = next_seq
+                client.sent += 1
+                yield frame
+        finally:
+            self._disconnect(client)
+
+    # -- producer --
+
+    def _connect(self):
+        client = PreviewClient(next(self._client_ids))
+        with self._cond:
+            # Start from the newest frame, not the oldest in the ring
+            client.last_seq = max(0, self._seq - 1)
+            self._clients[client.id] = client
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._produce, name='preview', daemon=True)
+                self._thread.start()
+        print(f"[Preview] Viewer {client.id} connected ({len(self._clients)} watching)")
+        return client
+
+    def _disconnect(self, client):
+        with self._cond:
+            self._clients.pop(client.id, None)
+        self._wake.set()
+        print(f"[Preview] Viewer {client.id} left after {client.sent} frames "
+              f"({client.dropped} skipped), {len(self._clients)} watching")
+
+    def _push(self, frame):
+        with self._cond:
+            self._ring.append(frame)
+            self._seq += 1
+            self.produced += 1
+            self._cond.notify_all()
+
+    def _produce(self):
+        idle_since = None
+        next_grab = time.monotonic()
+        try:
+            while True:
+                if not self._clients:
+                    idle_since = idle_since or time.monotonic()
+                    if time.monotonic() - idle_since >= IDLE_SECONDS:
+                        with self._cond:
+                            if not self._clients:
+                                self._thread = None
+                                return
+                else:
+                    idle_since = None
+
+                frame, self._offered = self._offered, None
+                if frame is None and self._clients and time.monotonic() >= next_grab:
+                    next_grab = time.monotonic() + 1.0 / self.fps
+                    try:
+                        frame = self.grab()
+                    except Exception as e:
+                        self.grab_errors += 1
+                        if self.grab_errors == 1 or self.grab_errors % 50 == 0:
+                            print(f"[Preview] Could not grab a frame: {e}")
+                        next_grab = time.monotonic() + 1.0  # back off
+
+                if frame is not None:
+                    try:
+                        self._push(scale_jpeg(frame, self.size))
+                    except Exception as e:
+                        print(f"[Preview] Bad frame: {e}")
+
+                self._wake.wait(max(0.0, min(next_grab - time.monotonic(), IDLE_SECONDS)))
+                self._wake.clear()
+        finally:
+            if self.release:
+                try:
+                    self.release()
+                except Exception as e:
+                    print(f"[Preview] Release error: {e}")
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Shared process pool
+
+Merging bursts (burst.py) and post-processing frames (frame_pipeline.py)
+is CPU-bound NumPy/Pillow work that threads can't spread over the Pi's
+cores. Both use one pool of worker processes, created by whichever needs
+it first with the configured size (process_workers; by default one less
+than the CPU cores, leaving one to the capture loop and web server).
+
+The workers are spawned, not forked: a forked worker would inherit the
+open camera devices (their V4L2 buffers could then never be released)
+and the capture lock's flock, and outlive the server holding them. A
+spawned worker starts from this module alone, not from the server's main
+module, and imports what a job needs when it gets one.
+
+Results are handed back on the pool's management thread, which must not
+wait on disk or the database; OrderedDelivery passes them on in submit
+order from a thread of its owner's instead.
+"""
+
+import os
+import sys
+import time
+import threading
+import contextlib
+import collections
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+_pool = None
+_workers = None
+_lock = threading.Lock()
+# How long each worker's start-up job runs, so that every worker is
+# started while the main module is swapped (see get_pool)
+_STARTUP_SECONDS = 0.2
+
+
+def default_workers():
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def get_pool(workers=None):
+    """The shared pool, started on first use
+
+    Args:
+        workers: Processes to start it with (None: default_workers()); once
+                 it is running the pool keeps its size
+    """
+    global _pool, _workers
+    with _lock:
+        if _pool is None:
+            _workers = workers or default_workers()
+            pool = ProcessPoolExecutor(max_workers=_workers, mp_context=multiprocessing.get_context('spawn'))
+            # A spawning pool starts a worker per submit until it is full;
+            # start them all now, each busy long enough that none is reused
+            with _slim_main():
+                started = [pool.submit(_started) for _ in range(_workers)]
+                pids = {future.result() for future in started}
+            _pool = pool
+            print(f"[Pool] Started {len(pids)} worker process(es)")
+        return _pool
+
+
+@contextlib.contextmanager
+def _slim_main():
+    """Spawned workers re-import the main module first; make that this one
+
+    Otherwise each worker would run app.py (or capture_daemon.py) over
+    again. Only the workers being started meanwhile see the swap.
+    """
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def _started():
+    time.sleep(_STARTUP_SECONDS)
+    return os.getpid()
+
+
+def size():
+    """Processes in the pool (what it would start with if it isn't running yet)"""
+    return _workers or default_workers()
+
+
+def ready(value):
+    """A future that is already done, for results that need no pool work"""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class OrderedDelivery:
+    """Hands pool results to a callback in submit order, on a thread of its own"""
+
+    def __init__(self, on_result, name='delivery'):
+        """
+        Args:
+            on_result: callable(key, future, context) run for each submitted
+                       item once its future is done, in submit order
+            name: Name of the delivery thread
+        """
+        self.on_result = on_result
+        self.name = name
+        self._pending = collections.deque()  # [key, future or callable, context]
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def pending(self):
+        """Items submitted and not handed on yet"""
+        with self._cond:
+            return len(self._pending)
+
+    def submit(self, key, work, context=None):
+        """Queue an item
+
+        Args:
+            key: Passed on to on_result (e.g. the frame number)
+            work: A Future, or a callable returning one; a callable is called
+                  on the delivery thread, in submit order, so it can keep
+                  state across items (and need not be quick)
+            context: Passed on to on_result
+
+        Raises:
+            RuntimeError: close() has been called
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"{self.name} is closed")
+            self._pending.append([key, work, context])
+            self._cond.notify_all()
+        if isinstance(work, Future):
+            work.add_done_callback(self._wake)
+
+    def _wake(self, _future):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _next(self):
+        """(entry to prepare, None), (None, entry to deliver) or (None, None)"""
+        for entry in self._pending:
+            if not isinstance(entry[1], Future):
+                return entry, None
+        if self._pending and self._pending[0][1].done():
+            return None, self._pending[0]
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                prepare, deliver = self._next()
+                while not self._closed and prepare is None and deliver is None:
+                    self._cond.wait()
+                    prepare, deliver = self._next()
+                if self._closed:
+                    return
+            if prepare is not None:
+                try:
+                    future = prepare[1]()
+                except Exception as e:
+                    future = Future()
+                    future.set_exception(e)
+                with self._cond:
+                    prepare[1] = future
+                future.add_done_callback(self._wake)
+                continue
+            key, future, context = deliver
+            try:
+                self.on_result(key, future, context)
+            except Exception as e:
+                print(f"[Pool] ERROR: {self.name}: handing on {key} failed: {e}")
+            with self._cond:
+                if self._pending and self._pending[0] is deliver:  # unless closed meanwhile
+                    self._pending.popleft()
+                self._cond.notify_all()
+
+    def drain(self, timeout=None, leave=0):
+        """Wait until every submitted item has been handed on
+
+        Args:
+            leave: Return as soon as no more than this many are pending
+
+        Returns:
+            bool: False if more were still pending at the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while len(self._pending) > leave:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        """Stop the delivery thread, dropping what is still pending
+
+        Returns:
+            int: Items dropped
+        """
+        with self._cond:
+            self._closed = True
+            dropped = list(self._pending)
+            self._pending.clear()
+            self._cond.notify_all()
+        for _, work, _ in dropped:
+            if isinstance(work, Future):
+                work.cancel()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        return len(dropped)
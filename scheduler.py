@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Capture scheduling
+
+Frames are fired on absolute deadlines (origin + n * interval on the
+monotonic clock) instead of sleeping `interval` after each capture, so the
+time spent capturing never accumulates into drift.
+"""
+
+import time
+from datetime import datetime
+
+# What to do when a capture runs past the start of the next slot:
+#   skip    - drop the missed slots and wait for the next slot boundary,
+#             keeping frames aligned to the original grid
+#   catchup - fire the missed slots back-to-back until back on schedule,
+#             so the session ends up with the expected number of frames
+#   shift   - restart the grid from now, keeping the spacing between
+#             frames but moving every later slot
+OVERRUN_POLICIES = ('skip', 'catchup', 'shift')
+
+# Wall-clock waits are re-checked at least this often so that a clock
+# correction (NTP sync on a Pi without an RTC) is picked up
+_WALL_CLOCK_RECHECK = 30.0
+
+
+def parse_schedule_time(value):
+    """Parse an ISO datetime from the API (accepts a trailing 'Z')
+
+    Returns:
+        datetime or None if value is empty
+    """
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def seconds_until(when):
+    """Seconds from now until a (possibly timezone-aware) datetime"""
+    return (when - datetime.now(when.tzinfo or None)).total_seconds()
+
+
+def wait_until(when, stop_event):
+    """Block until a wall-clock time, returning early if stop_event is set
+
+    Returns:
+        bool: True if the time was reached, False if cancelled
+    """
+    while True:
+        remaining = seconds_until(when)
+        if remaining <= 0:
+            return not stop_event.is_set()
+        if stop_event.wait(min(remaining, _WALL_CLOCK_RECHECK)):
+            return False
+
+
+class DeadlineScheduler:
+    """Fires capture slots on absolute monotonic deadlines
+
+    Usage:
+        scheduler = DeadlineScheduler(interval, policy='skip')
+        while scheduler.wait(stop_event):
+            capture()
+            scheduler.advance()
+    """
+
+    def __init__(self, interval, policy='skip', origin=None):
+        if policy not in OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy '{policy}', use one of {', '.join(OVERRUN_POLICIES)}")
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+        self.interval = float(interval)
+        self.policy = policy
+        self.origin = time.monotonic() if origin is None else origin
+        self.slot = 0
+        self.deadline = self.origin
+        self.lateness = 0.0
+
+        # Stats
+        self.frames = 0
+        self.overruns = 0
+        self.skipped_slots = 0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    def wait(self, stop_event, max_wait=None):
+        """Sleep until the current slot's deadline
+
+        Args:
+            stop_event: threading.Event that cancels the wait immediately
+            max_wait: Optional cap in seconds (e.g. time left until a scheduled end)
+
+        Returns:
+            bool: True when it's time to capture, False if cancelled or max_wait ran out first
+        """
+        remaining = self.deadline - time.monotonic()
+        if max_wait is not None and max_wait < remaining:
+            stop_event.wait(max(0.0, max_wait))
+            return False
+        if remaining > 0 and stop_event.wait(remaining):
+            return False
+        if stop_event.is_set():
+            return False
+
+        self.lateness = max(0.0, time.monotonic() - self.deadline)
+        self.frames += 1
+        self.total_lateness += self.lateness
+        self.max_lateness = max(self.max_lateness, self.lateness)
+        return True
+
+    def advance(self):
+        """Move to the next slot after a capture, applying the overrun policy"""
+        self.slot += 1
+        self.deadline = self.origin + self.slot * self.interval
+
+        now = time.monotonic()
+        if now <= self.deadline:
+            return
+
+        # The capture overran into the next slot
+        self.overruns += 1
+        if self.policy == 'skip':
+            next_slot = int((now - self.origin) // self.interval) + 1
+            self.skipped_slots += next_slot - self.slot
+            self.slot = next_slot
+            self.deadline = self.origin + self.slot * self.interval
+        elif self.policy == 'shift':
+            self.origin = now - self.slot * self.interval
+            self.deadline = now
+        # catchup: leave the deadline in the past so the next slot fires at once
+
+    def set_interval(self, interval):
+        """Change the spacing of slots from the next one on
+
+        Call before advance(): the next slot is `interval` after the
+        current one, and the grid continues from there.
+        """
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+        self.origin = self.deadline - self.slot * interval
+        self.interval = float(interval)
+
+    def stats(self):
+        """Timing stats for the status API (milliseconds)"""
+        return {
+            "policy": self.policy,
+            "interval": self.interval,
+            "slot": self.slot,
+            "last_lateness_ms": round(self.lateness * 1000, 1),
+            "max_lateness_ms": round(self.max_lateness * 1000, 1),
+            "mean_lateness_ms": round(self.total_lateness / self.frames * 1000, 1) if self.frames else 0.0,
+            "overruns": self.overruns,
+            "skipped_slots": self.skipped_slots,
+        }
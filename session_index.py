@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Session catalog
+
+A small SQLite database that keeps per-session totals (frame count, bytes,
+first/last frame time, compiled video size and duration). The capture,
+compile, rotate and delete paths update it as they go, so listing sessions
+is a single query instead of reading every session's frame manifest and
+running ffprobe on every video.
+
+If files are changed behind the app's back, rebuild the index with:
+
+    python3 session_index.py rebuild [SESSION_ID]
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+import subprocess
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id              TEXT PRIMARY KEY,
+    created         TEXT,
+    frame_count     INTEGER NOT NULL DEFAULT 0,
+    bytes           INTEGER NOT NULL DEFAULT 0,
+    first_frame_at  REAL,
+    last_frame_at   REAL,
+    has_video       INTEGER NOT NULL DEFAULT 0,
+    video_bytes     INTEGER,
+    video_duration  REAL,
+    rotation        INTEGER NOT NULL DEFAULT 0,
+    video_baked_rotation INTEGER NOT NULL DEFAULT 0,
+    recompressed    INTEGER NOT NULL DEFAULT 0,
+    device          TEXT
+);
+"""
+
+# Columns added after the first release, with their definitions
+MIGRATIONS = {
+    'rotation': 'INTEGER NOT NULL DEFAULT 0',
+    'video_baked_rotation': 'INTEGER NOT NULL DEFAULT 0',
+    'recompressed': 'INTEGER NOT NULL DEFAULT 0',
+    'device': 'TEXT',
+}
+
+
+def probe_duration(video_file):
+    """Video duration in seconds via ffprobe, or None"""
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries',
+             'format=duration', '-of',
+             'default=noprint_wrappers=1:nokey=1', str(video_file)],
+            capture_output=True,
+            text=True,
+            timeout=5
+        )
+        if result.returncode == 0 and result.stdout.strip():
+            return float(result.stdout.strip())
+    except Exception as e:
+        print(f"[Index] Error getting duration for {video_file}: {e}")
+    return None
+
+
+def session_created_time(session_id):
+    try:
+        # Sessions started in the same second get a suffix (20250101_120000_2)
+        return datetime.strptime(session_id[:15], "%Y%m%d_%H%M%S").isoformat()
+    except ValueError:
+        # If directory name doesn't match expected format, use current time
+        return datetime.now().isoformat()
+
+
+class SessionIndex:
+    """Persistent per-session totals, updated incrementally"""
+
+    def __init__(self, db_path, frame_store, videos_dir):
+        self.db_path = db_path
+        self.frame_store = frame_store
+        self.videos_dir = videos_dir
+        self._lock = threading.Lock()
+
+        is_new = not os.path.exists(db_path)
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        # WAL + NORMAL: a frame update doesn't fsync the SD card on every commit
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(sessions)")}
+        for column, definition in MIGRATIONS.items():
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE sessions ADD COLUMN {column} {definition}")
+
+        if is_new:
+            print("[Index] New session index, building from existing files")
+            self.rebuild()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    # -- incremental updates --
+
+    def ensure_session(self, session_id):
+        self._execute(
+            "INSERT OR IGNORE INTO sessions (id, created) VALUES (?, ?)",
+            (session_id, session_created_time(session_id))
+        )
+
+    def record_frame(self, session_id, size, timestamp):
+        """Account for one newly captured frame"""
+        self._execute(
+            """INSERT INTO sessions (id, created, frame_count, bytes, first_frame_at, last_frame_at)
+               VALUES (?, ?, 1, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+                   frame_count = frame_count + 1,
+                   bytes = bytes + excluded.bytes,
+                   first_frame_at = COALESCE(first_frame_at, excluded.first_frame_at),
+                   last_frame_at = excluded.last_frame_at""",
+            (session_id, session_created_time(session_id), size, timestamp, timestamp)
+        )
+
+    def record_video(self, session_id):
+        """Refresh the compiled video's size and duration (runs ffprobe once)"""
+        video_file = self.videos_dir / f"{session_id}.mp4"
+        if not video_file.exists():
+            self.clear_video(session_id)
+            return
+        duration = probe_duration(video_file)
+        self.ensure_session(session_id)
+        self._execute(
+            "UPDATE sessions SET has_video = 1, video_bytes = ?, video_duration = ? WHERE id = ?",
+            (video_file.stat().st_size, duration, session_id)
+        )
+
+    def set_rotation(self, session_id, rotation, baked=None):
+        """Store the session's display rotation (degrees clockwise)
+
+        Args:
+            rotation: How the session should be shown, relative to the captured frames
+            baked: How much of that is encoded into the current video's pixels
+                   (None: unchanged); the rest is display-matrix metadata
+        """
+        self.ensure_session(session_id)
+        if baked is None:
+            self._execute("UPDATE sessions SET rotation = ? WHERE id = ?", (rotation, session_id))
+        else:
+            self._execute(
+                "UPDATE sessions SET rotation = ?, video_baked_rotation = ? WHERE id = ?",
+                (rotation, baked, session_id)
+            )
+
+    def set_device(self, session_id, device):
+        """Store the camera device a session captures from"""
+        self.ensure_session(session_id)
+        self._execute("UPDATE sessions SET device = ? WHERE id = ?", (device, session_id))
+
+    def set_recompressed(self, session_id):
+        """Mark a session's frames as re-encoded by the retention policy"""
+        self._execute("UPDATE sessions SET recompressed = 1 WHERE id = ?", (session_id,))
+
+    def clear_video(self, session_id):
+        self._execute(
+            "UPDATE sessions SET has_video = 0, video_bytes = NULL, video_duration = NULL WHERE id = ?",
+            (session_id,)
+        )
+
+    def delete_session(self, session_id):
+        self._execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    # -- queries --
+
+    @staticmethod
+    def _to_dict(row):
+        return {
+            "id": row["id"],
+            "frame_count": row["frame_count"],
+            "bytes": row["bytes"],
+            "has_video": bool(row["has_video"]),
+            "created": row["created"],
+            "first_frame_at": row["first_frame_at"],
+            "last_frame_at": row["last_frame_at"],
+            "video_bytes": row["video_bytes"],
+            "duration": row["video_duration"],
+            "rotation": row["rotation"],
+            "video_baked_rotation": row["video_baked_rotation"],
+            "recompressed": bool(row["recompressed"]),
+            "device": row["device"],
+        }
+
+    def list_sessions(self):
+        """All sessions with frames or a video, newest first"""
+        rows = self._execute(
+            "SELECT * FROM sessions WHERE frame_count > 0 OR has_video = 1 ORDER BY id DESC"
+        ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def totals(self):
+        """Bytes taken by all sessions' frames and videos"""
+        row = self._execute(
+            "SELECT COALESCE(SUM(bytes), 0), COALESCE(SUM(video_bytes), 0) FROM sessions"
+        ).fetchone()
+        return {"frames": row[0], "videos": row[1]}
+
+    def get(self, session_id):
+        row = self._execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    # -- recovery --
+
+    def rebuild_session(self, session_id):
+        """Recount one session from its frame manifest"""
+        if not self.frame_store.session_dir(session_id).is_dir():
+            self.delete_session(session_id)
+            return
+
+        stats = self.frame_store.stats(session_id)
+        # Upsert so metadata that isn't derived from files (rotation) survives
+        self._execute(
+            """INSERT INTO sessions (id, created, frame_count, bytes, first_frame_at, last_frame_at)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+                   frame_count = excluded.frame_count,
+                   bytes = excluded.bytes,
+                   first_frame_at = excluded.first_frame_at,
+                   last_frame_at = excluded.last_frame_at""",
+            (session_id, session_created_time(session_id), stats["frame_count"], stats["bytes"],
+             stats["first"], stats["last"])
+        )
+        self.record_video(session_id)
+
+    def rebuild(self, session_id=None):
+        """Rebuild the index from the filesystem (all sessions or just one)"""
+        if session_id:
+            self.rebuild_session(session_id)
+            return 1
+
+        on_disk = set(self.frame_store.sessions())
+        for session_id in on_disk:
+            self.rebuild_session(session_id)
+
+        for row in self._execute("SELECT id FROM sessions").fetchall():
+            if row["id"] not in on_disk:
+                self.delete_session(row["id"])
+
+        print(f"[Index] Rebuilt index for {len(on_disk)} session(s)")
+        return len(on_disk)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        print(__doc__.strip().split('\n\n')[-1])
+        sys.exit(1)
+    from app import session_index
+    session_index.rebuild(sys.argv[2] if len(sys.argv) > 2 else None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Session journal
+
+Keeps the running session on disk so capture picks up where it was after
+a service restart, crash or power cut, instead of starting over at frame 0
+and overwriting the session's first frames. Per session:
+
+    journal/<session>.json     settings and schedule, written once at start
+    journal/<session>.journal  one fixed-size record per captured frame:
+                               (frame number, capture time, CRC32)
+    journal/active             IDs of the sessions that should be running,
+                               one per line (one per camera)
+
+A frame's record is appended after the frame file has been written and
+reaches the disk together with the frame (see frame_writer's durability
+policies), so the last valid record is the last frame known to be
+captured. Resuming reads the active list, and each session's settings and
+the journal's first and last records: a handful of small reads, however
+many frames the sessions have. A record torn by a power cut fails its CRC; the
+journal is cut back to the last whole record.
+
+Small files (settings, the active list) are replaced atomically: temp
+file, fsync, rename, fsync of the directory.
+"""
+
+import os
+import json
+import zlib
+import struct
+import threading
+from pathlib import Path
+
+from frame_writer import atomic_write, fsync_dir
+
+_RECORD = struct.Struct('<QdI')  # frame number, capture time, CRC32 of the first two
+RECORD_SIZE = _RECORD.size
+_PAYLOAD_SIZE = struct.calcsize('<Qd')
+# Records searched backwards for a valid one after a torn write
+MAX_TORN_RECORDS = 8
+
+
+def _pack(frame_number, timestamp):
+    payload = struct.pack('<Qd', frame_number, timestamp)
+    return _RECORD.pack(frame_number, timestamp, zlib.crc32(payload))
+
+
+def _unpack(raw):
+    """(frame number, timestamp) of a record, or None if it is torn or corrupt"""
+    if len(raw) != RECORD_SIZE:
+        return None
+    frame_number, timestamp, crc = _RECORD.unpack(raw)
+    if zlib.crc32(raw[:_PAYLOAD_SIZE]) != crc:
+        return None
+    return frame_number, timestamp
+
+
+class SessionJournal:
+    """Write-ahead state of the capturing session"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._fds = {}
+        self._lock = threading.Lock()
+        self._active_lock = threading.Lock()
+
+    def _paths(self, session_id):
+        return self.root / f"{session_id}.json", self.root / f"{session_id}.journal"
+
+    @property
+    def _active_path(self):
+        return self.root / "active"
+
+    # -- writing --
+
+    def begin(self, session_id, settings):
+        """Start journaling a new session and mark it as one to resume
+
+        Args:
+            settings: JSON-serialisable session settings (interval, schedule, ...)
+        """
+        settings_path, journal_path = self._paths(session_id)
+        atomic_write(settings_path, json.dumps(settings, indent=2).encode())
+        with open(journal_path, 'wb'):
+            pass
+        with self._active_lock:
+            active = self.active_ids()
+            if session_id not in active:
+                self._write_active(active + [session_id])
+
+    def record(self, session_id, frame_number, timestamp, sync=True):
+        """Append one captured frame
+
+        Call after the frame's file has been written.
+
+        Args:
+            sync: Flush the record to disk now; without it the record is
+                  flushed with the frames (see frame_writer)
+        """
+        with self._lock:
+            fd = self._fds.get(session_id)
+            if fd is None:
+                _, journal_path = self._paths(session_id)
+                fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                self._fds[session_id] = fd
+            os.write(fd, _pack(frame_number, timestamp))
+            if sync:
+                os.fdatasync(fd)
+
+    def close(self, session_id):
+        """Close the session's journal, leaving it to be resumed"""
+        with self._lock:
+            fd = self._fds.pop(session_id, None)
+        if fd is not None:
+            os.close(fd)
+
+    def finish(self, session_id):
+        """The session ended: keep its journal but don't resume it"""
+        self.close(session_id)
+        with self._active_lock:
+            active = self.active_ids()
+            if session_id in active:
+                active.remove(session_id)
+                self._write_active(active)
+
+    def _write_active(self, session_ids):
+        if session_ids:
+            atomic_write(self._active_path, ''.join(f"{sid}\n" for sid in session_ids).encode())
+            return
+        try:
+            self._active_path.unlink()
+            fsync_dir(self.root)
+        except FileNotFoundError:
+            pass
+
+    def remove(self, session_id):
+        """Forget a deleted session"""
+        self.finish(session_id)
+        for path in self._paths(session_id):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    # -- reading --
+
+    def active_ids(self):
+        """IDs of the sessions that were running, in the order they started"""
+        try:
+            return self._active_path.read_text().split()
+        except FileNotFoundError:
+            return []
+
+    def first(self, session_id):
+        """(frame number, timestamp) of the session's first recorded frame, or None"""
+        _, journal_path = self._paths(session_id)
+        try:
+            with open(journal_path, 'rb') as f:
+                return _unpack(f.read(RECORD_SIZE))
+        except FileNotFoundError:
+            return None
+
+    def last(self, session_id, repair=False):
+        """(frame number, timestamp) of the session's last valid record, or None
+
+        Args:
+            repair: Cut off a torn or corrupt tail so new records follow the
+                    last valid one
+        """
+        _, journal_path = self._paths(session_id)
+        try:
+            f = open(journal_path, 'r+b' if repair else 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            end = size - size % RECORD_SIZE
+            found = None
+            for _ in range(MAX_TORN_RECORDS):
+                if end <= 0:
+                    break
+                f.seek(end - RECORD_SIZE)
+                found = _unpack(f.read(RECORD_SIZE))
+                if found is not None:
+                    break
+                end -= RECORD_SIZE
+            if found is None:
+                end = 0
+            if repair and end != size:
+                print(f"[Journal] {session_id}: dropped {size - end} byte(s) of torn records")
+                f.truncate(end)
+                os.fsync(f.fileno())
+            return found
+
+    def active(self):
+        """The sessions to resume
+
+        Returns:
+            list of dicts with session_id, settings, next_frame,
+            first_capture and last_capture (timestamps or None); empty if no
+            session was running
+        """
+        sessions = []
+        for session_id in self.active_ids():
+            state = self._resume_state(session_id)
+            if state is not None:
+                sessions.append(state)
+        return sessions
+
+    def _resume_state(self, session_id):
+        settings_path, _ = self._paths(session_id)
+        try:
+            settings = json.loads(settings_path.read_text())
+        except (FileNotFoundError, ValueError) as e:
+            print(f"[Journal] Can't resume {session_id}, settings unreadable: {e}")
+            return None
+        last = self.last(session_id, repair=True)
+        first = self.first(session_id) if last else None
+        return {
+            "session_id": session_id,
+            "settings": settings,
+            "next_frame": last[0] + 1 if last else 0,
+            "first_capture": first[1] if first else None,
+            "last_capture": last[1] if last else None,
+        }
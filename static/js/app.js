@@ -8,6 +8,9 @@ let currentState = {
 };
 
 let updateInterval = null;
+let lastStatus = null;
+let pollTimers = [];
+let eventSource = null;
 
 // Initialize on page load
 document.addEventListener('DOMContentLoaded', () => {
@@ -16,11 +19,123 @@ document.addEventListener('DOMContentLoaded', () => {
     checkStatus();
     loadSessions();
     
-    // Update status every second when active
-    setInterval(checkStatus, 1000);
-    setInterval(loadSessions, 10000); // Refresh sessions every 10 seconds
+    // Status changes are pushed by the server; polling is only a fallback
+    connectEvents();
+    
+    // Keep the duration counter ticking between pushed updates
+    setInterval(() => {
+        if (lastStatus && lastStatus.active) {
+            updateUI(lastStatus);
+        }
+    }, 1000);
 });
 
+function startPolling() {
+    if (pollTimers.length > 0) return;
+    console.log('Event stream unavailable, falling back to polling');
+    checkStatus();
+    pollTimers.push(setInterval(checkStatus, 1000));
+    pollTimers.push(setInterval(loadSessions, 10000)); // Refresh sessions every 10 seconds
+}
+
+function stopPolling() {
+    pollTimers.forEach(timer => clearInterval(timer));
+    pollTimers = [];
+}
+
+function connectEvents() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    
+    eventSource = new EventSource('/api/events');
+    
+    // If the stream doesn't come up quickly, poll until it does
+    const openTimeout = setTimeout(() => {
+        if (eventSource.readyState !== EventSource.OPEN) {
+            startPolling();
+        }
+    }, 5000);
+    
+    eventSource.addEventListener('open', () => {
+        clearTimeout(openTimeout);
+        stopPolling();
+        // We may have missed changes while disconnected
+        loadSessions();
+    });
+    
+    eventSource.addEventListener('error', () => {
+        startPolling();
+        if (eventSource.readyState === EventSource.CLOSED) {
+            // The browser gave up reconnecting (e.g. server without /api/events)
+            clearTimeout(openTimeout);
+            setTimeout(connectEvents, 30000);
+        }
+    });
+    
+    const onStatus = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.status) {
+            applyStatus(data.status);
+        }
+        return data;
+    };
+    
+    eventSource.addEventListener('status', onStatus);
+    eventSource.addEventListener('frame', onStatus);
+    eventSource.addEventListener('session', onStatus);
+    eventSource.addEventListener('devices', (event) => {
+        onStatus(event);
+        loadCameraDevices();
+    });
+    eventSource.addEventListener('sessions', () => loadSessions());
+    eventSource.addEventListener('job', (event) => {
+        showJobProgress(JSON.parse(event.data));
+    });
+    eventSource.addEventListener('resync', () => {
+        checkStatus();
+        loadSessions();
+    });
+}
+
+function showJobProgress(job) {
+    if (job.kind !== 'compile' && job.kind !== 'rotate') {
+        return;
+    }
+    const progress = document.getElementById(`compile-progress-${job.session_id}`);
+    if (!progress) {
+        return;
+    }
+    if (job.state === 'failed') {
+        console.error(`${job.kind} job ${job.id} failed:`, job.error);
+        progress.textContent = job.kind === 'compile' ? '❌ Compilation failed' : '❌ Rotation failed';
+        return;
+    }
+    if (job.state === 'finished' || job.state === 'cancelled') {
+        progress.textContent = '';
+        return;
+    }
+    
+    const label = job.kind === 'compile' ? '🎬 Compiling' : '🔄 Rotating';
+    progress.textContent = job.state === 'queued'
+        ? `⏳ Queued for ${job.kind === 'compile' ? 'compilation' : 'rotation'} `
+        : `${label}... ${Math.round(job.progress || 0)}% `;
+    const cancel = document.createElement('button');
+    cancel.className = 'btn btn-secondary';
+    cancel.textContent = 'Cancel';
+    cancel.onclick = () => cancelJob(job.id);
+    progress.appendChild(cancel);
+}
+
+async function cancelJob(jobId) {
+    try {
+        await fetch(`/api/jobs/${jobId}/cancel`, { method: 'POST' });
+    } catch (error) {
+        console.error('Error cancelling job:', error);
+    }
+}
+
 function initializeUI() {
     const startBtn = document.getElementById('startBtn');
     const stopBtn = document.getElementById('stopBtn');
@@ -120,16 +235,21 @@ async function checkStatus() {
         const response = await fetch('/api/status');
         const data = await response.json();
         
-        currentState.active = data.active;
-        currentState.sessionId = data.session_id;
-        currentState.interval = data.interval;
-        
-        updateUI(data);
+        applyStatus(data);
     } catch (error) {
         console.error('Error checking status:', error);
     }
 }
 
+function applyStatus(data) {
+    lastStatus = data;
+    currentState.active = data.active;
+    currentState.sessionId = data.session_id;
+    currentState.interval = data.interval;
+    
+    updateUI(data);
+}
+
 function updateUI(status) {
     const statusBadge = document.getElementById('statusBadge');
     const statusText = document.getElementById('statusText');
@@ -207,6 +327,16 @@ function updateUI(status) {
             status.ir_mode === 'on' ? '✅ Always On' : 
             'Off';
         
+        // Brightness of the last frame (0-255) and whether IR is on
+        const metering = status.metering;
+        const brightness = document.getElementById('brightnessStatus');
+        if (metering && metering.session_id === status.session_id) {
+            const ir = metering.ir_on === true ? ' · IR on' : (metering.ir_on === false ? ' · IR off' : '');
+            brightness.textContent = `${Math.round(metering.center_mean)} (${metering.p5}–${metering.p95})${ir}`;
+        } else {
+            brightness.textContent = '-';
+        }
+        
     } else {
         // Timelapse is stopped
         statusBadge.classList.remove('active');
@@ -230,6 +360,7 @@ async function startTimelapse() {
     const endDateTime = document.getElementById('endDateTime');
     const autoAdjustCheckbox = document.getElementById('autoAdjustCheckbox');
     const irModeSelect = document.getElementById('irModeSelect');
+    const liveEncodeCheckbox = document.getElementById('liveEncodeCheckbox');
     
     const interval = parseInt(intervalInput.value);
     const [width, height] = resolutionSelect.value.split(',').map(Number);
@@ -243,7 +374,8 @@ async function startTimelapse() {
         interval: interval,
         resolution: [width, height],
         auto_adjust: autoAdjustCheckbox.checked,
-        ir_mode: irModeSelect.value
+        ir_mode: irModeSelect.value,
+        live_encode: liveEncodeCheckbox.checked
     };
     
     // Add scheduled times if checkbox is checked
@@ -299,11 +431,13 @@ async function stopTimelapse() {
     }
     
     try {
+        // Only the session shown here; sessions on other cameras keep recording
         const response = await fetch('/api/stop', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
-            }
+            },
+            body: JSON.stringify({ session_id: currentState.sessionId })
         });
         
         const data = await response.json();
@@ -339,6 +473,13 @@ async function loadSessions() {
         
         sessionsList.innerHTML = data.sessions.map(session => `
             <div class="session-item-no-preview">
+                ${session.frame_count > 0 ? `
+                    <div class="session-preview">
+                        <img src="/api/sessions/${session.id}/thumbnails/0" loading="lazy" alt=""
+                             data-session="${session.id}" data-frames="${session.frame_count}"
+                             onmousemove="scrubThumbnail(event, this)" onmouseleave="scrubThumbnail(null, this)">
+                    </div>
+                ` : ''}
                 <div class="session-info">
                     <h3>Session ${session.id}</h3>
                     <p>📸 Frames: ${session.frame_count}</p>
@@ -346,10 +487,11 @@ async function loadSessions() {
                     ${session.has_video && session.duration ? 
                         `<p>⏱️ Duration: ${formatDuration(Math.round(session.duration))}</p>` : ''}
                     <p>${session.has_video ? '✅ Video compiled' : '⏳ No video yet'}</p>
+                    <p class="compile-progress" id="compile-progress-${session.id}"></p>
                 </div>
                 <div class="session-actions">
                     ${!session.has_video ? `
-                        <button class="btn btn-success" onclick="compileVideo('${session.id}')">
+                        <button class="btn btn-success" onclick="compileVideo('${session.id}', ${session.rotation || 0})">
                             🎬 Compile Video
                         </button>
                     ` : `
@@ -370,18 +512,40 @@ async function loadSessions() {
             </div>
         `).join('');
         
+        // Re-attach progress of jobs still queued or running
+        const jobsResponse = await fetch('/api/jobs');
+        const jobsData = await jobsResponse.json();
+        jobsData.jobs
+            .filter(job => job.state === 'queued' || job.state === 'running')
+            .forEach(showJobProgress);
+        
     } catch (error) {
         console.error('Error loading sessions:', error);
         sessionsList.innerHTML = '<p class="loading">Error loading sessions</p>';
     }
 }
 
-async function compileVideo(sessionId) {
+function scrubThumbnail(event, img) {
+    // Show the frame under the pointer; thumbnails are small and cached by the browser
+    const frames = parseInt(img.dataset.frames);
+    let frame = 0;
+    if (event) {
+        const rect = img.getBoundingClientRect();
+        const position = Math.min(Math.max((event.clientX - rect.left) / rect.width, 0), 1);
+        frame = Math.min(frames - 1, Math.floor(position * frames));
+    }
+    if (img.dataset.frame !== String(frame)) {
+        img.dataset.frame = frame;
+        img.src = `/api/sessions/${img.dataset.session}/thumbnails/${frame}`;
+    }
+}
+
+async function compileVideo(sessionId, currentRotation = 0) {
     // Create a custom dialog for compilation options
     const fps = prompt('Enter frame rate for video (default: 30fps):', '30');
     if (!fps) return;
     
-    const rotation = prompt('Rotate video? Enter 0 (none), 90 (clockwise), 180, or 270 (counter-clockwise):', '0');
+    const rotation = prompt('Rotate video? Enter 0 (none), 90 (clockwise), 180, or 270 (counter-clockwise):', String(currentRotation));
     if (rotation === null) return;
     
     const rotationValue = parseInt(rotation);
@@ -406,7 +570,7 @@ async function compileVideo(sessionId) {
         const data = await response.json();
         
         if (data.success) {
-            alert('Video compilation started! This may take a few minutes. Refresh the page to check progress.');
+            alert('Video compilation queued! Progress is shown in the sessions list.');
             setTimeout(loadSessions, 2000);
         } else {
             alert('Error compiling video: ' + (data.error || 'Unknown error'));
@@ -479,6 +643,22 @@ async function loadCameraSettings() {
                 controlsSection.style.display = 'block';
             }
             
+            // Use this camera's ranges (set before the values so they aren't clamped)
+            const sliders = {
+                brightness: 'brightnessSlider',
+                contrast: 'contrastSlider',
+                saturation: 'saturationSlider',
+                exposure_absolute: 'exposureSlider'
+            };
+            for (const [name, range] of Object.entries(data.ranges || {})) {
+                const slider = sliders[name] && document.getElementById(sliders[name]);
+                if (slider && range.min !== null && range.max !== null) {
+                    slider.min = range.min;
+                    slider.max = range.max;
+                    if (range.step) slider.step = range.step;
+                }
+            }
+
             // Update sliders with current values
             if (data.controls.brightness !== undefined) {
                 document.getElementById('brightnessSlider').value = data.controls.brightness;
@@ -815,6 +995,23 @@ async function shutdownSystem() {
     }
 }
 
+async function waitForJob(jobId, onProgress) {
+    while (true) {
+        const response = await fetch(`/api/jobs/${jobId}`);
+        const job = await response.json();
+        if (!response.ok) {
+            return { state: 'failed', error: job.error };
+        }
+        if (job.state === 'finished' || job.state === 'failed' || job.state === 'cancelled') {
+            return job;
+        }
+        if (onProgress) {
+            onProgress(job);
+        }
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+    }
+}
+
 async function previewCurrentSession() {
     const btn = document.getElementById('previewCurrentBtn');
     const originalText = btn.textContent;
@@ -831,7 +1028,18 @@ async function previewCurrentSession() {
             body: JSON.stringify({ fps: 30 })
         });
         
-        const data = await response.json();
+        let data = await response.json();
+        
+        if (response.status === 202) {
+            // Still encoding: follow the job until it ends
+            btn.textContent = '⏳ Encoding...';
+            const job = await waitForJob(data.job_id, (job) => {
+                btn.textContent = `⏳ Encoding... ${Math.round(job.progress || 0)}%`;
+            });
+            data = job.state === 'finished'
+                ? { success: true, preview_url: data.preview_url }
+                : { error: job.state === 'cancelled' ? 'Preview cancelled' : job.error };
+        }
         
         if (data.success) {
             // Open preview modal with current session video
@@ -906,8 +1114,7 @@ async function rotateVideo(sessionId) {
         const data = await response.json();
         
         if (data.success) {
-            alert('Video rotation started! This may take a minute. Refresh to see the result.');
-            setTimeout(loadSessions, 3000);
+            alert('Video rotation queued! Progress is shown in the sessions list.');
         } else {
             alert('Error rotating video: ' + (data.error || 'Unknown error'));
         }
@@ -937,8 +1144,8 @@ async function loadCameraDevices() {
                 select.appendChild(option);
             });
             
-            // Add change handler
-            select.addEventListener('change', async (e) => {
+            // Add change handler (replaced, not stacked, when the list is reloaded)
+            select.onchange = async (e) => {
                 const newDevice = e.target.value;
                 try {
                     const response = await fetch('/api/camera/device', {
@@ -966,7 +1173,7 @@ async function loadCameraDevices() {
                     alert('Error changing camera device');
                     loadCameraDevices(); // Reload to reset selection
                 }
-            });
+            };
         } else {
             const option = document.createElement('option');
             option.textContent = 'No cameras detected';
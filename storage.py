@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Storage quota and retention
+
+Keeps capture from running the SD card full. Free space comes from one
+statvfs() call per frame, usage from the session index's running totals
+(updated as frames are captured and videos compiled, never by walking
+the disk), and the fill rate from the sizes of the last frames captured
+by all cameras, so the status can say how long until the card is full.
+
+Below two free-space thresholds capture degrades rather than failing
+every frame:
+
+    low     (free < storage_low_free_mb)  only every Nth frame of each session
+            is captured (storage_degrade_every) and the retention
+            policies are run
+    full    (free < storage_min_free_mb)  capture pauses; the session keeps
+            running and captures again once space has been freed
+
+Compiling is refused while the card is full, since it writes another copy
+of the session. While space is low the cached video segments of sessions
+not being captured are dropped too; the next compile encodes them again.
+
+Retention policies (all off by default) are applied by a job after each
+compile, at startup and when space runs low, never to the sessions being
+captured:
+
+    retention_keep_sessions                 keep only the newest N sessions
+    retention_max_gb                        delete the oldest sessions while
+                                            all sessions take more than this
+    retention_delete_frames_after_compile   delete a session's frames once its
+                                            video is compiled (thumbnails stay)
+    retention_recompress_after_days         re-encode the frames of sessions
+                                            older than this, at most
+                                            retention_recompress_width wide and
+                                            at retention_recompress_quality
+"""
+
+import os
+import time
+import threading
+import collections
+
+from frame_writer import sync_filesystem, temp_path
+from thumbnails import make_thumbnail
+
+DEFAULT_MIN_FREE_MB = 300
+DEFAULT_LOW_FREE_MB = 1024
+DEFAULT_DEGRADE_EVERY = 2
+DEFAULT_RECOMPRESS_WIDTH = 1280
+DEFAULT_RECOMPRESS_QUALITY = 75
+# Free space must recover this far past a threshold before capture returns
+# to normal, so it doesn't flap around the threshold
+RECOVER_MARGIN_MB = 50
+# Frames the fill rate is measured over
+RATE_WINDOW = 30
+# A recompressed frame must be at least this much smaller to replace the original
+RECOMPRESS_MIN_SAVING = 0.9
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+def disk_space(path):
+    """Size and free space (available to this user) of the filesystem holding `path`"""
+    st = os.statvfs(path)
+    return {"total": st.f_blocks * st.f_frsize, "free": st.f_bavail * st.f_frsize}
+
+
+def recompress_session(frame_store, session_id, width=DEFAULT_RECOMPRESS_WIDTH, quality=DEFAULT_RECOMPRESS_QUALITY,
+                       on_progress=None, cancel_event=None):
+    """Re-encode a session's frames smaller, in place
+
+    Frames that wouldn't get noticeably smaller are left alone, so running
+    it again does little. The session must not be capturing.
+
+    Args:
+        frame_store: FrameStore holding the session
+        width: Maximum frame width
+        quality: JPEG quality
+        on_progress: Optional callable(percent)
+        cancel_event: threading.Event that stops it when set (frames done so far stay)
+
+    Returns:
+        int: Bytes saved
+    """
+    records = frame_store.frames(session_id)
+    updated = []
+    saved = 0
+    for i, (frame_number, size, captured_at) in enumerate(records):
+        if cancel_event is not None and cancel_event.is_set():
+            updated.extend(records[i:])
+            break
+        path = frame_store.frame_path(session_id, frame_number)
+        try:
+            data = make_thumbnail(path, width=width, quality=quality)
+        except FileNotFoundError:
+            updated.append((frame_number, size, captured_at))
+            continue
+        except Exception as e:
+            print(f"[Storage] Could not recompress {session_id} frame {frame_number}: {e}")
+            updated.append((frame_number, size, captured_at))
+            continue
+        if len(data) < size * RECOMPRESS_MIN_SAVING:
+            tmp = temp_path(path)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+            saved += size - len(data)
+            size = len(data)
+        updated.append((frame_number, size, captured_at))
+        if on_progress and i % 20 == 0:
+            on_progress(i * 100.0 / len(records))
+    # Frames first, then the manifest with their new sizes
+    sync_filesystem(frame_store.session_dir(session_id))
+    frame_store.rewrite(session_id, updated)
+    print(f"[Storage] Recompressed {session_id}: {saved / MB:.1f} MB saved")
+    return saved
+
+
+class StorageManager:
+    """Free space checks, fill-rate forecast and retention planning"""
+
+    def __init__(self, path, usage=None, on_change=None):
+        """
+        Args:
+            path: A directory on the filesystem the frames are stored on
+            usage: Optional callable returning the bytes used by kind
+                   ({"frames": ..., "videos": ..., ...})
+            on_change: Optional callable(state, previous_state) run when the
+                       state ('ok', 'low' or 'full') changes
+        """
+        self.path = path
+        self.usage = usage
+        self.on_change = on_change
+        self.state = 'ok'
+        self._lock = threading.Lock()
+        self._frames = collections.deque(maxlen=RATE_WINDOW)
+        self._ticks = collections.Counter()  # frames due, by session
+        self.skipped = 0
+        self.configure({})
+
+    def configure(self, config):
+        """Take thresholds and retention policies from the app config"""
+        self.min_free = config.get('storage_min_free_mb', DEFAULT_MIN_FREE_MB) * MB
+        self.low_free = max(self.min_free, config.get('storage_low_free_mb', DEFAULT_LOW_FREE_MB) * MB)
+        self.degrade_every = max(1, int(config.get('storage_degrade_every', DEFAULT_DEGRADE_EVERY)))
+        self.keep_sessions = config.get('retention_keep_sessions')
+        self.max_bytes = config.get('retention_max_gb') and config['retention_max_gb'] * GB
+        self.delete_frames_after_compile = bool(config.get('retention_delete_frames_after_compile', False))
+        self.recompress_after_days = config.get('retention_recompress_after_days')
+        self.recompress_width = config.get('retention_recompress_width', DEFAULT_RECOMPRESS_WIDTH)
+        self.recompress_quality = config.get('retention_recompress_quality', DEFAULT_RECOMPRESS_QUALITY)
+
+    # -- capture --
+
+    def record_frame(self, size, timestamp):
+        """Account for a captured frame in the fill rate"""
+        with self._lock:
+            self._frames.append((timestamp, size))
+
+    def reset_rate(self):
+        """Forget the fill rate (capture stopped, or the first session started)"""
+        with self._lock:
+            self._frames.clear()
+            self._ticks.clear()
+            self.skipped = 0
+
+    def rate(self):
+        """Bytes per second captured recently, or 0 if not capturing"""
+        with self._lock:
+            frames = list(self._frames)
+        if len(frames) < 2 or frames[-1][0] <= frames[0][0]:
+            return 0.0
+        return sum(size for _, size in frames[1:]) / (frames[-1][0] - frames[0][0])
+
+    def check(self):
+        """Look at the free space and update the state
+
+        Returns:
+            str: 'ok', 'low' or 'full'
+        """
+        try:
+            free = disk_space(self.path)["free"]
+        except OSError as e:
+            print(f"[Storage] Could not check free space: {e}")
+            return self.state
+        previous = self.state
+        margin = RECOVER_MARGIN_MB * MB
+        if free < self.min_free or (previous == 'full' and free < self.min_free + margin):
+            state = 'full'
+        elif free < self.low_free or (previous != 'ok' and free < self.low_free + margin):
+            state = 'low'
+        else:
+            state = 'ok'
+        if state != previous:
+            self.state = state
+            print(f"[Storage] {previous} -> {state}: {free / MB:.0f} MB free")
+            if self.on_change:
+                self.on_change(state, previous)
+        return state
+
+    def admit(self, session_id=None):
+        """Whether a capture loop should take the frame that is due
+
+        Args:
+            session_id: Session the frame is for; each session is thinned
+                        out on its own
+
+        Returns:
+            bool: False while the card is full, and for all but every
+                  degrade_every-th frame of the session while it is low
+        """
+        state = self.check()
+        with self._lock:
+            self._ticks[session_id] += 1
+            ticks = self._ticks[session_id]
+        admitted = state == 'ok' or (state == 'low' and ticks % self.degrade_every == 0)
+        if not admitted:
+            self.skipped += 1
+        return admitted
+
+    # -- reporting --
+
+    def status(self):
+        try:
+            disk = disk_space(self.path)
+        except OSError:
+            disk = {"total": None, "free": None}
+        rate = self.rate()
+        usable = disk["free"] - self.min_free if disk["free"] is not None else None
+        return {
+            "state": self.state,
+            "total_bytes": disk["total"],
+            "free_bytes": disk["free"],
+            "usage": self.usage() if self.usage else None,
+            "capture_bytes_per_s": round(rate, 1),
+            # Until capture pauses, at the current rate
+            "seconds_to_full": round(max(0, usable) / rate) if rate and usable is not None else None,
+            "skipped_frames": self.skipped,
+            "min_free_bytes": self.min_free,
+            "low_free_bytes": self.low_free,
+        }
+
+    # -- retention --
+
+    def plan_retention(self, sessions, protect=(), now=None):
+        """What the retention policies would do now
+
+        Args:
+            sessions: Session dicts from SessionIndex.list_sessions() (newest first)
+            protect: Session IDs to leave alone (the ones being captured)
+            now: Current time (default: time.time())
+
+        Returns:
+            list of (action, session_id): 'delete', 'delete_frames' or 'recompress'
+        """
+        now = time.time() if now is None else now
+        actions = []
+        deleted = set()
+
+        def delete(session):
+            if session["id"] not in protect and session["id"] not in deleted:
+                deleted.add(session["id"])
+                actions.append(('delete', session["id"]))
+
+        if self.keep_sessions is not None:
+            for session in sessions[self.keep_sessions:]:
+                delete(session)
+
+        if self.max_bytes:
+            total = 0
+            for i, session in enumerate(sessions):
+                total += session["bytes"] + (session["video_bytes"] or 0)
+                # The newest session is kept even if it alone is over the cap
+                if i and total > self.max_bytes:
+                    delete(session)
+
+        for session in sessions:
+            if session["id"] in protect or session["id"] in deleted or not session["frame_count"]:
+                continue
+            if self.delete_frames_after_compile and session["has_video"]:
+                actions.append(('delete_frames', session["id"]))
+            elif self.recompress_after_days is not None and not session.get("recompressed") \
+                    and session["last_frame_at"] \
+                    and now - session["last_frame_at"] > self.recompress_after_days * 86400:
+                actions.append(('recompress', session["id"]))
+        return actions
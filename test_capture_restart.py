@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Capture daemon integration test
+
+Starts a session, then crashes (SIGKILL) and restarts (SIGTERM) the web
+server while the capture daemon keeps running, stops the session and
+checks the frames' timestamps: no gap between consecutive frames may be
+longer than 1.5 intervals, and the session must still be the one that was
+started.
+
+By default both processes are started from this checkout with a
+simulated camera (runs anywhere; the web server is gunicorn if installed,
+else the Flask development server). With --systemd it runs against the
+installed services on a Pi with a real camera, restarting the web side
+with `sudo systemctl restart timelapsepi`.
+
+Usage:
+    python3 test_capture_restart.py [--interval 1] [--systemd [--url http://localhost:5000]]
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+import urllib.error
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+IMAGES_DIR = os.path.join(ROOT, 'timelapse_data', 'images')
+
+# The capture daemon with a simulated V4L2 camera
+DAEMON_BOOTSTRAP = '''
+import io, os, sys
+sys.path.insert(0, {root!r})
+os.environ.pop('TIMELAPSEPI_CAPTURE', None)
+import app as timelapse
+import capture_daemon
+
+try:
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (640, 480), (90, 120, 150)).save(buf, 'JPEG', quality=80)
+    JPEG = buf.getvalue()
+except ImportError:
+    JPEG = b'\\xff\\xd8' + bytes(30000) + b'\\xff\\xd9'
+
+class SimulatedCamera:
+    name = 'v4l2'
+    device = '/dev/video-simulated'
+    def grab(self):
+        return JPEG
+    def close(self):
+        pass
+
+timelapse.detect_camera = lambda: 'usb'
+timelapse.open_capture_backend = lambda *args, **kwargs: SimulatedCamera()
+capture_daemon.main()
+'''
+
+# The web server when gunicorn isn't installed
+WEB_BOOTSTRAP = '''
+import sys
+sys.path.insert(0, {root!r})
+import app as timelapse
+timelapse.start_background_services()
+timelapse.app.run(host='127.0.0.1', port=int(sys.argv[1]), debug=False, threaded=True)
+'''
+
+
+def api(url, path, method='GET', body=None, timeout=15):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url + path, data=data, method=method,
+                                 headers={'Content-Type': 'application/json'} if data else {})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, json.loads(response.read() or b'{}')
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            status, body = api(url, '/api/status', timeout=2)
+            if status == 200 and body.get('capture_daemon'):
+                return body
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"web server at {url} did not come up connected to the capture daemon")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LocalSetup:
+    """Capture daemon and web server started from this checkout"""
+
+    def __init__(self, tmp):
+        self.tmp = tmp
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.daemon = None
+        self.web = None
+        with open(os.path.join(tmp, 'daemon_sim.py'), 'w') as f:
+            f.write(DAEMON_BOOTSTRAP.format(root=ROOT))
+        with open(os.path.join(tmp, 'web_dev.py'), 'w') as f:
+            f.write(WEB_BOOTSTRAP.format(root=ROOT))
+        self.log = open(os.path.join(tmp, 'servers.log'), 'w')
+
+    def start_daemon(self):
+        self.daemon = subprocess.Popen([sys.executable, os.path.join(self.tmp, 'daemon_sim.py')],
+                                       cwd=ROOT, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def start_web(self):
+        env = dict(os.environ, TIMELAPSEPI_CAPTURE='daemon')
+        if subprocess.run(['which', 'gunicorn'], capture_output=True).returncode == 0:
+            cmd = ['gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), '-b', f'127.0.0.1:{self.port}',
+                   'wsgi:application']
+        else:
+            cmd = [sys.executable, os.path.join(self.tmp, 'web_dev.py'), str(self.port)]
+        # Own process group, so a crash takes gunicorn's workers down with the arbiter
+        self.web = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        return wait_for(self.url)
+
+    def stop_web(self, sig):
+        os.killpg(self.web.pid, sig)
+        self.web.wait(15)
+        if sig == signal.SIGKILL:
+            return
+        # Let gunicorn's workers finish exiting before the port is reused
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            try:
+                os.killpg(self.web.pid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(0.1)
+
+    def restart_web(self, crash):
+        self.stop_web(signal.SIGKILL if crash else signal.SIGTERM)
+        return self.start_web()
+
+    def close(self):
+        for process in (self.web, self.daemon):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(20)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        self.log.close()
+
+
+class SystemdSetup:
+    """The installed services"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def restart_web(self, crash):
+        action = ['sudo', 'systemctl', 'kill', '-s', 'KILL', 'timelapsepi'] if crash else \
+                 ['sudo', 'systemctl', 'restart', 'timelapsepi']
+        subprocess.run(action, check=True)
+        if crash:
+            time.sleep(1)
+            subprocess.run(['sudo', 'systemctl', 'restart', 'timelapsepi'], check=True)
+        return wait_for(self.url, timeout=60)
+
+    def close(self):
+        pass
+
+
+def frame_times(session_id):
+    from frame_store import FrameStore
+    return [captured_at for _, _, captured_at in FrameStore(IMAGES_DIR).frames(session_id)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--interval', type=float, default=1.0, help='capture interval in seconds')
+    parser.add_argument('--systemd', action='store_true', help='test the installed services')
+    parser.add_argument('--url', default='http://localhost:5000', help='web server URL with --systemd')
+    args = parser.parse_args()
+    phase = max(3.0, args.interval * 4)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.systemd:
+            setup = SystemdSetup(args.url)
+            wait_for(setup.url)
+        else:
+            setup = LocalSetup(tmp)
+            setup.start_daemon()
+            setup.start_web()
+        session_id = None
+        try:
+            status, body = api(setup.url, '/api/start', 'POST',
+                               {'interval': args.interval, 'resolution': [640, 480], 'ir_mode': 'off'})
+            if status != 200:
+                print(f"FAIL: could not start a session: {status} {body}")
+                return 1
+            session_id = body['session_id']
+            print(f"Session {session_id} started, {args.interval:g} s interval")
+            time.sleep(phase)
+
+            for crash in (True, False):
+                before = api(setup.url, '/api/status')[1]['total_frames']
+                started = time.monotonic()
+                status = setup.restart_web(crash)
+                print(f"Web server {'killed' if crash else 'restarted'} and back after "
+                      f"{time.monotonic() - started:.1f} s; frames {before} -> {status['total_frames']}")
+                if not status['active'] or status['session_id'] != session_id:
+                    print(f"FAIL: session lost across the web restart: {status}")
+                    return 1
+                time.sleep(phase)
+
+            status, body = api(setup.url, '/api/stop', 'POST', {})
+            if status != 200:
+                print(f"FAIL: could not stop the session: {status} {body}")
+                return 1
+
+            times = frame_times(session_id)
+            gaps = [b - a for a, b in zip(times, times[1:])]
+            longest = max(gaps) if gaps else 0
+            print(f"{len(times)} frames, longest gap {longest:.2f} s")
+            if len(times) < 3:
+                print("FAIL: too few frames captured")
+                return 1
+            if longest > args.interval * 1.5:
+                print(f"FAIL: gap of {longest:.2f} s between frames (interval {args.interval:g} s)")
+                return 1
+            print("PASS: no frames lost across web server restarts")
+            return 0
+        finally:
+            if session_id:
+                api(setup.url, f'/api/sessions/{session_id}', 'DELETE')
+            setup.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Thumbnail cache
+
+Small proxies (320 px wide by default) of every frame, so the UI can show
+and scrub through a session without downloading the multi-megabyte
+originals. A session's thumbnails live in two files:
+
+    <session>.pack  the thumbnail JPEGs, appended one after another
+    <session>.idx   one fixed-size record per frame number: (offset, length)
+                    into the pack; an all-zero record means "not generated"
+
+so looking up frame N is one read at N * RECORD_SIZE and one pread of the
+pack, and consecutive frames captured in order sit next to each other.
+
+Thumbnails are made as frames are captured (from the JPEG still in
+memory), on demand for frames that have none, or by a backfill job for
+older sessions. The cache has a size cap: when it is exceeded, whole
+sessions are dropped, least recently viewed first; they are rebuilt on
+demand.
+"""
+
+import io
+import os
+import time
+import struct
+import threading
+import subprocess
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_QUALITY = 70
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+# Check the cache size after this many new thumbnails
+LIMIT_CHECK_EVERY = 200
+# Don't update a session's "last viewed" time more often than this
+TOUCH_INTERVAL = 60
+
+_RECORD = struct.Struct('<QI')
+RECORD_SIZE = _RECORD.size
+
+
+def make_thumbnail(path=None, data=None, width=THUMBNAIL_WIDTH, quality=THUMBNAIL_QUALITY):
+    """Scale a JPEG frame down to `width` pixels wide
+
+    Args:
+        path: JPEG file
+        data: JPEG bytes already in memory (skips reading the file)
+
+    Returns:
+        bytes: the thumbnail JPEG
+    """
+    if Image is not None:
+        with Image.open(io.BytesIO(data) if data is not None else path) as im:
+            height = max(1, round(im.height * width / im.width))
+            # Reduced-size decode: the JPEG decoder skips most of the work
+            im.draft('RGB', (width, height))
+            im = im.convert('RGB')
+            if im.width > width:
+                im = im.resize((width, height), Image.BILINEAR)
+            out = io.BytesIO()
+            im.save(out, 'JPEG', quality=quality)
+            return out.getvalue()
+
+    result = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', 'pipe:0' if data is not None else str(path),
+         '-vf', f'scale={width}:-2', '-frames:v', '1', '-q:v', '5', '-f', 'mjpeg', '-'],
+        input=data, capture_output=True, timeout=10
+    )
+    if result.returncode != 0 or not result.stdout:
+        raise ValueError(f"ffmpeg could not scale frame: {result.stderr[-200:]!r}")
+    return result.stdout
+
+
+class ThumbnailStore:
+    """Per-session thumbnail packs with an LRU size cap"""
+
+    def __init__(self, root, frame_path, width=THUMBNAIL_WIDTH, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            root: Directory of the packs and indexes
+            frame_path: Callable(session_id, frame_number) giving a frame's
+                        file (see frame_store)
+        """
+        self.root = Path(root)
+        self.frame_path = frame_path
+        self.width = width
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._touched = {}
+        self._added = 0
+
+    def _lock(self, session_id):
+        with self._locks_lock:
+            return self._locks.setdefault(session_id, threading.Lock())
+
+    def _paths(self, session_id):
+        return self.root / f"{session_id}.pack", self.root / f"{session_id}.idx"
+
+    # -- reading --
+
+    def _records(self, session_id, start, count, step=1):
+        """Index records for frames start, start+step, ... (count of them; missing ones are (0, 0))
+
+        With a step only the wanted records are read, never the span between them.
+        """
+        _, idx_path = self._paths(session_id)
+        try:
+            fd = os.open(idx_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return [(0, 0)] * count
+        try:
+            if step == 1:
+                raw = os.pread(fd, count * RECORD_SIZE, start * RECORD_SIZE)
+                records = [_RECORD.unpack_from(raw, i * RECORD_SIZE) for i in range(len(raw) // RECORD_SIZE)]
+            else:
+                records = []
+                for i in range(count):
+                    raw = os.pread(fd, RECORD_SIZE, (start + i * step) * RECORD_SIZE)
+                    if len(raw) < RECORD_SIZE:
+                        break  # past the end of the index
+                    records.append(_RECORD.unpack(raw))
+        finally:
+            os.close(fd)
+        return records + [(0, 0)] * (count - len(records))
+
+    def _read(self, session_id, records):
+        pack_path, _ = self._paths(session_id)
+        fd = os.open(pack_path, os.O_RDONLY)
+        try:
+            return [os.pread(fd, length, offset) if length else None for offset, length in records]
+        finally:
+            os.close(fd)
+
+    def get(self, session_id, frame_number, generate=True):
+        """One frame's thumbnail
+
+        Args:
+            generate: Make the thumbnail now if the frame has none yet
+
+        Returns:
+            tuple: (JPEG bytes, etag), or None if there is no such frame
+        """
+        result = self.get_range(session_id, frame_number, 1, 1, generate)
+        return result[0][1:] if result else None
+
+    def get_range(self, session_id, start, count, step=1, generate=True):
+        """Thumbnails of frames start, start+step, ... (count of them)
+
+        Returns:
+            list of (frame number, JPEG bytes, etag) for the frames that exist
+        """
+        if start < 0 or count < 1 or step < 1:
+            return []
+        last = start + (count - 1) * step
+        records = self._records(session_id, start, count, step)
+        frames = range(start, last + 1, step)
+
+        if generate:
+            for i, frame_number in enumerate(frames):
+                if records[i][1] == 0:
+                    records[i] = self.add(session_id, frame_number) or (0, 0)
+
+        wanted = [(frame_number, record) for frame_number, record in zip(frames, records) if record[1]]
+        if not wanted:
+            return []
+        try:
+            data = self._read(session_id, [record for _, record in wanted])
+        except FileNotFoundError:
+            return []  # evicted meanwhile
+        self._touch(session_id)
+        return [(frame_number, jpeg, f'{frame_number}-{offset}-{length}')
+                for (frame_number, (offset, length)), jpeg in zip(wanted, data)]
+
+    def count(self, session_id):
+        """Frames that have a thumbnail"""
+        _, idx_path = self._paths(session_id)
+        try:
+            size = idx_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+        records = self._records(session_id, 0, size // RECORD_SIZE)
+        return sum(1 for _, length in records if length)
+
+    def usage(self):
+        """Total bytes on disk and number of sessions cached"""
+        total = 0
+        sessions = set()
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.name.endswith(('.pack', '.idx')):
+                    total += entry.stat().st_size
+                    sessions.add(entry.name.rsplit('.', 1)[0])
+        return {"bytes": total, "sessions": len(sessions), "max_bytes": self.max_bytes}
+
+    # -- writing --
+
+    def add(self, session_id, frame_number, data=None):
+        """Make and store one frame's thumbnail
+
+        Args:
+            data: The frame's JPEG bytes if the caller still has them
+
+        Returns:
+            The (offset, length) record, or None if the frame can't be read
+        """
+        frame_file = self.frame_path(session_id, frame_number)
+        if data is None and not frame_file.exists():
+            return None
+        try:
+            thumbnail = make_thumbnail(frame_file if data is None else None, data, self.width)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"[Thumbnails] Could not make thumbnail of {session_id} frame {frame_number}: {e}")
+            return None
+
+        pack_path, idx_path = self._paths(session_id)
+        with self._lock(session_id):
+            with open(pack_path, 'ab') as pack:
+                offset = pack.tell()
+                pack.write(thumbnail)
+            # The index is written after the data, so a record never points
+            # at bytes that aren't there
+            fd = os.open(idx_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, _RECORD.pack(offset, len(thumbnail)), frame_number * RECORD_SIZE)
+            finally:
+                os.close(fd)
+
+        self._added += 1
+        if self._added % LIMIT_CHECK_EVERY == 0:
+            self.enforce_limit(protect=(session_id,))
+        return offset, len(thumbnail)
+
+    def backfill(self, session_id, frame_count, on_progress=None, cancel_event=None):
+        """Make the thumbnails a session is missing
+
+        Args:
+            frame_count: Frames in the session
+            on_progress: Optional callable(percent)
+            cancel_event: threading.Event that stops the backfill when set
+
+        Returns:
+            int: Thumbnails made
+        """
+        made = 0
+        records = self._records(session_id, 0, frame_count)
+        for frame_number, (_, length) in enumerate(records):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            if not length and self.add(session_id, frame_number):
+                made += 1
+            if on_progress and frame_number % 20 == 0:
+                on_progress(frame_number * 100.0 / max(frame_count, 1))
+        print(f"[Thumbnails] Backfilled {made} thumbnail(s) for {session_id}")
+        self.enforce_limit(protect=(session_id,))
+        return made
+
+    def remove(self, session_id):
+        with self._lock(session_id):
+            for path in self._paths(session_id):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        self._touched.pop(session_id, None)
+
+    # -- size cap --
+
+    def _touch(self, session_id):
+        """Record that a session was viewed (its index mtime is the LRU clock)"""
+        now = time.time()
+        if now - self._touched.get(session_id, 0) < TOUCH_INTERVAL:
+            return
+        self._touched[session_id] = now
+        try:
+            os.utime(self._paths(session_id)[1])
+        except FileNotFoundError:
+            pass
+
+    def enforce_limit(self, protect=()):
+        """Drop least recently viewed sessions until the cache fits max_bytes
+
+        Args:
+            protect: Sessions that must be kept (e.g. the one being captured)
+
+        Returns:
+            list of session IDs dropped
+        """
+        sessions = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                session_id, _, ext = entry.name.rpartition('.')
+                if ext not in ('pack', 'idx'):
+                    continue
+                st = entry.stat()
+                info = sessions.setdefault(session_id, {"bytes": 0, "used": 0})
+                info["bytes"] += st.st_size
+                if ext == 'idx':
+                    info["used"] = st.st_mtime
+
+        total = sum(info["bytes"] for info in sessions.values())
+        dropped = []
+        for session_id, info in sorted(sessions.items(), key=lambda item: item[1]["used"]):
+            if total <= self.max_bytes:
+                break
+            if session_id in protect:
+                continue
+            self.remove(session_id)
+            total -= info["bytes"]
+            dropped.append(session_id)
+        if dropped:
+            print(f"[Thumbnails] Cache over {self.max_bytes // (1024 * 1024)} MB, dropped {', '.join(dropped)}")
+        return dropped
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - V4L2 control registry
+
+Each camera's controls (name, id, type, range, default and current value)
+are enumerated once, when the camera state service finds the device, and
+kept in memory. Reads are served from that map and writes update it, so
+the camera settings API and IR switching no longer list and re-parse the
+controls on every call.
+
+Controls are read and written in batches: one VIDIOC_G_EXT_CTRLS /
+VIDIOC_S_EXT_CTRLS ioctl for any number of controls. Where the ioctls
+can't be used the same happens through a single v4l2-ctl call
+(--get-ctrl=a,b / --set-ctrl=a=1,b=2).
+"""
+
+import os
+import re
+import fcntl
+import ctypes
+import threading
+import subprocess
+
+from capture_backends import _ioc, _IOC_READ, _IOC_WRITE
+
+# ---------------------------------------------------------------------------
+# V4L2 control ABI (linux/videodev2.h)
+# ---------------------------------------------------------------------------
+
+V4L2_CTRL_FLAG_DISABLED = 0x0001
+V4L2_CTRL_FLAG_READ_ONLY = 0x0004
+V4L2_CTRL_FLAG_INACTIVE = 0x0010
+V4L2_CTRL_FLAG_WRITE_ONLY = 0x0040
+V4L2_CTRL_FLAG_NEXT_CTRL = 0x80000000
+V4L2_CTRL_WHICH_CUR_VAL = 0
+
+# Control types, named the way v4l2-ctl prints them
+CONTROL_TYPES = {
+    1: 'int',
+    2: 'bool',
+    3: 'menu',
+    4: 'button',
+    5: 'int64',
+    6: 'ctrl_class',
+    7: 'str',
+    8: 'bitmask',
+    9: 'intmenu',
+}
+# Types that carry no readable value of their own
+_VALUELESS_TYPES = ('button', 'ctrl_class')
+_FLAG_NAMES = {
+    V4L2_CTRL_FLAG_DISABLED: 'disabled',
+    V4L2_CTRL_FLAG_READ_ONLY: 'read-only',
+    V4L2_CTRL_FLAG_INACTIVE: 'inactive',
+    V4L2_CTRL_FLAG_WRITE_ONLY: 'write-only',
+}
+
+
+class v4l2_queryctrl(ctypes.Structure):
+    _fields_ = [
+        ('id', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('name', ctypes.c_char * 32),
+        ('minimum', ctypes.c_int32),
+        ('maximum', ctypes.c_int32),
+        ('step', ctypes.c_int32),
+        ('default_value', ctypes.c_int32),
+        ('flags', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 2),
+    ]
+
+
+class _v4l2_ext_control_value(ctypes.Union):
+    _pack_ = 1
+    _fields_ = [
+        ('value', ctypes.c_int32),
+        ('value64', ctypes.c_int64),
+        ('ptr', ctypes.c_void_p),
+    ]
+
+
+class v4l2_ext_control(ctypes.Structure):
+    # __attribute__((packed)) in the kernel header
+    _pack_ = 1
+    _fields_ = [
+        ('id', ctypes.c_uint32),
+        ('size', ctypes.c_uint32),
+        ('reserved2', ctypes.c_uint32),
+        ('u', _v4l2_ext_control_value),
+    ]
+
+
+class v4l2_ext_controls(ctypes.Structure):
+    _fields_ = [
+        ('which', ctypes.c_uint32),
+        ('count', ctypes.c_uint32),
+        ('error_idx', ctypes.c_uint32),
+        ('request_fd', ctypes.c_int32),
+        ('reserved', ctypes.c_uint32),
+        ('controls', ctypes.POINTER(v4l2_ext_control)),
+    ]
+
+
+VIDIOC_QUERYCTRL = _ioc(_IOC_READ | _IOC_WRITE, 36, v4l2_queryctrl)
+VIDIOC_G_EXT_CTRLS = _ioc(_IOC_READ | _IOC_WRITE, 71, v4l2_ext_controls)
+VIDIOC_S_EXT_CTRLS = _ioc(_IOC_READ | _IOC_WRITE, 72, v4l2_ext_controls)
+
+
+class ControlError(Exception):
+    """Raised when controls can't be listed, read or written"""
+
+
+def control_name(label):
+    """v4l2-ctl style name of a control ('Exposure Time, Absolute' -> 'exposure_time_absolute')"""
+    name = re.sub(r'[^0-9a-z]+', '_', label.lower())
+    return name.strip('_')
+
+
+def _flag_names(flags):
+    return [name for bit, name in _FLAG_NAMES.items() if flags & bit]
+
+
+# ---------------------------------------------------------------------------
+# ioctl access
+# ---------------------------------------------------------------------------
+
+def _ioctl(fd, request, arg):
+    while True:
+        try:
+            return fcntl.ioctl(fd, request, arg)
+        except InterruptedError:
+            continue
+
+
+def _open(device):
+    # Controls can be used while another file handle is streaming
+    return os.open(device, os.O_RDWR | os.O_NONBLOCK)
+
+
+def _query_controls_ioctl(device):
+    """Enumerate a device's controls with VIDIOC_QUERYCTRL
+
+    Returns:
+        list of control dicts (without values)
+    """
+    fd = _open(device)
+    try:
+        controls = []
+        query = v4l2_queryctrl()
+        query.id = V4L2_CTRL_FLAG_NEXT_CTRL
+        while True:
+            try:
+                _ioctl(fd, VIDIOC_QUERYCTRL, query)
+            except OSError:
+                break  # EINVAL: no more controls
+            type_name = CONTROL_TYPES.get(query.type, str(query.type))
+            if type_name != 'ctrl_class' and not query.flags & V4L2_CTRL_FLAG_DISABLED:
+                controls.append({
+                    'name': control_name(query.name.decode('utf-8', 'replace')),
+                    'id': query.id,
+                    'type': type_name,
+                    'min': query.minimum,
+                    'max': query.maximum,
+                    'step': query.step,
+                    'default': query.default_value,
+                    'flags': _flag_names(query.flags),
+                    'value': None,
+                })
+            query.id |= V4L2_CTRL_FLAG_NEXT_CTRL
+        return controls
+    finally:
+        os.close(fd)
+
+
+def _ext_controls(controls, values=None):
+    array = (v4l2_ext_control * len(controls))()
+    for i, control in enumerate(controls):
+        array[i].id = control['id']
+        if values is not None:
+            if control['type'] == 'int64':
+                array[i].u.value64 = values[i]
+            else:
+                array[i].u.value = values[i]
+    ext = v4l2_ext_controls()
+    ext.which = V4L2_CTRL_WHICH_CUR_VAL
+    ext.count = len(controls)
+    ext.controls = array
+    return ext, array
+
+
+def _get_ioctl(device, controls):
+    """Read many controls with one VIDIOC_G_EXT_CTRLS"""
+    ext, array = _ext_controls(controls)
+    fd = _open(device)
+    try:
+        _ioctl(fd, VIDIOC_G_EXT_CTRLS, ext)
+    finally:
+        os.close(fd)
+    return {control['name']: (array[i].u.value64 if control['type'] == 'int64' else array[i].u.value)
+            for i, control in enumerate(controls)}
+
+
+def _set_ioctl(device, controls, values):
+    """Write many controls with one VIDIOC_S_EXT_CTRLS"""
+    ext, _ = _ext_controls(controls, values)
+    fd = _open(device)
+    try:
+        _ioctl(fd, VIDIOC_S_EXT_CTRLS, ext)
+    except OSError as e:
+        failed = controls[ext.error_idx]['name'] if ext.error_idx < len(controls) else None
+        raise ControlError(f"{e.strerror}" + (f" (at {failed})" if failed else ""))
+    finally:
+        os.close(fd)
+
+
+# ---------------------------------------------------------------------------
+# v4l2-ctl access
+# ---------------------------------------------------------------------------
+
+# "  brightness 0x00980900 (int)    : min=-64 max=64 step=1 default=0 value=0 flags=inactive"
+_LIST_LINE = re.compile(r'^\s*(\w+)\s+0x([0-9a-f]+)\s+\((\w+)\)\s*:\s*(.*)$')
+
+
+def parse_list_ctrls(text):
+    """Parse `v4l2-ctl --list-ctrls` output into control dicts"""
+    controls = []
+    for line in text.splitlines():
+        match = _LIST_LINE.match(line)
+        if not match:
+            continue  # class headings and menu entries
+        name, control_id, type_name, rest = match.groups()
+        fields = dict(re.findall(r'(\w+)=(\S+)', rest))
+
+        def number(key):
+            try:
+                return int(fields[key])
+            except (KeyError, ValueError):
+                return None
+
+        flags = fields.get('flags', '')
+        controls.append({
+            'name': name,
+            'id': int(control_id, 16),
+            'type': type_name,
+            'min': number('min'),
+            'max': number('max'),
+            'step': number('step'),
+            'default': number('default'),
+            'flags': flags.split(',') if flags else [],
+            'value': number('value'),
+        })
+    return controls
+
+
+def _v4l2_ctl(device, *args):
+    try:
+        result = subprocess.run(['v4l2-ctl', '--device', device] + list(args),
+                                capture_output=True, text=True, timeout=3)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise ControlError(f"v4l2-ctl failed: {e}")
+    if result.returncode != 0:
+        raise ControlError(result.stderr.strip() or f"v4l2-ctl exited with {result.returncode}")
+    return result.stdout
+
+
+def _query_controls_v4l2_ctl(device):
+    return parse_list_ctrls(_v4l2_ctl(device, '--list-ctrls'))
+
+
+def _get_v4l2_ctl(device, controls):
+    output = _v4l2_ctl(device, '--get-ctrl=' + ','.join(c['name'] for c in controls))
+    values = {}
+    for line in output.splitlines():
+        name, _, value = line.partition(':')
+        try:
+            values[name.strip()] = int(value.strip())
+        except ValueError:
+            pass
+    return values
+
+
+def _set_v4l2_ctl(device, controls, values):
+    _v4l2_ctl(device, '--set-ctrl=' + ','.join(f"{c['name']}={v}" for c, v in zip(controls, values)))
+
+
+# ---------------------------------------------------------------------------
+# Registry
+# ---------------------------------------------------------------------------
+
+class DeviceControls:
+    """The control map of one device"""
+
+    def __init__(self, device, name=None):
+        self.device = device
+        self.name = name
+        self.method = None
+        self.controls = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Enumerate the controls and read their current values
+
+        Raises:
+            ControlError: Neither the ioctls nor v4l2-ctl could list the controls
+        """
+        try:
+            controls = _query_controls_ioctl(self.device)
+            method = 'ioctl'
+        except FileNotFoundError:
+            raise ControlError(f"{self.device} does not exist")
+        except OSError as e:
+            print(f"[Controls] ioctl enumeration failed on {self.device} ({e}), using v4l2-ctl")
+            controls = _query_controls_v4l2_ctl(self.device)
+            method = 'v4l2-ctl'
+
+        with self._lock:
+            self.method = method
+            self.controls = {c['name']: c for c in controls}
+        if method == 'ioctl':
+            self.refresh()
+        print(f"[Controls] {self.device}: {len(self.controls)} control(s) via {method}")
+        return self
+
+    def has(self, name):
+        return name in self.controls
+
+    def describe(self):
+        """All controls with their ranges and cached values"""
+        with self._lock:
+            return {name: dict(control) for name, control in self.controls.items()}
+
+    def values(self, names=None):
+        """Cached values (no device access)
+
+        Args:
+            names: Controls to return; None for all
+
+        Returns:
+            dict: name -> value, for the names this device has
+        """
+        with self._lock:
+            names = self.controls if names is None else names
+            return {name: self.controls[name]['value'] for name in names if name in self.controls}
+
+    def refresh(self, names=None):
+        """Re-read values from the device in one round-trip
+
+        Returns:
+            dict: name -> value
+        """
+        with self._lock:
+            wanted = [self.controls[n] for n in (self.controls if names is None else names)
+                      if n in self.controls]
+            readable = [c for c in wanted if c['type'] not in _VALUELESS_TYPES
+                        and 'write-only' not in c['flags']]
+            if not readable:
+                return {}
+            try:
+                read = _get_ioctl if self.method == 'ioctl' else _get_v4l2_ctl
+                values = read(self.device, readable)
+            except (OSError, ControlError):
+                if self.method != 'ioctl':
+                    raise
+                # Some drivers reject a batch with one unreadable control;
+                # fall back to reading them one at a time
+                values = {}
+                for control in readable:
+                    try:
+                        values.update(_get_ioctl(self.device, [control]))
+                    except OSError:
+                        pass
+            for name, value in values.items():
+                if name in self.controls:
+                    self.controls[name]['value'] = value
+            return values
+
+    def set(self, values):
+        """Write many controls in one round-trip
+
+        If the driver rejects the batch, the controls are retried one at a
+        time so the result says exactly which ones failed.
+
+        Args:
+            values: dict of control name -> value
+
+        Returns:
+            tuple: (applied {name: value}, errors {name: message}, skipped [names not on this device])
+        """
+        values = dict(values)
+        skipped = [name for name in values if name not in self.controls]
+        for name in skipped:
+            del values[name]
+        if not values:
+            return {}, {}, skipped
+
+        write = _set_ioctl if self.method == 'ioctl' else _set_v4l2_ctl
+        applied, errors = {}, {}
+        with self._lock:
+            controls = [self.controls[name] for name in values]
+            try:
+                write(self.device, controls, [int(v) for v in values.values()])
+                applied = values
+            except (ValueError, TypeError) as e:
+                errors = {name: f"invalid value: {e}" for name in values}
+            except (OSError, ControlError):
+                for control in controls:
+                    try:
+                        write(self.device, [control], [int(values[control['name']])])
+                        applied[control['name']] = values[control['name']]
+                    except (ValueError, TypeError, OSError, ControlError) as e:
+                        errors[control['name']] = str(e)
+            for name, value in applied.items():
+                self.controls[name]['value'] = int(value)
+        return applied, errors, skipped
+
+
+class ControlRegistry:
+    """Control maps of all known cameras, keyed by device path"""
+
+    def __init__(self):
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def get(self, device):
+        """Control map of a device, loading it if it hasn't been seen yet
+
+        Returns:
+            DeviceControls, or None if its controls can't be listed
+        """
+        with self._lock:
+            controls = self._devices.get(device)
+        if controls is not None:
+            return controls
+        return self._load(device)
+
+    def devices(self):
+        with self._lock:
+            return dict(self._devices)
+
+    def sync(self, devices, reload=False):
+        """Match the registry to a camera scan (called by the camera state service)
+
+        Args:
+            devices: Detected devices, [{'device': ..., 'name': ...}]
+            reload: Re-enumerate devices that are already known
+        """
+        current = {d['device']: d.get('name') for d in devices}
+        with self._lock:
+            for device in list(self._devices):
+                known = self._devices[device]
+                if device not in current or known.name != current[device] or reload:
+                    del self._devices[device]
+            missing = [device for device in current if device not in self._devices]
+        for device in missing:
+            self._load(device, current[device])
+
+    def _load(self, device, name=None):
+        try:
+            controls = DeviceControls(device, name).load()
+        except (OSError, ControlError) as e:
+            print(f"[Controls] Could not list controls of {device}: {e}")
+            return None
+        with self._lock:
+            return self._devices.setdefault(device, controls)
+
+
+registry = ControlRegistry()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - Incremental video building
+
+Frames are encoded into segments that are kept between compiles: every
+build only encodes the frames captured since the previous build (as one or
+more new segments of at most `segment_frames` frames), then stream-copies
+all segments into the output MP4. Previewing a running session therefore
+costs roughly the frames added since the last preview, not the whole
+session. ffmpeg is given each segment's frames as a concat demuxer list
+taken from the session's frame manifest (see frame_store), so the frames
+may sit in any directories.
+
+Segments live in VIDEOS_DIR/.segments/<session_id>/ next to a manifest
+recording which frames each one covers and the encode settings used;
+changing the settings (fps, filters, encoder) starts a fresh set of segments.
+
+Rotation is normally not encoded at all: the output MP4 is tagged with a
+display matrix while it is stream-copied, which takes seconds whatever
+the length and leaves the cached segments reusable for any rotation.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+DEFAULT_SEGMENT_FRAMES = 500
+# Frequent previews leave a run of small tail segments; once there are this
+# many they are stream-copied together into one (no re-encode)
+COMPACT_TAIL_SEGMENTS = 4
+LOW_PRIORITY_NICENESS = 10
+# Used when the caller doesn't pass a profile from encoders.py
+ENCODER_ARGS = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '23']
+
+_display_rotation_supported = None
+
+_session_locks = {}
+_session_locks_guard = threading.Lock()
+
+
+def _session_lock(key):
+    with _session_locks_guard:
+        return _session_locks.setdefault(key, threading.Lock())
+
+
+def low_priority_prefix(niceness=LOW_PRIORITY_NICENESS):
+    """Command prefix running a process below capture priority (CPU and disk)"""
+    prefix = ['nice', '-n', str(niceness)] if shutil.which('nice') else []
+    if shutil.which('ionice'):
+        # Best-effort class, lowest level: still progresses on a busy SD card
+        prefix += ['ionice', '-c', '2', '-n', '7']
+    return prefix
+
+
+def run_ffmpeg(cmd, on_progress=None, progress_interval=1.0, cancel_event=None, low_priority=False):
+    """Run an ffmpeg command, reporting encoded frame counts as it goes
+
+    Args:
+        cmd: ffmpeg command line (starting with 'ffmpeg')
+        on_progress: Optional callback taking the number of frames encoded so far
+        progress_interval: Minimum seconds between callbacks
+        cancel_event: Optional threading.Event; ffmpeg is terminated once it is set
+        low_priority: Run ffmpeg niced/ioniced below the capture thread
+
+    Returns:
+        tuple: (returncode, stderr text)
+    """
+    cmd = [cmd[0], '-progress', 'pipe:1', '-nostats'] + cmd[1:]
+    if low_priority:
+        cmd = low_priority_prefix() + cmd
+    last_report = 0
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, text=True)
+        # -progress writes a block twice a second, so cancellation is prompt
+        for line in process.stdout:
+            if cancel_event is not None and cancel_event.is_set():
+                process.terminate()
+                break
+            key, _, value = line.strip().partition('=')
+            if key == 'frame' and on_progress and time.monotonic() - last_report >= progress_interval:
+                last_report = time.monotonic()
+                try:
+                    on_progress(int(value))
+                except ValueError:
+                    pass
+        returncode = process.wait()
+        stderr.seek(0)
+        error_msg = stderr.read().decode('utf-8', 'replace')
+    return returncode, error_msg
+
+
+def rotation_args(rotation):
+    """ffmpeg args that tag a stream-copied video with a display rotation
+
+    Args:
+        rotation: Degrees clockwise (0, 90, 180 or 270); 0 clears any rotation
+
+    Returns:
+        tuple: (args to put before -i, args to put before the output file)
+    """
+    global _display_rotation_supported
+    if _display_rotation_supported is None:
+        # -display_rotation (ffmpeg 6.1+) replaces the old 'rotate' tag
+        try:
+            result = subprocess.run(['ffmpeg', '-hide_banner', '-h', 'full'],
+                                    capture_output=True, text=True, timeout=10)
+            _display_rotation_supported = '-display_rotation' in result.stdout
+        except (OSError, subprocess.TimeoutExpired):
+            _display_rotation_supported = False
+
+    if _display_rotation_supported:
+        # The display matrix angle is counter-clockwise
+        return ['-display_rotation', str(-rotation % 360)], []
+    return [], ['-metadata:s:v:0', f'rotate={rotation % 360}']
+
+
+def set_display_rotation(video_file, rotation, cancel_event=None, low_priority=False):
+    """Re-tag an existing MP4's display rotation in place (stream copy, no re-encode)
+
+    Returns:
+        tuple: (returncode, stderr text)
+    """
+    input_args, output_args = rotation_args(rotation)
+    tmp_output = video_file.with_name(f".{video_file.name}.rotate.mp4")
+    returncode, error_msg = run_ffmpeg(
+        ['ffmpeg', '-y'] + input_args + ['-i', str(video_file), '-map', '0', '-c', 'copy']
+        + output_args + ['-movflags', '+faststart', str(tmp_output)],
+        cancel_event=cancel_event, low_priority=low_priority)
+    if returncode != 0:
+        tmp_output.unlink(missing_ok=True)
+        return returncode, error_msg
+    os.replace(tmp_output, video_file)
+    return 0, ''
+
+
+def segments_dir(videos_dir, session_id):
+    return videos_dir / '.segments' / session_id
+
+
+def remove_segments(videos_dir, session_id):
+    """Delete a session's cached segments"""
+    shutil.rmtree(segments_dir(videos_dir, session_id), ignore_errors=True)
+
+
+def _load_manifest(path, settings):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('settings') == settings:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'settings': settings, 'segments': []}
+
+
+def _save_manifest(path, manifest):
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _concat(seg_dir, files, output, cancel_event=None, low_priority=False, rotation=0):
+    """Stream-copy segment files (relative to seg_dir) into output"""
+    list_file = seg_dir / 'concat.txt'
+    with open(list_file, 'w') as f:
+        for name in files:
+            f.write(f"file '{name}'\n")
+    input_args, output_args = rotation_args(rotation) if rotation else ([], [])
+    return run_ffmpeg(
+        ['ffmpeg', '-y'] + input_args
+        + ['-f', 'concat', '-safe', '0', '-i', str(list_file), '-c', 'copy'] + output_args
+        + ['-movflags', '+faststart', str(output)],
+        cancel_event=cancel_event, low_priority=low_priority)
+
+
+def _compact_tail(seg_dir, manifest, segment_frames, low_priority=False):
+    """Merge a run of small trailing segments into one"""
+    tail = []
+    for segment in reversed(manifest['segments']):
+        if segment['count'] >= segment_frames:
+            break
+        tail.insert(0, segment)
+    if len(tail) < COMPACT_TAIL_SEGMENTS:
+        return
+
+    start = tail[0]['start']
+    count = sum(s['count'] for s in tail)
+    merged = f"seg_{start:09d}_{count:06d}.mp4"
+    returncode, error_msg = _concat(seg_dir, [s['file'] for s in tail], seg_dir / f".{merged}",
+                                    low_priority=low_priority)
+    if returncode != 0:
+        print(f"[Video] Could not compact segments: {error_msg[-200:]}")
+        (seg_dir / f".{merged}").unlink(missing_ok=True)
+        return
+    os.replace(seg_dir / f".{merged}", seg_dir / merged)
+
+    manifest['segments'] = manifest['segments'][:-len(tail)] + [{'start': start, 'count': count, 'file': merged}]
+    _save_manifest(seg_dir / 'segments.json', manifest)
+    for segment in tail:
+        if segment['file'] != merged:
+            (seg_dir / segment['file']).unlink(missing_ok=True)
+
+
+def _frame_list(path, frame_files):
+    """Write a concat demuxer list of frame files"""
+    with open(path, 'w') as f:
+        for frame_file in frame_files:
+            escaped = str(frame_file).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+
+def build_video(session_id, frame_files, videos_dir, output_file, fps=30, video_filter=None,
+                segment_frames=DEFAULT_SEGMENT_FRAMES, on_progress=None, cancel_event=None,
+                low_priority=False, encoder_args=None, rotation=0, selection=None, changed_from=None):
+    """Build output_file from a session's frames, reusing encoded segments
+
+    Args:
+        session_id: Session identifier (names the segment cache)
+        frame_files: The frames to include, in order (see FrameStore.frame_files);
+                     segments cover positions in this list
+        videos_dir: VIDEOS_DIR (segments are cached below it)
+        output_file: MP4 to write
+        fps: Output frame rate
+        video_filter: Optional ffmpeg -vf filter applied while encoding
+        segment_frames: Maximum frames per segment
+        on_progress: Optional callback taking the frames of the video done so far,
+                     those in reused segments included
+        cancel_event: Optional threading.Event that aborts the build when set;
+                      segments finished so far are kept for the next build
+        low_priority: Run ffmpeg below capture priority
+        encoder_args: ffmpeg output args of the encoder profile (default: ENCODER_ARGS)
+        rotation: Display rotation (degrees clockwise) tagged onto the output
+        selection: Name of the subset of frames in frame_files, if not all
+        changed_from: Position in frame_files from which the frames may have
+                      changed since the last build although their paths
+                      didn't (re-rendered post-processed frames); segments
+                      covering it or anything after it are encoded again
+                   of them (segments of different subsets aren't shared)
+
+    Returns:
+        tuple: (success, error message, stats dict)
+    """
+    frame_count = len(frame_files)
+    seg_dir = segments_dir(videos_dir, session_id)
+    encoder_args = encoder_args or ENCODER_ARGS
+    settings = {'fps': fps, 'filter': video_filter, 'encoder': encoder_args}
+    if selection:
+        settings['selection'] = selection
+
+    with _session_lock(str(seg_dir)):
+        seg_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = seg_dir / 'segments.json'
+        manifest = _load_manifest(manifest_path, settings)
+        if not manifest['segments']:
+            # Settings changed (or first build): drop stale segment files
+            for stale in seg_dir.glob('seg_*.mp4'):
+                stale.unlink()
+
+        # Segments covering frames that no longer exist are useless, and so
+        # are those covering frames that changed
+        valid_until = frame_count if changed_from is None else min(frame_count, changed_from)
+        for stale in [s for s in manifest['segments'] if s['start'] + s['count'] > valid_until]:
+            (seg_dir / stale['file']).unlink(missing_ok=True)
+        manifest['segments'] = [s for s in manifest['segments']
+                                if s['start'] + s['count'] <= valid_until
+                                and (seg_dir / s['file']).exists()]
+
+        encoded_until = manifest['segments'][-1]['start'] + manifest['segments'][-1]['count'] \
+            if manifest['segments'] else 0
+        reused = encoded_until
+        encoded = 0
+        if on_progress and reused:
+            on_progress(reused)
+
+        while encoded_until < frame_count:
+            if cancel_event is not None and cancel_event.is_set():
+                _save_manifest(manifest_path, manifest)
+                return False, "Cancelled", {}
+            count = min(segment_frames, frame_count - encoded_until)
+            seg_file = f"seg_{encoded_until:09d}_{count:06d}.mp4"
+            # The frames come from the manifest, listed for the concat
+            # demuxer; -r makes each one a frame at the output rate
+            list_file = seg_dir / f".{seg_file}.txt"
+            _frame_list(list_file, frame_files[encoded_until:encoded_until + count])
+            cmd = [
+                'ffmpeg',
+                '-y',
+                '-f', 'concat',
+                '-safe', '0',
+                '-r', str(fps),
+                '-i', str(list_file),
+                '-frames:v', str(count),
+            ]
+            if video_filter:
+                cmd.extend(['-vf', video_filter])
+            cmd.extend(encoder_args)
+            cmd.append(str(seg_dir / seg_file))
+
+            done_before = reused + encoded
+            progress = (lambda n: on_progress(done_before + n)) if on_progress else None
+            returncode, error_msg = run_ffmpeg(cmd, progress, cancel_event=cancel_event,
+                                               low_priority=low_priority)
+            list_file.unlink(missing_ok=True)
+            if returncode != 0:
+                (seg_dir / seg_file).unlink(missing_ok=True)
+                _save_manifest(manifest_path, manifest)
+                return False, error_msg, {}
+
+            manifest['segments'].append({'start': encoded_until, 'count': count, 'file': seg_file})
+            _save_manifest(manifest_path, manifest)
+            encoded_until += count
+            encoded += count
+
+        if not manifest['segments']:
+            return False, "No frames to encode", {}
+
+        _compact_tail(seg_dir, manifest, segment_frames, low_priority)
+
+        # Stream-copy all segments into the final file
+        tmp_output = output_file.with_name(f".{output_file.name}.tmp.mp4")
+        returncode, error_msg = _concat(seg_dir, [s['file'] for s in manifest['segments']], tmp_output,
+                                        cancel_event, low_priority, rotation)
+        if returncode != 0:
+            tmp_output.unlink(missing_ok=True)
+            return False, error_msg, {}
+        os.replace(tmp_output, output_file)
+
+    stats = {'encoded_frames': encoded, 'reused_frames': reused, 'segments': len(manifest['segments'])}
+    print(f"[Video] Built {output_file.name}: {encoded} frames encoded, {reused} reused "
+          f"from {len(manifest['segments'])} segments")
+    return True, '', stats
@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+"""
+TimelapsePI - WSGI entry point for production serving
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+See SERVING.md for the concurrency model.
+"""
+
+from app import app as application, start_background_services
+
+start_background_services()